@@ -2,10 +2,13 @@
  Syntax: python build_models.py cfg_path
 '''
 
-from sklearn.cross_validation import train_test_split
-from numpy import std, mean, asarray
+from numpy import std, mean, asarray, flatnonzero
 from smyth import HMMCluster
-from sequence_utils import trim_inactive
+from sweep import SweepScheduler
+from hmm_utils import setBackend
+from sequence_utils import trim_inactive, SeriesBatch
+from prepcache import load_preprocessed
+from circrecord import RunSeries
 from math import log, exp
 from traceback import print_exc
 from pprint import pprint
@@ -24,6 +27,9 @@ def rev_log_preprocess(series):
 	return map(lambda s: rev_log_series(s),series)
 
 def log_series_preprocess(series):
+	if isinstance(series, RunSeries):
+		# one log per run rather than per window
+		return series.map(lambda c: log(1+c))
 	return map(lambda o: (log(1+o[0]), log(1+o[1])), series)
 
 def preprocess(series):
@@ -33,36 +39,80 @@ def filter_criteria(series):
 	return len(series[0]) > 0 and std(series[0]) > 0
 
 def filter_criteria_preprocess(series):
+	if isinstance(series, RunSeries) and len(series) > 0:
+		# series with two different counts have a nonzero std, so only
+		# a constant one has to be expanded. numpy's std of a constant
+		# series isn't always exactly 0, and this has to agree with it.
+		if len(set(series.values)) > 1:
+			return True
+		return std(asarray(series)) > 0
 	return len(series) > 0 and std(series) > 0
 
 def filter_processed(series):
 	return filter(filter_criteria, series)
 
+def preprocess_filtered(series):
+	"""
+	filter_processed(preprocess(series)), for all the series at once with a
+	SeriesBatch. No trimming is done: trim_inactive compares the (in, out)
+	windows themselves to 2, which is never true, so it leaves the series
+	as they are (and they come from trim_series.py, trimmed already).
+	@param series: a list of (window series, ip slug) tuples
+	@return: the log transformed series that pass filter_criteria, as
+		(list of (in, out) tuples, ip slug) tuples
+	"""
+	batch = SeriesBatch([s[0] for s in series])
+	batch.log_transform()
+	return [(batch.window_tuples(i), series[i][1]) for i in
+		flatnonzero(batch.good())]
+
 if __name__ == "__main__":
 	logging.disable('warning')
 	cfg_path = sys.argv[1]                        
 	with open(cfg_path) as cfg_file:
 		cfg = json.load(cfg_file)
-	with open(cfg['inpath']) as datafile:
-		records = cPickle.load(datafile)['records']
+	if 'hmm_backend' in cfg:
+		# "ghmm" or "numpy", see hmm_utils
+		setBackend(cfg['hmm_backend'])
 	with open(cfg['gt_path']) as gt_file:
 		gt = cPickle.load(gt_file)
-	out_series = [(record['relays'], record['ident'][1]) for record in records]
-	# log transformation and trim inactive
-	preprocessed = preprocess(out_series)
-	filtered = filter_processed(preprocessed)
+	# log transformed and filtered series, preprocessed on the first run
+	prep = load_preprocessed(cfg['inpath'])
+	filtered = prep.series()
 	print "%i series after preprocessing" % len(filtered)
 	if not isdir(cfg['outdir']):
 		mkdir(cfg['outdir'])
+	# every trial's models are trained together on one pool once all the
+	# clusterings are done, and each results file is written as soon as its
+	# models are
+	scheduler = SweepScheduler(cfg['n_jobs'])
+	outpaths = {}
+	def dump_trial(smyth_out):
+		outpath, rand_seed, target_m = outpaths[smyth_out]
+		trial = {
+			'components': smyth_out.components,
+			# 'composites': smyth_out.composites,
+			# 'init_hmms': smyth_out.init_hmms,
+			# 'dist_matrix': smyth_out.dist_matrix,
+			'times': smyth_out.times,
+			'labelings': smyth_out.labelings,
+			'rand_seed': rand_seed,
+			'beta': cfg['beta'],
+			'min_k': cfg['min_k'],
+			'max_k': cfg['max_k'],
+			'target_m': target_m
+		}
+		with open(outpath, 'w') as outfile:
+			print "Dumping results to %s" % outpath
+			cPickle.dump(trial, outfile)
 	for trial_num in xrange(0, cfg['n_trials']):
 		rand_seed = cfg['first_seed'] + trial_num
 		print "** Trial %i of %i **" % (trial_num+1, cfg['n_trials'])
 
 
 		if cfg['beta'] < 1:
-			train_array, test = train_test_split(filtered,
-				train_size=cfg['beta'], random_state=rand_seed)
-			train = [(series[0],series[1])for series in train_array]
+			train_idx, test_idx = prep.split(cfg['beta'], rand_seed)
+			train = [filtered[i] for i in train_idx]
 		else:
 			train = filtered
 		print "Training on %i time series" % len(train)
@@ -188,32 +238,12 @@ if __name__ == "__main__":
 				print "## Target m = %i ##" % target_m
 							#print labelings
 				smyth_out = HMMCluster(out_train, target_m, cfg['min_k'],
-					cfg['max_k'], labelings, 'hmm', 'smyth', cfg['n_jobs'])
-				"""
-				try:
-					smyth_out.model()
-				except Exception, e:
-					print "!!!", e, "(trial #%i, target_m=%i)" % \
-						(trial_num, target_m)
-					print_exc()
-					continue
-				"""
-				smyth_out.model()
-				trial = {
-					'components': smyth_out.components,
-					# 'composites': smyth_out.composites,
-					# 'init_hmms': smyth_out.init_hmms,
-					# 'dist_matrix': smyth_out.dist_matrix,
-					'times': smyth_out.times,
-					'labelings': smyth_out.labelings,
-					'rand_seed': rand_seed,
-					'beta': cfg['beta'],
-					'min_k': cfg['min_k'],
-					'max_k': cfg['max_k'],
-					'target_m': target_m
-				}
-				with open(outpath, 'w') as outfile:
-					print "Dumping results to %s" % outpath
-					cPickle.dump(trial, outfile)
+					cfg['max_k'], labelings, 'hmm', 'smyth', cfg['n_jobs'],
+					cfg.get('dist_dir'), pool=scheduler.pool,
+					parallel_bw=cfg.get('parallel_bw'))
+				outpaths[smyth_out] = (outpath, rand_seed, target_m)
+				scheduler.add(smyth_out)
 			else:
 				print "*** Results file %s already exists!" % outpath
+	scheduler.run(on_done=dump_trial)
+	scheduler.close()
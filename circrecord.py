@@ -0,0 +1,670 @@
+"""
+Compact in-memory circuit records. A CircuitRecord has the same keys as the
+record dicts produced by logparse.py, window.py and trim_series.py and can be
+used the same way (record['relays_in'], record['relays'], ...), but keeps its
+timestamps and window counts in flat machine arrays instead of lists of boxed
+floats and tuples. Its ident is packed too, so a short circuit costs little
+more than its cells:
+
+	relays_in, relays_out: millisecond offsets from the CREATE time, 16
+		or 32 bit depending on the circuit's length, both directions in
+		one array (2-4 bytes/cell instead of ~32)
+	relays: WindowSeries, interleaved 32 bit (in, out) window counts
+		(8 bytes/window instead of ~80-120), or RunSeries, the same counts
+		run-length encoded (12 bytes per run of equal windows, so idle
+		stretches of any length cost one run)
+
+	Syntax: python circrecord.py infile [window_size]
+
+Benchmarks the memory used by the circuits in infile, a logparse.py output
+file, as record dicts and as CircuitRecords, before and after windowing, and
+with the windows run-length encoded.
+"""
+
+from numpy import frombuffer, repeat, zeros, int16, int32, float64
+from array import array
+from bisect import bisect_right
+from circstore import load_records
+from time import time
+import sys
+
+class TimeSeries(object):
+	"""
+	A list of millisecond timestamps, stored as 32 bit integer offsets from
+	the first one. Behaves like the list of floats it replaces. If a
+	timestamp isn't a whole number of milliseconds, or is more than ~24 days
+	after the first one, the offsets fall back to 64 bit floats.
+	"""
+	__slots__ = ['base', 'offsets']
+
+	def __init__(self, times=()):
+		self.base = 0.0
+		self.offsets = array('i')
+		for t in times:
+			self.append(t)
+
+	def append(self, t):
+		if len(self.offsets) == 0:
+			self.base = float(t)
+		offset = t - self.base
+		if self.offsets.typecode == 'i':
+			try:
+				if offset == int(offset):
+					self.offsets.append(int(offset))
+					return
+			except OverflowError:
+				pass
+			self.offsets = array('d', self.offsets)
+		self.offsets.append(offset)
+
+	def __iadd__(self, times):
+		for t in times:
+			self.append(t)
+		return self
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self.base + o for o in self.offsets[i]]
+		return self.base + self.offsets[i]
+
+	def __iter__(self):
+		base = self.base
+		for o in self.offsets:
+			yield base + o
+
+	def __array__(self, dtype=None):
+		dtype_offsets = int32 if self.offsets.typecode == 'i' else float64
+		times = frombuffer(self.offsets, dtype_offsets) + self.base
+		if dtype is not None:
+			times = times.astype(dtype)
+		return times
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return repr(list(self))
+
+	def __getstate__(self):
+		return (self.base, self.offsets)
+
+	def __setstate__(self, state):
+		self.base, self.offsets = state
+
+class WindowSeries(object):
+	"""
+	A list of (in, out) window cell count tuples, stored as one array of
+	interleaved 32 bit counts. Indexing gives tuples, slicing gives another
+	WindowSeries.
+	"""
+	__slots__ = ['counts']
+
+	def __init__(self, windows=(), counts=None):
+		"""
+		@param windows: an iterable of (in, out) pairs
+		@param counts: an array('i') of interleaved counts to use directly,
+			instead of windows
+		"""
+		if counts is None:
+			counts = array('i')
+			for w_in, w_out in windows:
+				counts.append(w_in)
+				counts.append(w_out)
+		self.counts = counts
+
+	def __len__(self):
+		return len(self.counts)/2
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(len(self))
+			if step != 1:
+				return [self[j] for j in xrange(start, stop, step)]
+			return WindowSeries(counts=self.counts[2*start:2*max(start, stop)])
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError("window index out of range")
+		return (self.counts[2*i], self.counts[2*i+1])
+
+	def __iter__(self):
+		counts = self.counts
+		for i in xrange(0, len(counts), 2):
+			yield (counts[i], counts[i+1])
+
+	def __array__(self, dtype=None):
+		windows = frombuffer(self.counts, int32).reshape(-1, 2)
+		if dtype is not None:
+			windows = windows.astype(dtype)
+		return windows
+
+	def __add__(self, other):
+		return list(self) + list(other)
+
+	def __radd__(self, other):
+		return list(other) + list(self)
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return repr(list(self))
+
+	def __getstate__(self):
+		return self.counts
+
+	def __setstate__(self, state):
+		self.counts = state
+
+class RunSeries(object):
+	"""
+	A list of (in, out) window cell count tuples, run-length encoded: values
+	holds the interleaved (in, out) counts of each run of equal windows and
+	ends the index one past the run's last window. Behaves like a
+	WindowSeries, but its size, and the cost of slicing, indexing and the
+	run based operations, grows with the number of times the counts change
+	rather than with the number of windows.
+	"""
+	__slots__ = ['values', 'ends']
+
+	def __init__(self, windows=(), values=None, ends=None):
+		"""
+		@param windows: an iterable of (in, out) pairs of ints
+		@param values: an array of interleaved run counts to use directly,
+			instead of windows ('i', or 'd' for transformed counts)
+		@param ends: an array('i') of run ends to go with values
+		"""
+		if values is None:
+			values = array('i')
+			ends = array('i')
+			for w_in, w_out in windows:
+				if ends and values[-2] == w_in and values[-1] == w_out:
+					ends[-1] += 1
+				else:
+					values.append(w_in)
+					values.append(w_out)
+					ends.append(ends[-1] + 1 if ends else 1)
+		self.values = values
+		self.ends = ends
+
+	def runs(self):
+		"""
+		@return: a generator of ((in, out), length) pairs, one per run
+		"""
+		values = self.values
+		start = 0
+		for r, end in enumerate(self.ends):
+			yield ((values[2*r], values[2*r+1]), end - start)
+			start = end
+
+	def run_arrays(self):
+		"""
+		@return: (values, lengths), an (n_runs, 2) numpy array of the runs'
+			counts and an array of their lengths
+		"""
+		dtype = int32 if self.values.typecode == 'i' else float64
+		values = frombuffer(self.values, dtype).reshape(-1, 2)
+		ends = frombuffer(self.ends, int32)
+		lengths = ends.copy()
+		lengths[1:] -= ends[:-1]
+		return (values, lengths)
+
+	def map(self, func):
+		"""
+		Apply a function to every count, without expanding the runs.
+		@param func: a function from a count to a float
+		@return: the transformed series, as a RunSeries with float counts
+		"""
+		values = array('d', [func(v) for v in self.values])
+		return RunSeries(values=values, ends=array('i', self.ends))
+
+	def _cut(self, start, stop):
+		# the windows start, ..., stop-1 as a RunSeries
+		if start >= stop:
+			return RunSeries(values=array(self.values.typecode),
+				ends=array('i'))
+		first = bisect_right(self.ends, start)
+		last = bisect_right(self.ends, stop - 1)
+		ends = array('i', [end - start for end in self.ends[first:last]])
+		ends.append(stop - start)
+		return RunSeries(values=self.values[2*first:2*last+2], ends=ends)
+
+	def __len__(self):
+		return self.ends[-1] if self.ends else 0
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(len(self))
+			if step != 1:
+				return [self[j] for j in xrange(start, stop, step)]
+			return self._cut(start, stop)
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError("window index out of range")
+		r = bisect_right(self.ends, i)
+		return (self.values[2*r], self.values[2*r+1])
+
+	def __iter__(self):
+		for window, length in self.runs():
+			for i in xrange(0, length):
+				yield window
+
+	def __array__(self, dtype=None):
+		values, lengths = self.run_arrays()
+		windows = repeat(values, lengths, axis=0)
+		if dtype is not None:
+			windows = windows.astype(dtype)
+		return windows
+
+	def __add__(self, other):
+		return list(self) + list(other)
+
+	def __radd__(self, other):
+		return list(other) + list(self)
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return repr(list(self))
+
+	def __getstate__(self):
+		return (self.values, self.ends)
+
+	def __setstate__(self, state):
+		self.values, self.ends = state
+
+class CircuitTimes(object):
+	"""
+	The relays_in or relays_out timestamps of a CircuitRecord, a live view
+	of the cell offsets the record stores. Behaves like a TimeSeries, and
+	appending to it appends to the record. Pickles as a TimeSeries.
+	"""
+	__slots__ = ['record', 'direction']
+
+	def __init__(self, record, direction):
+		"""
+		@param record: the CircuitRecord
+		@param direction: 0 for relays_in, 1 for relays_out
+		"""
+		self.record = record
+		self.direction = direction
+
+	def _bounds(self):
+		# (offsets array, start, stop) of the cells in the record
+		return self.record._bounds(self.direction)
+
+	def append(self, t):
+		self.record._append(self.direction, t)
+
+	def __iadd__(self, times):
+		for t in list(times):
+			self.append(t)
+		return self
+
+	def __len__(self):
+		offsets, start, stop = self._bounds()
+		return stop - start
+
+	def __getitem__(self, i):
+		offsets, start, stop = self._bounds()
+		base = self.record.base()
+		if isinstance(i, slice):
+			return [base + o for o in offsets[start:stop][i]]
+		if i < 0:
+			i += stop - start
+		if i < 0 or i >= stop - start:
+			raise IndexError("timestamp index out of range")
+		return base + offsets[start + i]
+
+	def __iter__(self):
+		offsets, start, stop = self._bounds()
+		base = self.record.base()
+		for j in xrange(start, stop):
+			yield base + offsets[j]
+
+	def __array__(self, dtype=None):
+		offsets, start, stop = self._bounds()
+		dtype_offsets = dict((code, dtype) for code, limit, dtype in
+			CELL_TYPECODES)[offsets.typecode]
+		if stop > start:
+			times = (frombuffer(offsets, dtype_offsets)[start:stop] +
+				self.record.base())
+		else:
+			times = zeros(0, float64)
+		if dtype is not None:
+			times = times.astype(dtype)
+		return times
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return repr(list(self))
+
+	def __reduce__(self):
+		return (TimeSeries, (list(self),))
+
+# the typecodes cell offsets are stored with, smallest first, the range of
+# offsets each holds and the numpy dtype it reads as
+CELL_TYPECODES = [('h', 2**15, int16), ('i', 2**31, int32), ('d', None, float64)]
+
+def _cell_typecode(offsets, typecode='h'):
+	# the smallest typecode, no smaller than typecode, that stores offsets
+	# exactly
+	codes = [code for code, limit, dtype in CELL_TYPECODES]
+	for code, limit, dtype in CELL_TYPECODES[codes.index(typecode):]:
+		if limit is None:
+			return code
+		try:
+			if all(o == int(o) and -limit <= o < limit for o in offsets):
+				return code
+		except OverflowError:
+			pass
+
+class CircuitRecord(object):
+	"""
+	A circuit record with the keys of the logparse.py record dicts
+	('ident', 'create', 'destroy', 'relays_in', 'relays_out') or of the
+	window.py ones ('ident', 'create', 'destroy', 'relays'). Supports the
+	read/write mapping operations the pipeline uses on those dicts.
+
+	Most circuits are short, so a record holds as few objects as it can.
+	The ident ((relay_ip, circid), ipslug) is kept as the relay_ip string,
+	interned so records share it, and one int packing circid and ipslug.
+	The timestamps of both directions are offsets from create (or, for a
+	record without one, from 0) in the smallest of the CELL_TYPECODES that
+	holds them exactly. While cells are being appended they are in two
+	arrays; compact() packs them into one array of just the size needed:
+	the number of relays_in cells, the relays_in offsets and the
+	relays_out ones. Records are packed when pickled. relays_in and
+	relays_out are CircuitTimes views of the arrays, made on access.
+	"""
+	__slots__ = ['relay', 'ids', '_create', 'destroy', 'cells', 'relays']
+
+	# the mapping keys, in order
+	KEYS = ('ident', 'create', 'destroy', 'relays_in', 'relays_out', 'relays')
+
+	def __init__(self, ident, create, destroy=None, **series):
+		"""
+		@param ident: the circuit identifier ((relay_ip, circid), ipslug)
+		@param create: timestamp of the last CREATE cell
+		@param destroy: timestamp of the first DESTROY cell, or None
+		@param series: any of relays_in, relays_out (iterables of
+			timestamps, like TimeSeries) and relays (WindowSeries or
+			RunSeries)
+		"""
+		self.ident = ident
+		self._create = create
+		self.destroy = destroy
+		for key, value in series.iteritems():
+			self[key] = value
+
+	def _getIdent(self):
+		if self.relay is None:
+			return self.ids
+		if isinstance(self.ids, tuple):
+			return ((self.relay, self.ids[0]), self.ids[1])
+		return ((self.relay, int(self.ids >> 32)), int(self.ids & 0xffffffff))
+
+	def _setIdent(self, ident):
+		try:
+			(relay, circ_id), slug = ident
+		except (TypeError, ValueError):
+			relay = None
+		if relay is None:
+			self.relay = None
+			self.ids = ident
+			return
+		self.relay = intern(relay) if type(relay) is str else relay
+		if all(type(x) in (int, long) and 0 <= x < 2**32 for x in
+				(circ_id, slug)):
+			self.ids = (circ_id << 32) | slug
+		else:
+			self.ids = (circ_id, slug)
+
+	ident = property(_getIdent, _setIdent)
+
+	def _setCreate(self, create):
+		# the offsets are from create, so they move with it
+		if hasattr(self, 'cells'):
+			times = (list(self.relays_in), list(self.relays_out))
+			self._create = create
+			self._setCells(*times)
+		else:
+			self._create = create
+
+	create = property(lambda self: self._create, _setCreate)
+
+	def base(self):
+		"""
+		@return: the timestamp cell offsets are from
+		"""
+		return 0.0 if self._create is None else float(self._create)
+
+	def _bounds(self, direction):
+		# (offsets array, start, stop) of the cells of one direction
+		cells = self.cells
+		if isinstance(cells, tuple):
+			return (cells[direction], 0, len(cells[direction]))
+		n_in = int(cells[0])
+		if direction == 0:
+			return (cells, 1, 1 + n_in)
+		return (cells, 1 + n_in, len(cells))
+
+	def _append(self, direction, t):
+		cells = self.cells
+		if not isinstance(cells, tuple):
+			# unpack
+			n_in = int(cells[0])
+			cells = (cells[1:1 + n_in], cells[1 + n_in:])
+			self.cells = cells
+		offset = t - self.base()
+		typecode = _cell_typecode([offset], cells[0].typecode)
+		if typecode != cells[0].typecode:
+			cells = (array(typecode, cells[0]), array(typecode, cells[1]))
+			self.cells = cells
+		cells[direction].append(offset if typecode == 'd' else int(offset))
+
+	def _setCells(self, times_in, times_out):
+		# pack both directions' timestamps
+		base = self.base()
+		offsets = [len(times_in)] + [t - base for t in times_in] + \
+			[t - base for t in times_out]
+		typecode = _cell_typecode(offsets)
+		if typecode != 'd':
+			offsets = map(int, offsets)
+		self.cells = array(typecode, offsets)
+
+	def _getTimes(self, direction):
+		if not hasattr(self, 'cells'):
+			raise AttributeError("relays_out" if direction else "relays_in")
+		return CircuitTimes(self, direction)
+
+	def _setTimes(self, direction, times):
+		if (isinstance(times, CircuitTimes) and times.record is self and
+				times.direction == direction):
+			# record['relays_in'] += ... assigns the view back
+			return
+		both = [None, None]
+		both[direction] = list(times)
+		both[1 - direction] = (list(CircuitTimes(self, 1 - direction)) if
+			hasattr(self, 'cells') else [])
+		self._setCells(*both)
+
+	relays_in = property(lambda self: self._getTimes(0),
+		lambda self, times: self._setTimes(0, times))
+	relays_out = property(lambda self: self._getTimes(1),
+		lambda self, times: self._setTimes(1, times))
+
+	def compact(self):
+		"""
+		Pack the cells of both directions into one array of just the size
+		needed. Appending cells afterwards unpacks them again.
+		"""
+		cells = getattr(self, 'cells', None)
+		if isinstance(cells, tuple):
+			n_in = len(cells[0])
+			typecode = _cell_typecode([n_in], cells[0].typecode)
+			self.cells = array(typecode, [n_in]) + array(typecode,
+				cells[0]) + array(typecode, cells[1])
+
+	def keys(self):
+		return [key for key in self.KEYS if key in self]
+
+	def __contains__(self, key):
+		if key in ('relays_in', 'relays_out'):
+			return hasattr(self, 'cells')
+		if key == 'create':
+			return hasattr(self, '_create')
+		return key in self.KEYS and hasattr(self, key)
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __getitem__(self, key):
+		if key not in self.KEYS:
+			raise KeyError(key)
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		if key not in self.KEYS:
+			raise KeyError(key)
+		setattr(self, key, value)
+
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+
+	def to_dict(self):
+		"""
+		@return: the record as a dict in the original format, with lists of
+			floats and lists of tuples
+		"""
+		record = {}
+		for key in self.keys():
+			value = getattr(self, key)
+			if isinstance(value, (CircuitTimes, TimeSeries, WindowSeries,
+					RunSeries)):
+				value = list(value)
+			record[key] = value
+		return record
+
+	def __eq__(self, other):
+		if isinstance(other, CircuitRecord):
+			other = other.to_dict()
+		return self.to_dict() == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return "CircuitRecord(%r)" % self.to_dict()
+
+	def __getstate__(self):
+		self.compact()
+		return dict((key, getattr(self, key)) for key in self.__slots__ if
+			hasattr(self, key))
+
+	def __setstate__(self, state):
+		# older records' states are keyed by KEYS. Their create has to be
+		# in place before their timestamps are converted to offsets from it.
+		if 'create' in state:
+			self._create = state['create']
+		for key, value in state.iteritems():
+			if key != 'create':
+				setattr(self, key, value)
+
+def compact_record(record):
+	"""
+	Convert a record dict in any of the pipeline's formats to a
+	CircuitRecord.
+	@param record: the record dict
+	@return: the CircuitRecord
+	"""
+	series = {}
+	for key in ('relays_in', 'relays_out'):
+		if key in record:
+			series[key] = record[key]
+	if 'relays' in record:
+		series['relays'] = WindowSeries(record['relays'])
+	return CircuitRecord(record['ident'], record['create'], record['destroy'],
+		**series)
+
+def deep_size(obj, seen=None):
+	"""
+	@return: the total size in bytes of obj and every object it references,
+		counting shared objects once
+	"""
+	if seen is None:
+		seen = set()
+	if id(obj) in seen:
+		return 0
+	seen.add(id(obj))
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		for key, value in obj.iteritems():
+			size += deep_size(key, seen) + deep_size(value, seen)
+	elif isinstance(obj, (list, tuple)):
+		for item in obj:
+			size += deep_size(item, seen)
+	elif hasattr(obj, '__slots__'):
+		for key in obj.__slots__:
+			if hasattr(obj, key):
+				size += deep_size(getattr(obj, key), seen)
+	return size
+
+def _window_dict(record, window_size):
+	return {
+		'ident': record['ident'],
+		'create': record['create'],
+		'destroy': record['destroy'],
+		'relays': window_allrelays(record['create'], record['destroy'],
+			record['relays_in'], record['relays_out'], window_size)
+	}
+
+if __name__ == "__main__":
+	from window import window_allrelays
+	inpath = sys.argv[1]
+	window_size = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+	print "Loading circuit data..."
+	dicts = [record if isinstance(record, dict) else record.to_dict() for
+		record in load_records(inpath)]
+	start = time()
+	compact = [compact_record(record) for record in dicts]
+	print "Converted %i circuits in %.2fs" % (len(dicts), time() - start)
+	assert all(c == d for c, d in zip(compact, dicts))
+	dict_size = deep_size(dicts)
+	compact_size = deep_size(compact)
+	print "Parsed:   %12i bytes as dicts, %12i bytes compact (%.1fx)" % (
+		dict_size, compact_size, 1.0*dict_size/compact_size)
+
+	windowed_dicts = [_window_dict(record, window_size) for record in dicts]
+	windowed = [compact_record(record) for record in windowed_dicts]
+	dict_size = deep_size(windowed_dicts)
+	compact_size = deep_size(windowed)
+	print "Windowed: %12i bytes as dicts, %12i bytes compact (%.1fx)" % (
+		dict_size, compact_size, 1.0*dict_size/compact_size)
+	for record in windowed:
+		record.relays = RunSeries(record.relays)
+	runs_size = deep_size(windowed)
+	print "Runs:     %12i bytes as dicts, %12i bytes as runs (%.1fx)" % (
+		dict_size, runs_size, 1.0*dict_size/runs_size)
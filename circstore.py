@@ -0,0 +1,256 @@
+"""
+Columnar on-disk storage for the circuits parsed by logparse.py. A store is a
+directory of flat int64 column files that are opened with numpy.memmap, so
+readers only page in the columns and circuits they touch:
+
+	meta.json        number of circuits and cells, relay names
+	relay.bin        index into the relay names, per circuit
+	circ.bin         circuit id, per circuit
+	slug.bin         ip slug, per circuit
+	create.bin       timestamp of the last CREATE, per circuit
+	destroy.bin      timestamp of the first DESTROY (NO_DESTROY if none)
+	in_offsets.bin   CSR offsets into in_times, n_circuits + 1 entries
+	in_times.bin     timestamps of incoming RELAY cells, all circuits
+	out_offsets.bin  CSR offsets into out_times, n_circuits + 1 entries
+	out_times.bin    timestamps of outgoing RELAY cells, all circuits
+
+The RELAY cells of circuit i are in_times[in_offsets[i]:in_offsets[i+1]]
+(resp. out). Timestamps are milliseconds since January 1, 2013, as produced
+by logparse.parse_time. Stores are named with a ".circs" suffix.
+"""
+
+from numpy import array, memmap, zeros, int64
+from os.path import join, isdir
+from os import mkdir
+import json, cPickle
+
+NO_DESTROY = -1
+CIRC_COLUMNS = ["relay", "circ", "slug", "create", "destroy"]
+OFFSET_COLUMNS = ["in_offsets", "out_offsets"]
+TIME_COLUMNS = ["in_times", "out_times"]
+META_FILE = "meta.json"
+STORE_SUFFIX = ".circs"
+COLUMN_BYTES = 8
+# buffered RELAY cells are written out once there are more than this many
+FLUSH_CELLS = 1000000
+
+def is_store(path):
+	"""
+	@param path: a path to parsed circuit data
+	@return: True if path is (or names) a circuit store, False if it is a
+		pickle
+	"""
+	return isdir(path) or path.rstrip("/").endswith(STORE_SUFFIX)
+
+def _open_column(path, name, length):
+	# numpy can't memory map an empty file
+	if length == 0:
+		return zeros(0, int64)
+	return memmap(join(path, name + ".bin"), dtype=int64, mode='r',
+		shape=(length,))
+
+class CircuitStoreWriter(object):
+	"""
+	Writes circuit records to a store one at a time, so the records never
+	have to be in memory all at once.
+	"""
+	def __init__(self, path, n_keep=None):
+		"""
+		@param path: the directory to write the store to. It is created if
+			it doesn't exist; existing column files are overwritten.
+		@param n_keep: If given, the existing store at path is appended to
+			instead, after its first n_keep circuits. Any circuits after
+			those are dropped.
+		"""
+		self.path = path
+		self.files = {}
+		self.buffers = {}
+		for name in CIRC_COLUMNS + OFFSET_COLUMNS + TIME_COLUMNS:
+			self.buffers[name] = []
+		if n_keep is not None:
+			self._reopen(n_keep)
+			return
+		if not isdir(path):
+			mkdir(path)
+		self.n_circuits = 0
+		self.n_in = 0
+		self.n_out = 0
+		self.relay_idx = {}
+		self.relays = []
+		for name in CIRC_COLUMNS + OFFSET_COLUMNS + TIME_COLUMNS:
+			self.files[name] = open(join(path, name + ".bin"), 'wb')
+		for name in OFFSET_COLUMNS:
+			self.buffers[name].append(0)
+
+	def _reopen(self, n_keep):
+		# truncate the store's columns to its first n_keep circuits and
+		# position the files for appending
+		store = CircuitStore(self.path)
+		if n_keep > len(store):
+			raise ValueError("%s has only %i circuits, can't keep %i" %
+				(self.path, len(store), n_keep))
+		self.n_circuits = n_keep
+		self.n_in = int(store.in_offsets[n_keep])
+		self.n_out = int(store.out_offsets[n_keep])
+		self.relays = store.relays
+		self.relay_idx = dict((relay, i) for i, relay in
+			enumerate(self.relays))
+		del store
+		lengths = {'in_times': self.n_in, 'out_times': self.n_out}
+		for name in CIRC_COLUMNS:
+			lengths[name] = n_keep
+		for name in OFFSET_COLUMNS:
+			lengths[name] = n_keep + 1
+		for name, length in lengths.iteritems():
+			f = open(join(self.path, name + ".bin"), 'r+b')
+			f.truncate(length*COLUMN_BYTES)
+			f.seek(0, 2)
+			self.files[name] = f
+
+	def add(self, record):
+		"""
+		Append a circuit record.
+		@param record: a record in the format output by logparse.py
+		"""
+		(relay, circ), slug = record['ident']
+		if relay not in self.relay_idx:
+			self.relay_idx[relay] = len(self.relays)
+			self.relays.append(relay)
+		destroy = record['destroy']
+		if destroy is None:
+			destroy = NO_DESTROY
+		buffers = self.buffers
+		buffers['relay'].append(self.relay_idx[relay])
+		buffers['circ'].append(circ)
+		buffers['slug'].append(slug)
+		buffers['create'].append(int(record['create']))
+		buffers['destroy'].append(int(destroy))
+		relays_in, relays_out = record['relays_in'], record['relays_out']
+		buffers['in_times'].extend(relays_in)
+		buffers['out_times'].extend(relays_out)
+		self.n_in += len(relays_in)
+		self.n_out += len(relays_out)
+		buffers['in_offsets'].append(self.n_in)
+		buffers['out_offsets'].append(self.n_out)
+		self.n_circuits += 1
+		if len(buffers['in_times']) + len(buffers['out_times']) > FLUSH_CELLS:
+			self.flush()
+
+	def flush(self):
+		"""
+		Write the buffered columns out to their files.
+		"""
+		for name, buf in self.buffers.iteritems():
+			array(buf, int64).tofile(self.files[name])
+			del buf[:]
+
+	def close(self):
+		"""
+		Flush the column files and write the store's metadata.
+		"""
+		self.flush()
+		for f in self.files.itervalues():
+			f.close()
+		with open(join(self.path, META_FILE), 'w') as meta_file:
+			json.dump({
+				'n_circuits': self.n_circuits,
+				'n_in': self.n_in,
+				'n_out': self.n_out,
+				'relays': self.relays
+			}, meta_file)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+class CircuitStore(object):
+	"""
+	Read only, memory mapped view of a circuit store. Iterating over it or
+	indexing it gives records in the format output by logparse.py.
+	"""
+	def __init__(self, path):
+		"""
+		@param path: the store's directory
+		"""
+		self.path = path
+		with open(join(path, META_FILE)) as meta_file:
+			meta = json.load(meta_file)
+		self.n_circuits = meta['n_circuits']
+		self.relays = [str(relay) for relay in meta['relays']]
+		n = self.n_circuits
+		for name in CIRC_COLUMNS:
+			setattr(self, name, _open_column(path, name, n))
+		for name in OFFSET_COLUMNS:
+			setattr(self, name, _open_column(path, name, n + 1))
+		self.in_times = _open_column(path, "in_times", meta['n_in'])
+		self.out_times = _open_column(path, "out_times", meta['n_out'])
+
+	def __len__(self):
+		return self.n_circuits
+
+	def ident(self, i):
+		"""
+		@return: the ident of circuit i, ((relay_ip, circ_id), ip_slug)
+		"""
+		return ((self.relays[self.relay[i]], int(self.circ[i])),
+			int(self.slug[i]))
+
+	def relays_in(self, i):
+		"""
+		@return: the incoming RELAY cell timestamps of circuit i, as a slice
+			of the memory mapped column
+		"""
+		return self.in_times[self.in_offsets[i]:self.in_offsets[i+1]]
+
+	def relays_out(self, i):
+		"""
+		@return: the outgoing RELAY cell timestamps of circuit i, as a slice
+			of the memory mapped column
+		"""
+		return self.out_times[self.out_offsets[i]:self.out_offsets[i+1]]
+
+	def __getitem__(self, i):
+		"""
+		@return: circuit i as a record dict in the format output by
+			logparse.py, with float timestamps
+		"""
+		if i < 0:
+			i += self.n_circuits
+		if i < 0 or i >= self.n_circuits:
+			raise IndexError("circuit index out of range: %i" % i)
+		destroy = int(self.destroy[i])
+		return {
+			'ident': self.ident(i),
+			'create': float(self.create[i]),
+			'destroy': None if destroy == NO_DESTROY else float(destroy),
+			'relays_in': self.relays_in(i).astype(float).tolist(),
+			'relays_out': self.relays_out(i).astype(float).tolist()
+		}
+
+	def __iter__(self):
+		for i in xrange(0, self.n_circuits):
+			yield self[i]
+
+def write_store(path, records):
+	"""
+	Write a list of circuit records to a store.
+	@param path: the store's directory
+	@param records: an iterable of records in the format output by logparse.py
+	"""
+	with CircuitStoreWriter(path) as writer:
+		for record in records:
+			writer.add(record)
+
+def load_records(path):
+	"""
+	Load parsed circuits as a list of record dicts, whether they were saved
+	as a store or as a pickle.
+	@param path: the store's directory, or a pickle output by logparse.py
+	@return: the list of records
+	"""
+	if is_store(path):
+		return list(CircuitStore(path))
+	with open(path) as data_file:
+		return cPickle.load(data_file)
@@ -0,0 +1,199 @@
+"""
+Persistent condensed distance matrices for smyth.HMMCluster. The matrix is
+computed in tiles, pairs of blocks of sequences (see smyth.distanceTile),
+and each tile is written into a memory mapped file as it completes, so a
+crashed run loses at most the tiles since the last flush, and the matrix
+never has to fit in memory. An entry is a directory:
+
+	meta.json          number of sequences and the block size
+	dist.npy           condensed float32 distance matrix (the upper triangle,
+	                   row by row, as scipy's squareform uses)
+	tiles.npy          completion bitmap, one byte per tile
+	init_hmms.pickle   the default HMM triples the distances are computed
+	                   from
+
+Entries are content addressed, like prepcache's: they are named by the md5
+of the sequences and the parameters of the distance computation, so a rerun
+on the same inputs finds the entry and only computes its missing tiles.
+"""
+
+from numpy import (array, asarray, concatenate, arange, zeros, uint8, int64,
+	float32, float64, broadcast_arrays, flatnonzero)
+from numpy.lib.format import open_memmap
+from os.path import join, isdir, exists
+from os import mkdir, rename, getpid
+from hashlib import md5
+import json, cPickle
+
+META_FILE = "meta.json"
+# tiles written between flushes of the matrix and the bitmap
+FLUSH_TILES = 64
+
+def condensedIndex(rows, cols, n):
+	"""
+	@param rows: row indices into an n x n matrix
+	@param cols: column indices, with rows < cols
+	@param n: the number of rows of the matrix
+	@return: the indices of the (row, col) entries in the condensed form of
+		the matrix
+	"""
+	return rows*(2*n - rows - 1)/2 + cols - rows - 1
+
+def tileList(n, block):
+	"""
+	@param n: the number of sequences
+	@param block: the number of sequences per block
+	@return: the tiles of the matrix, a list of (bi, bj) block number pairs
+		with bi <= bj, in the order of their bits in the completion bitmap
+	"""
+	n_blocks = (n + block - 1)/block
+	return [(bi, bj) for bi in xrange(0, n_blocks) for bj in
+		xrange(bi, n_blocks)]
+
+def distanceKey(seqs, params):
+	"""
+	@param seqs: the sequences, in Python list form
+	@param params: a dict of the parameters the distances depend on
+	@return: the name of the entry for seqs and params
+	"""
+	digest = md5(json.dumps(params, sort_keys=True))
+	digest.update(array([len(s) for s in seqs], int64).tostring())
+	if len(seqs) > 0:
+		digest.update(concatenate([asarray(s, float64) for s in
+			seqs]).tostring())
+	return digest.hexdigest()
+
+class DistanceStore(object):
+	"""
+	A condensed distance matrix that is filled in tile by tile, kept in
+	memory or in an entry directory.
+	"""
+	def __init__(self, n, block, path=None):
+		"""
+		@param n: the number of sequences
+		@param block: the number of sequences per block
+		@param path: the entry's directory, created if it doesn't exist. If
+			None, the matrix is kept in memory.
+		"""
+		self.n = n
+		self.block = block
+		self.path = path
+		self.tiles = tileList(n, block)
+		self.pending = []
+		n_dists = n*(n-1)/2
+		if path is None:
+			self.dist = zeros(n_dists, float32)
+			self.done = zeros(len(self.tiles), uint8)
+			return
+		if not isdir(path):
+			self._create(path, n_dists)
+		with open(join(path, META_FILE)) as meta_file:
+			meta = json.load(meta_file)
+		if meta['n'] != n or meta['block'] != block:
+			raise ValueError("%s holds %i sequences in blocks of %i" %
+				(path, meta['n'], meta['block']))
+		self.dist = open_memmap(join(path, "dist.npy"), mode='r+')
+		self.done = open_memmap(join(path, "tiles.npy"), mode='r+')
+
+	def _create(self, path, n_dists):
+		# build the entry under a temporary name and rename it into place,
+		# so a half created entry is never opened
+		tmp_path = "%s.%i.tmp" % (path, getpid())
+		mkdir(tmp_path)
+		open_memmap(join(tmp_path, "dist.npy"), mode='w+', dtype=float32,
+			shape=(n_dists,))
+		open_memmap(join(tmp_path, "tiles.npy"), mode='w+', dtype=uint8,
+			shape=(len(self.tiles),))
+		with open(join(tmp_path, META_FILE), 'w') as meta_file:
+			json.dump({'n': self.n, 'block': self.block}, meta_file)
+		rename(tmp_path, path)
+
+	def missing(self):
+		"""
+		@return: the tiles that haven't been written yet
+		"""
+		return [self.tiles[t] for t in flatnonzero(self.done == 0)]
+
+	def add(self, bi, bj, D):
+		"""
+		Write a tile of distances.
+		@param bi, bj: the tile's block numbers
+		@param D: the distances between the sequences of the blocks, as
+			returned by smyth.distanceTile
+		"""
+		lo_i, lo_j = bi*self.block, bj*self.block
+		rows = arange(lo_i, lo_i + D.shape[0], dtype=int64)
+		cols = arange(lo_j, lo_j + D.shape[1], dtype=int64)
+		rows, cols = broadcast_arrays(rows[:,None], cols[None,:])
+		upper = rows < cols
+		self.dist[condensedIndex(rows[upper], cols[upper], self.n)] = D[upper]
+		n_blocks = (self.n + self.block - 1)/self.block
+		# tiles are numbered row by row of the upper triangle of blocks
+		self.pending.append(bi*n_blocks - bi*(bi-1)/2 + bj - bi)
+		if len(self.pending) >= FLUSH_TILES:
+			self.flush()
+
+	def flush(self):
+		"""
+		Mark the tiles written since the last flush as done. The distances
+		are flushed to disk before the bitmap, so a tile is never marked
+		done before its distances are saved.
+		"""
+		if self.path is not None:
+			self.dist.flush()
+		self.done[self.pending] = 1
+		if self.path is not None:
+			self.done.flush()
+		self.pending = []
+
+	def complete(self):
+		"""
+		@return: True if every tile has been written
+		"""
+		return bool(self.done.all())
+
+	def copyFrom(self, base):
+		"""
+		Copy in the distances of a store of this one's first base.n
+		sequences, and mark the tiles whose blocks are all base sequences as
+		done. Tiles of a block that is only partly made of base sequences
+		are left to be computed.
+		@param base: the complete DistanceStore of the base sequences
+		"""
+		if base.block != self.block or base.n > self.n:
+			raise ValueError("can't extend %i sequences in blocks of %i to "
+				"%i in blocks of %i" % (base.n, base.block, self.n, self.block))
+		# row i of the upper triangle is contiguous in both matrices
+		for i in xrange(0, base.n - 1):
+			src = condensedIndex(i, i + 1, base.n)
+			dst = condensedIndex(i, i + 1, self.n)
+			length = base.n - i - 1
+			self.dist[dst:dst + length] = base.dist[src:src + length]
+		full_blocks = base.n/self.block
+		self.pending = [t for t, (bi, bj) in enumerate(self.tiles) if
+			bj < full_blocks]
+		self.flush()
+
+	def loadInitHMMs(self):
+		"""
+		@return: the default HMM triples saved with saveInitHMMs, or None
+		"""
+		if self.path is None or not exists(join(self.path,
+				"init_hmms.pickle")):
+			return None
+		with open(join(self.path, "init_hmms.pickle")) as hmm_file:
+			return cPickle.load(hmm_file)
+
+	def saveInitHMMs(self, triples):
+		"""
+		Save the default HMM triples the distances are computed from, so a
+		resumed run uses the same ones.
+		@param triples: the triples
+		"""
+		if self.path is None:
+			return
+		path = join(self.path, "init_hmms.pickle")
+		tmp_path = "%s.%i.tmp" % (path, getpid())
+		with open(tmp_path, 'wb') as hmm_file:
+			cPickle.dump(triples, hmm_file, protocol=2)
+		rename(tmp_path, path)
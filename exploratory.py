@@ -17,13 +17,14 @@ format 'circ_id,ip_slug'.
 """
 
 from scipy.stats import skew, pearsonr
-from numpy import mean, std, median, linspace, correlate
+from numpy import mean, std, median, linspace, correlate, int64
 from matplotlib.colors import LinearSegmentedColormap, ListedColormap
 from matplotlib.patches import Rectangle
 from sklearn.cluster import k_means
 from pprint import pprint
 from math import sqrt
 from sequence_utils import trim_inactive_preprocess, flatten
+from circrecord import RunSeries
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import pylab
@@ -123,6 +124,27 @@ def discretize(relay_series):
 	cluster_ranges = zip(sorted(cluster_mins), sorted(cluster_maxes))
 	return (relay_series, cluster_ranges)
 
+def run_stats(values, lengths):
+	"""
+	Summary stats for a run-length encoded series of counts, computed
+	without expanding the runs
+	@param values: array of the counts of each run
+	@param lengths: array of the lengths of each run
+	@return: (mean, median, min, max, std) of the expanded series
+	"""
+	values = values.astype(int64)
+	n = lengths.sum()
+	mean_value = 1.0*(values*lengths).sum()/n
+	order = values.argsort(kind='mergesort')
+	sorted_values = values[order]
+	cum_lengths = lengths[order].cumsum()
+	# the middle one or two values of the sorted, expanded series
+	low = sorted_values[cum_lengths.searchsorted((n-1)/2, side='right')]
+	high = sorted_values[cum_lengths.searchsorted(n/2, side='right')]
+	std_value = sqrt((lengths*(values - mean_value)**2).sum()/n)
+	return (mean_value, (low + high)/2.0, int(values.min()),
+		int(values.max()), std_value)
+
 def do_summarize(records):
 	"""
 	Display summary histograms for the series in records.
@@ -144,25 +166,34 @@ def do_summarize(records):
 	out_median_cells_per_window_aggr = []
 	out_stddev_cells_per_window_aggr = []
 	out_inst_counts_aggr = []
+	# number of windows with each instantaneous count, one per run
+	inst_weights_aggr = []
 
 	for record in records:
 		relays = record['relays']
-		in_relays = [r[0] for r in relays]
-		out_relays = [r[1] for r in relays]
+		if not isinstance(relays, RunSeries):
+			relays = RunSeries(relays)
+		# the statistics are computed on the runs, weighted by their lengths
+		values, lengths = relays.run_arrays()
 		circ_len_aggr.append((record['destroy'] - record['create'])/1000.0)
-		in_mean_cells_per_window_aggr.append(1.0*sum(in_relays)/len(in_relays))
-		out_mean_cells_per_window_aggr.append(1.0*sum(out_relays)/len(out_relays))
-
-		in_median_cells_per_window_aggr.append(median(in_relays))
-		out_median_cells_per_window_aggr.append(median(out_relays))
-		in_min_cells_per_window_aggr.append(min(in_relays))
-		out_min_cells_per_window_aggr.append(min(out_relays))
-		in_max_cells_per_window_aggr.append(max(in_relays))
-		out_max_cells_per_window_aggr.append(max(out_relays))
-		in_stddev_cells_per_window_aggr.append(std(in_relays))
-		out_stddev_cells_per_window_aggr.append(std(out_relays))
-		in_inst_counts_aggr += in_relays
-		out_inst_counts_aggr += out_relays
+		in_mean, in_median, in_min, in_max, in_std = run_stats(values[:,0],
+			lengths)
+		out_mean, out_median, out_min, out_max, out_std = run_stats(
+			values[:,1], lengths)
+		in_mean_cells_per_window_aggr.append(in_mean)
+		out_mean_cells_per_window_aggr.append(out_mean)
+
+		in_median_cells_per_window_aggr.append(in_median)
+		out_median_cells_per_window_aggr.append(out_median)
+		in_min_cells_per_window_aggr.append(in_min)
+		out_min_cells_per_window_aggr.append(out_min)
+		in_max_cells_per_window_aggr.append(in_max)
+		out_max_cells_per_window_aggr.append(out_max)
+		in_stddev_cells_per_window_aggr.append(in_std)
+		out_stddev_cells_per_window_aggr.append(out_std)
+		in_inst_counts_aggr += values[:,0].tolist()
+		out_inst_counts_aggr += values[:,1].tolist()
+		inst_weights_aggr += lengths.tolist()
 		# unique_vals_aggr.append(len(set(filter(lambda o: o > 2, relays))))
 		time_active = len(trim_inactive_preprocess(relays))
 
@@ -221,8 +252,10 @@ def do_summarize(records):
 	plt.xlabel("Single Window Cell Count")
 	plt.ylabel("Frequency")
 	plt.yscale('log')
-	cellsplot.hist(in_inst_counts_aggr, bins=N_HIST_BINS, alpha=0.5, label='in')
-	cellsplot.hist(out_inst_counts_aggr, bins=N_HIST_BINS, alpha=0.5, label='out')
+	cellsplot.hist(in_inst_counts_aggr, weights=inst_weights_aggr,
+		bins=N_HIST_BINS, alpha=0.5, label='in')
+	cellsplot.hist(out_inst_counts_aggr, weights=inst_weights_aggr,
+		bins=N_HIST_BINS, alpha=0.5, label='out')
 
 
 	lenplot = fig.add_subplot(427)
@@ -0,0 +1,396 @@
+"""
+A pure numpy HMM with 1-D Gaussian emissions, a stand in for the ghmm
+models hmm_utils.tripleToHMM builds (see hmm_utils.HMM_BACKEND). Models are
+made from the same (A, B, pi) triples, with B a list of (mu, sigma) pairs.
+As in ghmm, sigma is used as the variance of the state's normal
+distribution.
+
+Forward-backward is scaled, with the emission densities of each step
+normalized by their maximum in log space first, so long sequences and far
+off observations don't underflow. It runs on a batch of sequences at once:
+the sequences are sorted by length, padded into BATCH_SEQS x length
+matrices and every step is vectorized over sequences and states.
+
+Baum-Welch on a large set of sequences can have its E-step split across a
+multiprocessing.Pool. The sequences are cut into one shard per worker,
+written to a temporary directory once, and memory mapped by the workers the
+first time they get each shard (see shardStatistics). Each step then only
+sends the current model out and the shards' statistics back.
+
+	Syntax: python gaussian_hmm.py [n_seqs] [length]
+
+Benchmarks Baum-Welch and log likelihood against ghmm on
+sample_gen.smyth_example data, with n_seqs sequences of each of its two
+models (default 50) of the given length (default 200).
+"""
+
+from numpy import (array, asarray, zeros, ones, exp, log, pi as PI, einsum,
+	dot, where, float64, int64, argsort, isfinite, cumsum, searchsorted,
+	errstate, arange, load, save)
+from numpy.random import RandomState
+from multiprocessing import cpu_count
+from os.path import join
+from tempfile import mkdtemp
+from time import time
+import sys, shutil
+
+# how many sequences are run through forward-backward at once
+BATCH_SEQS = 256
+# smallest variance Baum-Welch can give a state (ghmm's GHMM_EPS_U)
+MIN_VARIANCE = 1e-4
+# ghmm's defaults for baumWelch
+BW_STEPS = 500
+BW_CUTOFF = 0.0001
+
+def _padded(seqs, order):
+	# the sequences seqs[order[0]], seqs[order[1]], ... as a zero padded
+	# matrix, and a mask of the real observations
+	lengths = [len(seqs[i]) for i in order]
+	obs = zeros((len(order), max(lengths) if lengths else 0), float64)
+	mask = zeros(obs.shape, bool)
+	for row, i in enumerate(order):
+		obs[row, 0:lengths[row]] = seqs[i]
+		mask[row, 0:lengths[row]] = True
+	return (obs, mask)
+
+def _batches(seqs, order=None):
+	# (indices, obs, mask) batches of the sequences, sorted by length so
+	# little padding is needed, or of seqs[order[0]], seqs[order[1]], ...
+	if order is None:
+		order = argsort([len(s) for s in seqs], kind='mergesort')
+	batches = []
+	for start in xrange(0, len(order), BATCH_SEQS):
+		batch = order[start:start + BATCH_SEQS]
+		obs, mask = _padded(seqs, batch)
+		batches.append((batch, obs, mask))
+	return batches
+
+def _sumStatistics(batch_stats):
+	# the statistics of a list of batches, added up in order, or None if
+	# there are none
+	stats = None
+	for s in batch_stats:
+		if stats is None:
+			stats = dict(s)
+		else:
+			for key, value in s.iteritems():
+				stats[key] = stats[key] + value
+	return stats
+
+def _shardPath(shard_dir, shard, batch, name):
+	return join(shard_dir, "%i_%i_%s.npy" % (shard, batch, name))
+
+def writeShards(seqs, n_shards):
+	"""
+	Cut sequences into shards of about the same number of observations, and
+	save each shard's padded batches to a new temporary directory, for
+	shardStatistics. The caller deletes the directory.
+	@param seqs: a list of non-empty float arrays
+	@param n_shards: the number of shards
+	@return: (shard_dir, n_batches), the directory and the number of
+		batches of each shard
+	"""
+	order = argsort([len(s) for s in seqs], kind='mergesort')
+	ends = cumsum([len(seqs[i]) for i in order])
+	if len(ends) > 0:
+		cuts = searchsorted(ends, ends[-1]*arange(1, n_shards)/float(n_shards),
+			'right')
+	else:
+		cuts = [0]*(n_shards - 1)
+	bounds = [0] + list(cuts) + [len(order)]
+	shard_dir = mkdtemp(prefix="bw_shards.")
+	n_batches = []
+	for shard in xrange(0, n_shards):
+		batches = _batches(seqs, order[bounds[shard]:bounds[shard + 1]])
+		for b, (batch, obs, mask) in enumerate(batches):
+			save(_shardPath(shard_dir, shard, b, "obs"), obs)
+			save(_shardPath(shard_dir, shard, b, "mask"), mask)
+		n_batches.append(len(batches))
+	return (shard_dir, n_batches)
+
+# the shards of the Baum-Welch run a pool worker last worked on, see
+# shardStatistics
+_bwState = {}
+
+def shardStatistics(item):
+	"""
+	The E-step of one Baum-Welch step on one shard of sequences, for
+	splitting Baum-Welch across processes (see GaussianHMM.baumWelch). Each
+	worker memory maps a shard the first time it gets it, and keeps it
+	until it gets a shard of another run.
+	@param item: a (shard_dir, shard, n_batches, triple) tuple: the shard,
+		as written by writeShards, and the model as a triple
+	@return: the shard's expected sufficient statistics, or None if it has
+		no sequences
+	"""
+	shard_dir, shard, n_batches, triple = item
+	if _bwState.get('shard_dir') != shard_dir:
+		_bwState.clear()
+		_bwState['shard_dir'] = shard_dir
+		_bwState['shards'] = {}
+	shards = _bwState['shards']
+	if shard not in shards:
+		shards[shard] = [(load(_shardPath(shard_dir, shard, b, "obs"),
+			mmap_mode='r'), load(_shardPath(shard_dir, shard, b, "mask"),
+			mmap_mode='r')) for b in xrange(0, n_batches)]
+	model = GaussianHMM(triple)
+	return _sumStatistics(model._statistics(obs, mask) for obs, mask in
+		shards[shard])
+
+class SequenceBatches(object):
+	"""
+	Sequences padded into batches once, to be scored under many models with
+	GaussianHMM.loglikelihoods.
+	"""
+	def __init__(self, seqs):
+		"""
+		@param seqs: a list of sequences (lists or arrays of floats)
+		"""
+		self.n = len(seqs)
+		self.batches = _batches(seqs)
+
+	def __len__(self):
+		return self.n
+
+class GaussianHMM(object):
+	"""
+	An HMM with a 1-D Gaussian emission distribution per state.
+	"""
+	def __init__(self, triple):
+		"""
+		@param triple: the model as a triple (A, B, pi), see hmm_utils
+		"""
+		A, B, pi = triple
+		self.A = array(A, float64)
+		B = array(B, float64).reshape(-1, 2)
+		self.mu = B[:,0].copy()
+		self.sigma = B[:,1].copy()
+		self.pi = array(pi, float64)
+		self.N = len(self.pi)
+
+	def toTriple(self):
+		"""
+		@return: the model as a triple (A, B, pi), in the form
+			hmm_utils.hmmToTriple gives for a ghmm model
+		"""
+		B = [(float(m), float(s)) for m, s in zip(self.mu, self.sigma)]
+		return (self.A.copy(), B, self.pi.tolist())
+
+	def _emissions(self, obs):
+		# log densities of obs under every state, split into normalized
+		# densities and the per step log of the normalizing maximum
+		log_b = (-0.5*log(2*PI*self.sigma) -
+			(obs[...,None] - self.mu)**2/(2*self.sigma))
+		log_max = log_b.max(axis=-1)
+		log_max[~isfinite(log_max)] = 0
+		return (exp(log_b - log_max[...,None]), log_max)
+
+	def _forward(self, obs, mask):
+		# scaled forward pass over a padded batch of sequences
+		# @return: (alpha, scale, b, log_max): alpha[s,t] is the filtered
+		#	state distribution and scale[s,t] the scaling factor of step t
+		#	(1 past the end of a sequence)
+		n_seqs, length = obs.shape
+		b, log_max = self._emissions(obs)
+		alpha = zeros((n_seqs, length, self.N), float64)
+		scale = ones((n_seqs, length), float64)
+		prev = self.pi*b[:,0]
+		for t in xrange(0, length):
+			if t > 0:
+				prev = dot(alpha[:,t-1], self.A)*b[:,t]
+			c = prev.sum(axis=1)
+			# a sequence the model can't produce gets a 0 scaling factor,
+			# and so a log likelihood of -inf
+			scale[:,t] = where(mask[:,t], c, 1.0)
+			norm = where(c > 0, c, 1.0)
+			alpha[:,t] = where(mask[:,t,None], prev/norm[:,None],
+				alpha[:,t-1] if t > 0 else 0)
+		log_max[~mask] = 0
+		return (alpha, scale, b, log_max)
+
+	def _batch_loglikelihoods(self, obs, mask):
+		alpha, scale, b, log_max = self._forward(obs, mask)
+		with errstate(divide='ignore'):
+			return (log(scale) + log_max).sum(axis=1)
+
+	def loglikelihoods(self, seqs):
+		"""
+		@param seqs: a list of sequences (lists or arrays of floats), or a
+			SequenceBatches
+		@return: an array of the log likelihood of each sequence
+		"""
+		if not isinstance(seqs, SequenceBatches):
+			seqs = SequenceBatches(seqs)
+		result = zeros(len(seqs), float64)
+		for batch, obs, mask in seqs.batches:
+			result[batch] = self._batch_loglikelihoods(obs, mask)
+		return result
+
+	def loglikelihood(self, seqs):
+		"""
+		@param seqs: a list of sequences, or a single sequence of floats
+		@return: the sum of the sequences' log likelihoods, as ghmm's
+			loglikelihood gives for a SequenceSet
+		"""
+		if len(seqs) > 0 and not hasattr(seqs[0], '__len__'):
+			seqs = [seqs]
+		return float(self.loglikelihoods(seqs).sum())
+
+	def _statistics(self, obs, mask):
+		# expected sufficient statistics of a batch for one Baum-Welch step.
+		# Like ghmm, sequences the model can't produce are left out.
+		alpha, scale, b, log_max = self._forward(obs, mask)
+		possible = (scale > 0).all(axis=1)
+		if not possible.all():
+			obs, mask = obs[possible], mask[possible]
+			alpha, scale, b, log_max = self._forward(obs, mask)
+		n_seqs, length = obs.shape
+		beta = ones((n_seqs, length, self.N), float64)
+		for t in xrange(length - 2, -1, -1):
+			nxt = b[:,t+1]*beta[:,t+1]/scale[:,t+1,None]
+			beta[:,t] = where(mask[:,t+1,None], dot(nxt, self.A.T), 1.0)
+		gamma = alpha*beta
+		gamma[~mask] = 0
+		# xi summed over sequences and steps
+		nxt = b[:,1:]*beta[:,1:]/scale[:,1:,None]
+		nxt[~mask[:,1:]] = 0
+		trans = einsum('sti,stj->ij', alpha[:,:-1], nxt)*self.A
+		return {
+			'n_seqs': n_seqs,
+			'loglikelihood': (log(scale) + log_max).sum(),
+			'start': gamma[:,0].sum(axis=0),
+			'trans': trans,
+			'gamma': gamma.sum(axis=(0, 1)),
+			'gamma_x': einsum('stn,st->n', gamma, obs),
+			'gamma_xx': einsum('stn,st->n', gamma, obs*obs)
+		}
+
+	def baumWelch(self, seqs, nrSteps=BW_STEPS,
+			loglikelihoodCutoff=BW_CUTOFF, pool=None, n_shards=None):
+		"""
+		Train the model on a set of sequences with Baum-Welch, in place.
+		Stops after nrSteps steps or once a step improves the total log
+		likelihood by less than loglikelihoodCutoff times its magnitude.
+		@param seqs: a list of sequences (lists or arrays of floats)
+		@param pool: a multiprocessing.Pool to run the E-step of each step
+			on, by shard of the sequences (see writeShards). The statistics
+			are added up in a different order than without one, so the
+			model is the same up to rounding.
+		@param n_shards: how many shards to cut the sequences into for
+			pool, normally its number of workers. cpu_count() if None.
+		@return: the total log likelihood of seqs under the trained model
+		"""
+		seqs = [asarray(s, float64) for s in seqs]
+		seqs = [s for s in seqs if len(s) > 0]
+		if pool is None:
+			batches = _batches(seqs)
+			estep = lambda: _sumStatistics(self._statistics(obs, mask) for
+				batch, obs, mask in batches)
+			return self._baumWelch(estep, nrSteps, loglikelihoodCutoff)
+		if n_shards is None:
+			n_shards = cpu_count()
+		shard_dir, n_batches = writeShards(seqs, n_shards)
+		def estep():
+			triple = self.toTriple()
+			shard_stats = pool.map(shardStatistics, [(shard_dir, shard, n,
+				triple) for shard, n in enumerate(n_batches)])
+			return _sumStatistics(s for s in shard_stats if s is not None)
+		try:
+			return self._baumWelch(estep, nrSteps, loglikelihoodCutoff)
+		finally:
+			shutil.rmtree(shard_dir)
+
+	def _baumWelch(self, estep, nrSteps, loglikelihoodCutoff):
+		# the Baum-Welch loop of baumWelch, with estep() giving the summed
+		# statistics of all the sequences under the current model
+		last = None
+		for step in xrange(0, nrSteps):
+			stats = estep()
+			if stats is None:
+				return 0.0
+			loglik = stats['loglikelihood']
+			if last is not None and (loglik - last <=
+					loglikelihoodCutoff*abs(loglik)):
+				return loglik
+			last = loglik
+			if stats['n_seqs'] == 0:
+				return loglik
+			self._reestimate(stats)
+		return last
+
+	def _reestimate(self, stats):
+		self.pi = stats['start']/stats['n_seqs']
+		trans = stats['trans']
+		row_sums = trans.sum(axis=1)
+		used = row_sums > 0
+		self.A[used] = trans[used]/row_sums[used,None]
+		gamma = stats['gamma']
+		seen = gamma > 0
+		mu = stats['gamma_x'][seen]/gamma[seen]
+		var = stats['gamma_xx'][seen]/gamma[seen] - mu*mu
+		self.mu[seen] = mu
+		self.sigma[seen] = var.clip(MIN_VARIANCE)
+
+	def sampleSingle(self, length, seed=0):
+		"""
+		@param length: the number of observations
+		@param seed: the random seed
+		@return: a sequence sampled from the model, as a list of floats
+		"""
+		return self.sample(1, length, seed)[0]
+
+	def sample(self, n, length, seed=0):
+		"""
+		@param n: the number of sequences
+		@param length: the number of observations per sequence
+		@param seed: the random seed
+		@return: n sequences sampled from the model, as lists of floats
+		"""
+		rand = RandomState(seed)
+		cum_A = cumsum(self.A, axis=1)
+		states = searchsorted(cumsum(self.pi), rand.random_sample(n))
+		seqs = zeros((n, length), float64)
+		for t in xrange(0, length):
+			if t > 0:
+				u = rand.random_sample(n)
+				states = array([searchsorted(cum_A[s], x) for s, x in
+					zip(states, u)], int64)
+			states = states.clip(0, self.N - 1)
+			seqs[:,t] = rand.normal(self.mu[states],
+				self.sigma[states]**0.5)
+		return seqs.tolist()
+
+def _bench(name, func):
+	start = time()
+	result = func()
+	print "%-36s %8.3fs" % (name, time() - start)
+	return result
+
+if __name__ == "__main__":
+	from sample_gen import smyth_example
+	from sequence_utils import seqSetToList, toSequenceSet
+	from matrix_utils import uniformMatrix
+	import hmm_utils
+	n_seqs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+	length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+	seqs = seqSetToList(smyth_example(Ns=(n_seqs, n_seqs),
+		lengths=(length, length), seed=9))
+	print "%i sequences of length %i" % (len(seqs), length)
+	init = (uniformMatrix(2, 2, .5), [(0.0, 4.0), (8.0, 4.0)], [.5, .5])
+	model = GaussianHMM(init)
+	_bench("numpy Baum-Welch", lambda: model.baumWelch(seqs))
+	ll = _bench("numpy loglikelihood", lambda: model.loglikelihood(seqs))
+	print "numpy:", model.toTriple(), ll
+	if hmm_utils.ghmm is not None:
+		hmm = hmm_utils.ghmm.HMMFromMatrices(hmm_utils.ghmm.Float(),
+			hmm_utils.ghmm.GaussianDistribution(None), *init)
+		seq_set = toSequenceSet(seqs)
+		_bench("ghmm Baum-Welch", lambda: hmm.baumWelch(seq_set))
+		ghmm_ll = _bench("ghmm loglikelihood",
+			lambda: hmm.loglikelihood(seq_set))
+		print "ghmm: ", hmm_utils.hmmToTriple(hmm), ghmm_ll
+		ghmm_model = GaussianHMM(hmm_utils.hmmToTriple(hmm))
+		print "numpy loglikelihood of the ghmm model: %f" % (
+			ghmm_model.loglikelihood(seqs))
+	else:
+		print "ghmm isn't installed, skipping the comparison"
@@ -1,14 +1,12 @@
-from sklearn.cross_validation import train_test_split
-from build_models import preprocess, filter_processed
-from hmm_utils import tripleToHMM, compositeTriple
-from sequence_utils import toSequenceSet
+from prepcache import load_preprocessed
+from hmm_utils import tripleToHMM, compositeTriple, loglikelihood
 from multiprocessing import Pool
 import sys, cPickle, glob
 
 def getLikelihood(args):
 	k, target_m, triple, rand_seed, test = args
 	hmm = tripleToHMM(triple)
-	likelihood = hmm.loglikelihood(toSequenceSet(test))
+	likelihood = loglikelihood(hmm, test)
 	return (k, target_m, rand_seed, likelihood)
 
 if __name__ == "__main__":
@@ -23,52 +21,41 @@ if __name__ == "__main__":
 			results = cPickle.load(results_file)
 			agg_results.append(results)
 	print "done"
-	with open(records_path) as records_file:
-		records = cPickle.load(records_file)['records']
-		series = [(record['relays'], record['ident'][1]) for record in records]
-		processed = preprocess(series)
-		filtered = filter_processed(processed)
-		out_filt = []
+	prep = load_preprocessed(records_path)
+	# the outbound series, log transformed and filtered
+	out_filt = prep.out_series()
 
-		# grab just the outbound series
-		for i in filtered:
-			temp_series = []
-			for out in i[0]:
-				temp_series.append(out[1])
-			out_filt.append((temp_series, i[1]))
+	batch_items_test = []
+	batch_items_train = []
+	pool = Pool()
+	for result in agg_results:
+		rand_seed = result['rand_seed']
+		beta = result['beta']
+		target_m = result['target_m']
+		train_idx, test_idx = prep.split(beta, rand_seed)
+		train = [out_filt[i][0] for i in train_idx]
+		test = [out_filt[i][0] for i in test_idx]
+		for k, comp in result['components'].iteritems():
+			triple = compositeTriple(comp)
+			batch_items_test.append((k, target_m, triple,
+				rand_seed, list(train)))
 
-		batch_items_test = []
-		batch_items_train = []
-		pool = Pool()
-		for result in agg_results:
-			rand_seed = result['rand_seed']
-			beta = result['beta']
-			target_m = result['target_m']
-			train_array, test_array = train_test_split(out_filt,
-				train_size=beta, random_state=rand_seed)
-			train = [series[0] for series in train_array]
-			test = [series[0] for series in test_array]
-			for k, comp in result['components'].iteritems():
-				triple = compositeTriple(comp)
-				batch_items_test.append((k, target_m, triple,
-					rand_seed, list(train)))
-
-			for k, comp in result['components'].iteritems():
-				triple = compositeTriple(comp)
-				batch_items_train.append((k, target_m, triple, rand_seed, list(test)))
-		print "Computing train likelihoods (parallel)..."
-		likelihoodsTrain = pool.map(getLikelihood, batch_items_train)
-		print "Computing test likelihoods (parallel)..."
-		likelihoodsTest = pool.map(getLikelihood, batch_items_test)
-		print likelihoodsTrain
-		print likelihoodsTest
-		print "done"
-		outTrain = outpath + "train"
-		outTest = outpath + "test"
-		with open(outTrain, 'w') as out_file:
-			print "Dumping to %s" % outTrain
-			cPickle.dump(likelihoodsTrain, out_file)
-		with open(outTest, 'w') as out_file:
-			print "Dumping to %s" % outTest
-			cPickle.dump(likelihoodsTest, out_file)
+		for k, comp in result['components'].iteritems():
+			triple = compositeTriple(comp)
+			batch_items_train.append((k, target_m, triple, rand_seed, list(test)))
+	print "Computing train likelihoods (parallel)..."
+	likelihoodsTrain = pool.map(getLikelihood, batch_items_train)
+	print "Computing test likelihoods (parallel)..."
+	likelihoodsTest = pool.map(getLikelihood, batch_items_test)
+	print likelihoodsTrain
+	print likelihoodsTest
+	print "done"
+	outTrain = outpath + "train"
+	outTest = outpath + "test"
+	with open(outTrain, 'w') as out_file:
+		print "Dumping to %s" % outTrain
+		cPickle.dump(likelihoodsTrain, out_file)
+	with open(outTest, 'w') as out_file:
+		print "Dumping to %s" % outTest
+		cPickle.dump(likelihoodsTest, out_file)
 
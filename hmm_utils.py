@@ -1,12 +1,41 @@
 """
 Utility functions for creating composite HMMs and converting
 back and forth from ghmm instances.
+
+Models are ghmm HMMs, or gaussian_hmm.GaussianHMMs if HMM_BACKEND is
+"numpy". The backend can be chosen with the HMM_BACKEND environment
+variable, and is "numpy" if ghmm isn't installed. Code that should work
+with either goes through tripleToHMM, hmmToTriple, baumWelch,
+loglikelihood and loglikelihoods.
 @author Julian Applebaum
 """
 
 from matrix_utils import blockDiagMatrix, uniformMatrix
-from sequence_utils import flatten
-import ghmm
+from sequence_utils import flatten, toSequence, toSequenceSet
+from gaussian_hmm import GaussianHMM, SequenceBatches
+from numpy import array, float64
+from os import environ
+
+try:
+	import ghmm
+except ImportError:
+	ghmm = None
+
+HMM_BACKENDS = ["ghmm", "numpy"]
+HMM_BACKEND = environ.get("HMM_BACKEND", "numpy" if ghmm is None else "ghmm")
+
+def setBackend(backend):
+	"""
+	Choose the HMM implementation. Pools have to be created after this for
+	their worker processes to use it.
+	@param backend: "ghmm" or "numpy"
+	"""
+	global HMM_BACKEND
+	if backend not in HMM_BACKENDS:
+		raise ValueError("unknown HMM backend: %s" % backend)
+	if backend == "ghmm" and ghmm is None:
+		raise ImportError("the ghmm backend needs ghmm installed")
+	HMM_BACKEND = backend
 
 def compositeTriple(mixture):
 	"""
@@ -51,6 +80,8 @@ def hmmToTriple(hmm):
 	@param hmm: The HMM
 	@param return: The triple (A, B, pi)
 	"""
+	if isinstance(hmm, GaussianHMM):
+		return hmm.toTriple()
 	cmodel = hmm.cmodel
 	A, pi = getDynamics(hmm)
 	B = []
@@ -59,16 +90,73 @@ def hmmToTriple(hmm):
 		B.append((state.getMean(0), state.getStdDev(0)))
 	return (A, B, pi)
 
-def tripleToHMM(triple, distr=ghmm.GaussianDistribution(None)):
+def tripleToHMM(triple, distr=None):
 	"""
 	Get the ghmm.HMM corresponding to the triple (A, B, pi). If all of the
 	distributions in B have standard deviations of 0, we create a
 	@param triple: The triple
-	@return: The HMM
+	@return: The HMM, a GaussianHMM with the numpy backend
 	"""
+	if HMM_BACKEND == "numpy":
+		return GaussianHMM(triple)
+	if distr is None:
+		distr = ghmm.GaussianDistribution(None)
 	A, B, pi = triple
 	return ghmm.HMMFromMatrices(ghmm.Float(), distr, A, B, pi)
 
+def baumWelch(hmm, seqs, pool=None, n_shards=None):
+	"""
+	Train an HMM on a set of sequences, in place.
+	@param hmm: the HMM, as returned by tripleToHMM
+	@param seqs: a list of sequences in Python list form
+	@param pool: a multiprocessing.Pool to split the E-step of each step
+		across, by shard of sequences. Only GaussianHMMs can be trained
+		this way.
+	@param n_shards: how many shards, see GaussianHMM.baumWelch
+	"""
+	if isinstance(hmm, GaussianHMM):
+		hmm.baumWelch(seqs, pool=pool, n_shards=n_shards)
+	elif pool is not None:
+		raise ValueError("only GaussianHMMs can be trained on a pool")
+	else:
+		hmm.baumWelch(toSequenceSet(seqs))
+
+def loglikelihood(hmm, seqs):
+	"""
+	@param hmm: the HMM, as returned by tripleToHMM
+	@param seqs: a list of sequences in Python list form
+	@return: the sum of the log likelihoods of seqs under hmm
+	"""
+	if isinstance(hmm, GaussianHMM):
+		return hmm.loglikelihood(seqs)
+	if len(seqs) == 1:
+		return hmm.loglikelihood(toSequence(seqs[0]))
+	return hmm.loglikelihood(toSequenceSet(seqs))
+
+def sequenceBlock(seqs):
+	"""
+	Convert sequences once, to be scored under many models with
+	loglikelihoods.
+	@param seqs: a list of sequences in Python list form
+	@return: the sequences in the current backend's form
+	"""
+	if HMM_BACKEND == "numpy":
+		return SequenceBatches(seqs)
+	return toSequenceSet(seqs)
+
+def loglikelihoods(hmm, seqs):
+	"""
+	@param hmm: the HMM, as returned by tripleToHMM
+	@param seqs: a list of sequences in Python list form, or as returned by
+		sequenceBlock
+	@return: an array of the log likelihood of each sequence under hmm
+	"""
+	if isinstance(hmm, GaussianHMM):
+		return hmm.loglikelihoods(seqs)
+	if not isinstance(seqs, ghmm.SequenceSet):
+		seqs = toSequenceSet(seqs)
+	return array(hmm.loglikelihoods(seqs), float64)
+
 def discreteDefaultDMM(min_label, max_label):
 	sigma = ghmm.IntegerRange(min_label, max_label+1)
 	alpha_len = max_label - min_label + 1
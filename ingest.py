@@ -0,0 +1,938 @@
+"""
+Single pass ingest of a scallion.log file. Lines are filtered and
+pseudonymized as in logshadow.py, fed through the logparse.py
+CREATE/RELAY/DESTROY state machine, and the valid circuits are windowed and
+trimmed as in window.py and trim_series.py. Nothing is written to disk until
+the trimmed records are ready, and no tor formatted text is generated or
+parsed back along the way.
+
+	Syntax: python ingest.py infile window_size [grace]
+
+window_size is in milliseconds. Writes infile_trimmed_good.pickle,
+infile_trimmed_bad.pickle and infile_pseudo_ip.pickle (with the ".log"
+suffix of infile dropped), the same files post_processing.py used to get
+from running each stage separately. infile can be compressed (see
+logreader.py). If grace is given, each circuit is
+finalized and dropped from memory grace milliseconds after its first
+DESTROY (see EvictingParser), so memory use follows the number of open
+circuits rather than the length of the log.
+
+	Syntax: python ingest.py -stream infile window_size [grace] [-follow]
+
+Windows circuits as they come in instead (see stream), writing the windows
+and each circuit's validity to stdout as soon as they are known. grace
+defaults to STREAM_GRACE, and as with EvictingParser, RELAY cells arriving
+more than grace milliseconds after a circuit's DESTROY are missed by its
+validity check. With -follow, infile is followed like tail -f as it is
+written, until interrupted.
+"""
+
+from timecodec import shadow_millis, tor_time
+from logreader import scan_lines, open_log, is_compressed, log_name, \
+	follow_lines
+from logshadow import ip_replace
+from logparse import parse_line, is_valid_circ
+from window import window_record, OnlineWindows
+from circrecord import CircuitRecord, TimeSeries, WindowSeries, RunSeries
+from sequence_utils import trim_inactive_preprocess, SeriesBatch
+from build_models import filter_criteria_preprocess, log_series_preprocess
+from multiprocessing import Pool, cpu_count
+from os.path import getsize, exists
+from os import rename
+from heapq import heappush, heappop
+from collections import OrderedDict
+from hashlib import md5
+import sys, cPickle
+import logparse
+
+# every line ShadowFilter.filter_line counts or keeps contains one of these
+SHADOW_MARKERS = ["CLIENTLOGGING", "BUILT", "transfer-complete", "SENTCONNECT"]
+# how much of the start of a log a checkpoint fingerprints
+CHECKPOINT_HEAD = 4096
+# how many finalized circuits EvictingParser remembers, to count the RELAY
+# cells that arrive for them after their grace period
+RECENT_EVICTED = 4096
+# default grace period of StreamingWindower, in milliseconds
+STREAM_GRACE = 1000
+
+class ShadowFilter(object):
+	"""
+	The logshadow.py filter. Keeps the CLIENTLOGGING lines whose previous hop
+	is a client, pseudonymizes their ip addresses, and tallies the BUILT,
+	GET and SENTCONNECT counters along the way. Lines without any of the
+	SHADOW_MARKERS are never counted or kept, so they can be skipped before
+	they reach filter_line (see logreader.scan_lines).
+	"""
+	def __init__(self):
+		self.ip_dict = {}
+		self.ip_pseudo = 1
+		self.n_entries = 0
+		self.num_cl = 0
+		self.sc = 0
+		self.unique_sc = 0
+		self.trans_comp = 0
+		self.built = 0
+		self.sc_seen = set()
+
+	def filter_line(self, line):
+		"""
+		Filter and pseudonymize a single line of scallion.log.
+		@param line: the line
+		@return: the line split on whitespace with its ip addresses
+			pseudonymized, or None if the line was filtered out
+		"""
+		self.n_entries += 1
+		split = line.split()
+		if "BUILT" in line:
+			self.built += 1
+
+		if "GET" in line and "transfer-complete" in line:
+			self.trans_comp += 1
+
+		if "SENTCONNECT" in line and split[-1].split(":")[1] == "80":
+			self.sc += 1
+			if (split[12], split[4]) not in self.sc_seen:
+				self.sc_seen.add((split[12], split[4]))
+				self.unique_sc += 1
+
+		# previous relay is a client
+		if (split[6] == "CLIENTLOGGING:" and split[8].startswith("11.0.")):
+			self.num_cl += 1
+			split, self.ip_dict, self.ip_pseudo = ip_replace(split,
+				self.ip_dict, self.ip_pseudo)
+			return split
+		return None
+
+	def pseudo_ip_map(self):
+		"""
+		@return: a dict of the form {pseudo_ip_address: real_ip_address}
+		"""
+		return {v:k for k, v in self.ip_dict.items()}
+
+	def print_counts(self):
+		print "\ntotal SENTCONNECT: " + str(self.sc)
+		print "unique SENTCONNECT: " + str(self.unique_sc)
+		print "total GET: " + str(self.trans_comp)
+		print "total BUILT: " + str(self.built)
+		print "Filtered cell count: " + str(self.num_cl)
+
+def tor_line(split):
+	"""
+	Format a filtered scallion.log line as regular Tor output.
+	@param split: a line returned by ShadowFilter.filter_line
+	@return: the tor formatted line
+	"""
+	ip = split[4]
+	# get virtual time
+	date_fmt = tor_time(shadow_millis(split[2]))
+	loglevel = "[notice]"
+	return date_fmt + " " + loglevel + " " + ip + " " + " ".join(split[6:]) + "\n"
+
+def shadow_event(split):
+	"""
+	Get the event logparse.py would read back from the tor formatted version
+	of a filtered scallion.log line, without formatting it.
+	@param split: a line returned by ShadowFilter.filter_line
+	@return: a tuple (command, ident, time, direc), where time is the number
+		of milliseconds since January 1, 2013 at millisecond resolution
+	"""
+	time = float(shadow_millis(split[2]))
+	ident = ((split[4], int(split[-1], 16)), int(split[8], 16))
+	return (split[7], ident, time, split[9])
+
+class CircuitParser(object):
+	"""
+	The logparse.py state machine. Builds a dict of circuit records keyed by
+	ident from a stream of CREATE, RELAY and DESTROY events. The records are
+	compact CircuitRecords (see circrecord.py).
+	"""
+	def __init__(self):
+		self.records = {}
+		self.n_create = 0
+		self.n_destroy = 0
+		self.n_relay = 0
+
+	def feed(self, command, ident, time, direc):
+		"""
+		Apply a single event to the circuit records.
+		@param command: "CREATE", "DESTROY" or "RELAY"
+		@param ident: the circuit identifier ((relay_ip, circid), ipslug)
+		@param time: the timestamp of the cell
+		@param direc: "<-" for incoming or "->" for outgoing RELAY cells
+		"""
+		if command == "CREATE":
+			self.n_create += 1
+			# In the case of multiple CREATE cells, we define the
+			# beginning of the circuit as the time at which the last
+			# CREATE was sent.
+			self.records[ident] = CircuitRecord(ident, time,
+				relays_in=TimeSeries(), relays_out=TimeSeries())
+
+		elif command == "DESTROY":
+			self.n_destroy += 1
+			record = self.records.get(ident)
+			if record is None:
+				record = self.orphan(ident)
+			if record is not None:
+				# In the case of multiple DESTROY cells, we define the
+				# end of the circuit as the time at which the first
+				# DESTROY was sent.
+				if record['destroy'] is None:
+					record['destroy'] = time
+
+		elif command == "RELAY":
+			self.n_relay += 1
+			record = self.records.get(ident)
+			if record is None:
+				record = self.orphan(ident)
+			if record is not None:
+				if direc == "<-":
+					record['relays_in'].append(time)
+				elif direc == "->":
+					record['relays_out'].append(time)
+
+	def orphan(self, ident):
+		"""
+		Called for DESTROY and RELAY cells of a circuit with no CREATE seen
+		so far. These cells are dropped.
+		@param ident: the circuit identifier
+		@return: the record to apply the cell to, or None to drop it
+		"""
+		return None
+
+	def feed_tor_line(self, line):
+		"""
+		Apply a line of tor formatted output (see logshadow.py) to the
+		circuit records.
+		@param line: the line
+		"""
+		split = line.split(" ")
+		command = split[6]
+		if command in ("CREATE", "DESTROY", "RELAY"):
+			ident, time = parse_line(line)
+			self.feed(command, ident, time, split[8])
+
+	def compact(self):
+		"""
+		Pack the cells of every record, once no more are coming (see
+		CircuitRecord.compact).
+		"""
+		for record in self.records.itervalues():
+			record.compact()
+
+	def print_counts(self):
+		print "CREATE cells: " + str(self.n_create)
+		print "DESTROY cells: " + str(self.n_destroy)
+		print "RELAY cells: " + str(self.n_relay)
+
+class RangeParser(CircuitParser):
+	"""
+	A CircuitParser for one byte range of a log file. A circuit's CREATE may
+	lie in an earlier range, so instead of dropping DESTROY and RELAY cells
+	that arrive before any CREATE, they are kept in self.orphans so that
+	merge_partials can apply them to the state left by the earlier ranges.
+	"""
+	def __init__(self):
+		CircuitParser.__init__(self)
+		self.orphans = {}
+
+	def orphan(self, ident):
+		orphan = self.orphans.get(ident)
+		if orphan is None:
+			orphan = CircuitRecord(ident, None, relays_in=TimeSeries(),
+				relays_out=TimeSeries())
+			self.orphans[ident] = orphan
+		return orphan
+
+class EvictingParser(CircuitParser):
+	"""
+	A CircuitParser that keeps only open circuits in memory. A circuit is
+	finalized grace milliseconds (of log time) after its first DESTROY: it
+	is checked with is_valid_circ, passed to a sink if valid, and evicted
+	from self.records. Memory then depends on the number of circuits open
+	at once rather than on the number of circuits in the whole log.
+
+	Unlike CircuitParser, cells for a circuit that arrive after it was
+	evicted are dropped, and a CREATE reusing its ident starts a new
+	circuit instead of replacing the evicted one. This limits how faithful
+	the validity check is: is_valid_circ rejects circuits with RELAY cells
+	after their DESTROY, but only sees those that arrive within the grace
+	period. A circuit is finalized just before the first cell later than
+	its DESTROY plus grace, so cells up to and including that millisecond
+	still count (with a grace of 0, those in the same millisecond as the
+	DESTROY). RELAY cells for one of the last RECENT_EVICTED finalized
+	circuits are counted in n_late, and the valid circuits they arrive for
+	in n_late_valid: those were passed to the sink although a longer grace
+	would have rejected them.
+	"""
+	def __init__(self, grace, sink, valid=is_valid_circ):
+		"""
+		@param grace: How long, in milliseconds, to wait after a circuit's
+			first DESTROY before finalizing it. If None, circuits are only
+			finalized by finish().
+		@param sink: a function called with each valid circuit record
+		@param valid: the validity check for finalized circuits
+		"""
+		CircuitParser.__init__(self)
+		self.grace = grace
+		self.sink = sink
+		self.valid = valid
+		# heap of (deadline, seq, ident, record) for destroyed circuits
+		self.pending = []
+		self.seq = 0
+		self.n_circuits = 0
+		self.n_valid = 0
+		self.max_open = 0
+		# ident: True if valid, of the last RECENT_EVICTED finalized circuits
+		self.recent = OrderedDict()
+		self.n_late = 0
+		self.n_late_valid = 0
+
+	def feed(self, command, ident, time, direc):
+		# first finalize the circuits this cell is too late for
+		self.evict(time)
+		record = self.records.get(ident)
+		destroyed = record is not None and record['destroy'] is not None
+		CircuitParser.feed(self, command, ident, time, direc)
+		if command == "CREATE":
+			self.recent.pop(ident, None)
+			self.max_open = max(self.max_open, len(self.records))
+		elif command == "RELAY" and record is None and ident in self.recent:
+			self.n_late += 1
+			if self.recent[ident]:
+				# count each circuit once
+				self.recent[ident] = False
+				self.n_late_valid += 1
+		elif (command == "DESTROY" and record is not None and not destroyed and
+				self.grace is not None):
+			heappush(self.pending, (time + self.grace, self.seq, ident, record))
+			self.seq += 1
+
+	def evict(self, now):
+		"""
+		Finalize every circuit whose grace period has ended before now.
+		@param now: the current log time
+		"""
+		pending = self.pending
+		while pending and pending[0][0] < now:
+			_, _, ident, record = heappop(pending)
+			# skip circuits that were replaced by a later CREATE
+			if self.records.get(ident) is record:
+				del self.records[ident]
+				self.recent[ident] = self.finalize(record)
+				if len(self.recent) > RECENT_EVICTED:
+					self.recent.popitem(last=False)
+
+	def finalize(self, record):
+		"""
+		Check a circuit and pass it to the sink if it's valid.
+		@param record: the circuit's record
+		@return: True if it was valid
+		"""
+		record.compact()
+		self.n_circuits += 1
+		if self.valid(record):
+			self.n_valid += 1
+			self.sink(record)
+			return True
+		return False
+
+	def finish(self):
+		"""
+		Finalize all remaining circuits, at the end of the log.
+		"""
+		for record in self.records.itervalues():
+			self.finalize(record)
+		self.records = {}
+		self.pending = []
+
+	def get_state(self):
+		"""
+		@return: the open circuits, pending evictions and counters, as a
+			picklable dict for set_state
+		"""
+		state = dict(self.__dict__)
+		del state['sink'], state['valid']
+		return state
+
+	def set_state(self, state):
+		"""
+		Pick up where the parser get_state was called on left off.
+		@param state: a dict returned by get_state
+		"""
+		self.__dict__.update(state)
+
+class CellEnds(object):
+	"""
+	What is_valid_circ looks at of one direction's RELAY cells: how many
+	there are and the first and last timestamps. Stands in for the list of
+	timestamps, so circuits can be checked without keeping it.
+	"""
+	__slots__ = ['n', 'first', 'last']
+
+	def __init__(self):
+		self.n = 0
+		self.first = None
+		self.last = None
+
+	def add(self, time):
+		if self.n == 0:
+			self.first = time
+		self.last = time
+		self.n += 1
+
+	def __len__(self):
+		return self.n
+
+	def __getitem__(self, i):
+		if self.n == 0 or i not in (0, -1):
+			raise IndexError("only the first and last cells are kept")
+		return self.first if i == 0 else self.last
+
+class StreamingWindower(CircuitParser):
+	"""
+	A CircuitParser for live logs that windows circuits while they are still
+	open, instead of keeping their timestamps until the end. Each circuit
+	only holds an OnlineWindows, and every window is passed to a callback as
+	soon as it is complete. A circuit is closed grace milliseconds (of log
+	time) after its first DESTROY, when its last windows are passed on.
+
+	The windows of a circuit are the ones window_allrelays gives its CREATE,
+	first DESTROY and the RELAY cells seen up to its close, the same cells
+	an EvictingParser with the same grace would keep: a circuit is closed
+	just before the first cell later than its DESTROY plus grace. As there,
+	cells that arrive after the close are dropped, and counted in n_late
+	(and the circuits closed as valid they arrive for in n_late_valid) if
+	they're for one of the last RECENT_EVICTED closed circuits. A CREATE
+	reusing the ident of an open circuit starts over, so its windows come
+	with the new CREATE time.
+
+	Whether a circuit is valid is only known at its close, after most of its
+	windows have been passed on, so every circuit whose windows were
+	started ends with a call to a close callback saying whether they should
+	be kept. It is valid if is_valid_circ would pass the EvictingParser
+	record (it is called on a stand in with the same counts, first and last
+	cells, so logparse's counters add up the same way), so the valid
+	circuits are the ones an EvictingParser with the same grace would pass
+	to its sink. Like those, they can include circuits with RELAY cells
+	more than grace milliseconds after their DESTROY, which logparse.py
+	would reject when parsing the whole log; n_late_valid counts the ones
+	seen. Circuits replaced by a later CREATE, left without a DESTROY by
+	finish(), or with cells in windows past the end that window_allrelays
+	fails on (counted in n_overrun) are closed as not valid.
+
+	Memory is one OnlineWindows and two CellEnds per open circuit. An
+	OnlineWindows holds one window for each window its busier direction's
+	walk is ahead of the other's, so a circuit with traffic in only one
+	direction holds up to one window per cell of that direction until the
+	other direction catches up or the circuit closes.
+	"""
+	def __init__(self, window_size, emit, grace=STREAM_GRACE, on_close=None,
+			valid=is_valid_circ):
+		"""
+		@param window_size: the length, in milliseconds, of each window
+		@param emit: a function called as emit(ident, create, index, window)
+			for each window, in order, where create is the circuit's CREATE
+			timestamp, index the window's position and window its (in, out)
+			cell counts
+		@param grace: how long, in milliseconds, to keep counting cells
+			after a circuit's first DESTROY
+		@param on_close: a function called as on_close(ident, create, valid)
+			once a circuit is closed, after its last window, where valid is
+			True if the circuit's windows should be kept
+		@param valid: the validity check, called on a record of each closed
+			circuit whose relays_in and relays_out are CellEnds
+		"""
+		CircuitParser.__init__(self)
+		self.window_size = window_size
+		self.emit = emit
+		self.grace = grace
+		self.on_close = on_close
+		self.valid = valid
+		# ident: [OnlineWindows, destroy timestamp or None, [CellEnds in,
+		# CellEnds out]]
+		self.records = {}
+		# heap of (deadline, seq, ident, record) for destroyed circuits
+		self.pending = []
+		self.seq = 0
+		self.n_overrun = 0
+		self.n_circuits = 0
+		self.n_valid = 0
+		# ident: True if valid, of the last RECENT_EVICTED closed circuits
+		self.recent = OrderedDict()
+		self.n_late = 0
+		self.n_late_valid = 0
+
+	def feed(self, command, ident, time, direc):
+		# first close the circuits this cell is too late for
+		self.evict(time)
+		record = self.records.get(ident)
+		if command == "CREATE":
+			self.n_create += 1
+			self.recent.pop(ident, None)
+			if record is not None:
+				self._closed(ident, record, False)
+			self.records[ident] = [OnlineWindows(time, self.window_size), None,
+				[CellEnds(), CellEnds()]]
+		elif command == "DESTROY":
+			self.n_destroy += 1
+			if record is not None and record[1] is None:
+				record[1] = time
+				heappush(self.pending, (time + self.grace, self.seq, ident,
+					record))
+				self.seq += 1
+		elif command == "RELAY":
+			self.n_relay += 1
+			if record is None and ident in self.recent:
+				self.n_late += 1
+				if self.recent[ident]:
+					# count each circuit once
+					self.recent[ident] = False
+					self.n_late_valid += 1
+			elif record is not None and direc in ("<-", "->"):
+				windows = record[0]
+				direction = 0 if direc == "<-" else 1
+				record[2][direction].add(time)
+				start = windows.base
+				done = windows.add(time, direction)
+				for i, window in enumerate(done):
+					self.emit(ident, windows.create, start + i, window)
+
+	def evict(self, now):
+		"""
+		Close every circuit whose grace period has ended before now.
+		@param now: the current log time
+		"""
+		pending = self.pending
+		while pending and pending[0][0] < now:
+			_, _, ident, record = heappop(pending)
+			# skip circuits that were replaced by a later CREATE
+			if self.records.get(ident) is record:
+				del self.records[ident]
+				self.recent[ident] = self.close(ident, record)
+				if len(self.recent) > RECENT_EVICTED:
+					self.recent.popitem(last=False)
+
+	def _check(self, record):
+		# is_valid_circ on what's kept of the circuit
+		windows, destroy, ends = record
+		self.n_circuits += 1
+		valid = self.valid({
+			'create': windows.create,
+			'destroy': destroy,
+			'relays_in': ends[0],
+			'relays_out': ends[1]
+		})
+		if valid:
+			self.n_valid += 1
+		return valid
+
+	def _closed(self, ident, record, valid):
+		if self.on_close is not None:
+			self.on_close(ident, record[0].create, valid)
+
+	def close(self, ident, record):
+		"""
+		Pass on a circuit's last windows and report its close.
+		@param ident: the circuit's ident
+		@param record: its entry in self.records
+		@return: True if it was closed as valid
+		"""
+		windows, destroy = record[0:2]
+		valid = self._check(record)
+		start = windows.base
+		try:
+			rest = windows.close(destroy)
+		except IndexError:
+			self.n_overrun += 1
+			self._closed(ident, record, False)
+			return False
+		for i, window in enumerate(rest):
+			self.emit(ident, windows.create, start + i, window)
+		self._closed(ident, record, valid)
+		return valid
+
+	def finish(self):
+		"""
+		Close all circuits, at the end of the log. Those without a DESTROY
+		are closed as not valid, without their last windows.
+		"""
+		for _, _, ident, record in sorted(self.pending):
+			if self.records.get(ident) is record:
+				del self.records[ident]
+				self.close(ident, record)
+		self.pending = []
+		for ident, record in self.records.iteritems():
+			self._check(record)
+			self._closed(ident, record, False)
+		self.records = {}
+
+def byte_ranges(path, n_ranges):
+	"""
+	Split a file into byte ranges that start and end on line boundaries.
+	@param path: the path to the file
+	@param n_ranges: the number of ranges to aim for. Fewer are returned if
+		the file has fewer lines.
+	@return: a list of (start, stop) byte offsets covering the whole file
+	"""
+	size = getsize(path)
+	bounds = [0]
+	with open(path, 'rb') as f:
+		for i in xrange(1, n_ranges):
+			offset = max(size*i/n_ranges, bounds[-1])
+			if offset == 0 or offset >= size:
+				continue
+			# move forward to the first line starting at or after offset
+			f.seek(offset - 1)
+			f.readline()
+			if f.tell() > bounds[-1] and f.tell() < size:
+				bounds.append(f.tell())
+	bounds.append(size)
+	return zip(bounds[:-1], bounds[1:])
+
+def parse_range(args):
+	"""
+	Parse one byte range of a tor formatted log file.
+	@param args: a tuple (path, start, stop), where start and stop are byte
+		offsets returned by byte_ranges
+	@return: a tuple (records, orphans, counts), where counts is
+		(n_create, n_destroy, n_relay). See RangeParser.
+	"""
+	path, start, stop = args
+	parser = RangeParser()
+	with open(path, 'rb') as f:
+		f.seek(start)
+		pos = start
+		for line in iter(f.readline, ''):
+			parser.feed_tor_line(line)
+			pos += len(line)
+			if pos >= stop:
+				break
+	counts = (parser.n_create, parser.n_destroy, parser.n_relay)
+	return (parser.records, parser.orphans, counts)
+
+def merge_partials(partials):
+	"""
+	Merge the results of parse_range into the state that a single
+	CircuitParser would have reached reading the ranges in order: the last
+	CREATE wins, the first DESTROY after it wins, and RELAY cells are
+	appended in log order.
+	@param partials: parse_range results, in the order of their ranges
+	@return: a CircuitParser holding the merged records and cell counts
+	"""
+	merged = CircuitParser()
+	records = merged.records
+	for part_records, orphans, counts in partials:
+		# cells before the first CREATE of this range continue the circuit
+		# from the earlier ranges, if there is one
+		for ident, orphan in orphans.iteritems():
+			record = records.get(ident)
+			if record is None:
+				continue
+			if record['destroy'] is None:
+				record['destroy'] = orphan['destroy']
+			record['relays_in'] += orphan['relays_in']
+			record['relays_out'] += orphan['relays_out']
+		# a CREATE in this range discards everything before it
+		records.update(part_records)
+		merged.n_create += counts[0]
+		merged.n_destroy += counts[1]
+		merged.n_relay += counts[2]
+	return merged
+
+def parse_parallel(path, n_jobs=None):
+	"""
+	Parse a tor formatted log file (see logshadow.py) by splitting it into
+	byte ranges and parsing each range in a separate process.
+	@param path: the path to the log file
+	@param n_jobs: How many processes to spawn. If None, cpu_count()
+		processes are created. If -1, the file is parsed in this process.
+		Compressed files can't be split, so they are always parsed in this
+		process while a background thread decompresses them.
+	@return: a CircuitParser holding the records and cell counts
+	"""
+	if is_compressed(path):
+		parser = CircuitParser()
+		with open_log(path) as logfile:
+			for line in logfile:
+				parser.feed_tor_line(line)
+	elif n_jobs == -1:
+		parser = merge_partials([parse_range((path, 0, getsize(path)))])
+	else:
+		pool = Pool(n_jobs)
+		# a few ranges per process evens out the load between them
+		n_ranges = 4*(n_jobs or cpu_count())
+		batch_items = [(path, start, stop) for start, stop in
+			byte_ranges(path, n_ranges)]
+		partials = pool.map(parse_range, batch_items, chunksize=1)
+		pool.close()
+		parser = merge_partials(partials)
+	parser.compact()
+	return parser
+
+def _log_head(path, length):
+	# fingerprint of the start of a log, to recognize it when resuming
+	with open(path, 'rb') as f:
+		return md5(f.read(length)).hexdigest()
+
+def load_checkpoint(checkpoint_path, path):
+	"""
+	Load the checkpoint of an incremental parse of a tor formatted log file.
+	@param checkpoint_path: the checkpoint file
+	@param path: the log file being parsed
+	@return: a tuple (offset, state, counts), where offset is the byte
+		offset to resume parsing at, state is the EvictingParser state to
+		resume with and counts the counters saved with it, or (0, None, {})
+		if there's no checkpoint yet
+	"""
+	if is_compressed(path):
+		raise ValueError("can't parse compressed log %s incrementally" % path)
+	if not exists(checkpoint_path):
+		return (0, None, {})
+	with open(checkpoint_path, 'rb') as f:
+		checkpoint = cPickle.load(f)
+	offset = checkpoint['offset']
+	if (getsize(path) < offset or
+			_log_head(path, checkpoint['head_length']) != checkpoint['head']):
+		raise ValueError("%s doesn't continue the log checkpointed in %s" %
+			(path, checkpoint_path))
+	return (offset, checkpoint['state'], checkpoint.get('counts', {}))
+
+def save_checkpoint(checkpoint_path, path, offset, parser, counts=None):
+	"""
+	Save the state of an incremental parse. The checkpoint is written to a
+	temporary file first and renamed, so it is replaced all at once.
+	@param checkpoint_path: the checkpoint file
+	@param path: the log file being parsed
+	@param offset: the byte offset parsing stopped at
+	@param parser: the EvictingParser holding the open circuits
+	@param counts: a dict of counters to save along with the parser, like
+		logparse.invalid_counts()
+	"""
+	head_length = min(offset, CHECKPOINT_HEAD)
+	checkpoint = {
+		'offset': offset,
+		'head_length': head_length,
+		'head': _log_head(path, head_length),
+		'state': parser.get_state(),
+		'counts': counts or {}
+	}
+	tmp_path = checkpoint_path + ".tmp"
+	with open(tmp_path, 'wb') as f:
+		cPickle.dump(checkpoint, f, protocol=2)
+	rename(tmp_path, checkpoint_path)
+
+def parse_appended(parser, path, offset):
+	"""
+	Parse the lines of a tor formatted log file after a byte offset. A last
+	line without a newline is assumed to still be being written and is left
+	for the next run.
+	@param parser: the CircuitParser to feed the lines to
+	@param path: the log file
+	@param offset: the byte offset to start at, on a line boundary
+	@return: the byte offset parsing stopped at
+	"""
+	with open(path, 'rb') as f:
+		f.seek(offset)
+		n_entries = 0
+		for line in f:
+			if not line.endswith("\n"):
+				break
+			n_entries += 1
+			if n_entries % 50000 == 0:
+				print "%i entries processed" % n_entries
+			parser.feed_tor_line(line)
+			offset += len(line)
+	return offset
+
+def trim_record(record):
+	"""
+	Trim the leading and trailing inactive windows from a windowed record.
+	@param record: the windowed record
+	@return: (trimmed, good), where trimmed is the trimmed record and good is
+		True if it passes filter_criteria_preprocess
+	"""
+	trimmed = trim_inactive_preprocess(record['relays'])
+	if not isinstance(trimmed, (WindowSeries, RunSeries)):
+		trimmed = WindowSeries(trimmed)
+	new_rec = CircuitRecord(record['ident'], record['create'],
+		record['destroy'], relays=trimmed)
+	return (new_rec, filter_criteria_preprocess(log_series_preprocess(trimmed)))
+
+def trim_records(records):
+	"""
+	Trim a list of windowed records and split them into good and rejected
+	records as trim_series.py does, all at once with a SeriesBatch. Records
+	that are empty after trimming are dropped.
+	@param records: the windowed records
+	@return: a pair of lists (good_records, rej_records)
+	"""
+	batch = SeriesBatch([record['relays'] for record in records])
+	batch.trim_inactive()
+	batch.log_transform()
+	good = batch.good()
+	good_records = []
+	rej_records = []
+	for i, record in enumerate(records):
+		relays = record['relays'][batch.lead[i]:batch.trail[i]]
+		if not isinstance(relays, (WindowSeries, RunSeries)):
+			relays = WindowSeries(relays)
+		trimmed = CircuitRecord(record['ident'], record['create'],
+			record['destroy'], relays=relays)
+		if good[i]:
+			good_records.append(trimmed)
+		elif len(relays) > 0:
+			rej_records.append(trimmed)
+	return (good_records, rej_records)
+
+def ingest(lines, window_size, grace=None):
+	"""
+	Take scallion.log lines all the way to windowed, trimmed records.
+	@param lines: an iterable of scallion.log lines
+	@param window_size: the length, in milliseconds, of each window
+	@param grace: If not None, circuits are windowed and trimmed this many
+		milliseconds after their first DESTROY and evicted from memory (see
+		EvictingParser). If None, all circuits are kept until the end of
+		the log.
+	@return: a tuple (good_records, rej_records, pseudo_ip_map)
+	"""
+	good_records = []
+	rej_records = []
+	def sink(record):
+		trimmed, good = trim_record(window_record((record, window_size)))
+		if good:
+			good_records.append(trimmed)
+		elif len(trimmed['relays']) > 0:
+			rej_records.append(trimmed)
+
+	shadow = ShadowFilter()
+	parser = EvictingParser(grace, sink)
+	print "Parsing..."
+	for line in lines:
+		split = shadow.filter_line(line)
+		if shadow.n_entries % 50000 == 0:
+			print "%i entries processed" % shadow.n_entries
+		if split is not None:
+			parser.feed(*shadow_event(split))
+	shadow.print_counts()
+	parser.print_counts()
+
+	print "Removing invalid circuits..."
+	parser.finish()
+	n_circuits, n_valid = parser.n_circuits, parser.n_valid
+	print "%i circuits total" % n_circuits
+	if n_circuits > 0:
+		print "%i (%.2f%%) valid circuits" % (n_valid,
+			100.0*n_valid/n_circuits)
+	if grace is not None:
+		print "%i circuits open at once (max)" % parser.max_open
+		print "%i RELAY cells after the grace period (%i valid circuits)" % (
+			parser.n_late, parser.n_late_valid)
+	print "NO DESTROY: " + str(logparse.no_destroy)
+	print "FEW RELAYS: " + str(logparse.no_relays)
+	print "CREATE AFTER RELAY: " + str(logparse.create_after_relay)
+	print "RELAY AFTER DESTROY: " + str(logparse.relay_after_destroy)
+	print "%i good records" % len(good_records)
+	print "%i reject records" % len(rej_records)
+	print "%i len 0 after trimming" % (n_valid - len(good_records) -
+		len(rej_records))
+	return (good_records, rej_records, shadow.pseudo_ip_map())
+
+def stream(lines, window_size, grace=STREAM_GRACE, out=sys.stdout):
+	"""
+	Window the circuits of scallion.log lines as they come in (see
+	StreamingWindower), for logs that are still being written. Writes one
+	tab separated line per window and one per closed circuit to out:
+
+		W relay circid ipslug create index in out
+		C relay circid ipslug create valid
+
+	where relay, circid and ipslug make up the circuit's ident and valid is
+	1 if the circuit's windows should be kept and 0 if they should be
+	dropped. Every circuit's W lines come before its C line. Counts go to
+	stderr, so that out can be piped on.
+	@param lines: an iterable of scallion.log lines
+	@param window_size: the length, in milliseconds, of each window
+	@param grace: how long, in milliseconds, to keep counting cells after a
+		circuit's first DESTROY before closing it (see StreamingWindower)
+	@param out: the file to write to
+	"""
+	def ident_fields(ident):
+		(relay, circ_id), slug = ident
+		return "%s\t%d\t%d" % (relay, circ_id, slug)
+
+	def emit(ident, create, index, window):
+		out.write("W\t%s\t%r\t%d\t%d\t%d\n" % (ident_fields(ident), create,
+			index, window[0], window[1]))
+
+	def on_close(ident, create, valid):
+		out.write("C\t%s\t%r\t%d\n" % (ident_fields(ident), create,
+			int(valid)))
+		out.flush()
+
+	shadow = ShadowFilter()
+	windower = StreamingWindower(window_size, emit, grace, on_close)
+	try:
+		for line in lines:
+			split = shadow.filter_line(line)
+			if split is not None:
+				windower.feed(*shadow_event(split))
+	except KeyboardInterrupt:
+		pass
+	windower.finish()
+	out.flush()
+	sys.stderr.write("%i circuits closed, %i valid, %i overrun\n" % (
+		windower.n_circuits, windower.n_valid, windower.n_overrun))
+	sys.stderr.write("%i RELAY cells after the grace period (%i valid "
+		"circuits)\n" % (windower.n_late, windower.n_late_valid))
+
+def ingest_file(infile, name, window_size, grace=None):
+	"""
+	Ingest a scallion.log file and dump the good and rejected records and
+	the pseudonymized ip address map.
+	@param infile: a scallion.log file
+	@param name: prefix for the output files
+	@param window_size: the length, in milliseconds, of each window
+	@param grace: See ingest
+	"""
+	print "Reading file..."
+	good_records, rej_records, ip_map = ingest(
+		scan_lines(infile, SHADOW_MARKERS), window_size, grace)
+
+	goodpath = name + "_trimmed_good.pickle"
+	rejpath = name + "_trimmed_bad.pickle"
+	ippath = log_name(infile)[:-4] + "_pseudo_ip.pickle"
+	with open(goodpath, 'w') as good_file:
+		print "Dumping good records to %s" % goodpath
+		cPickle.dump({
+			'window_size': window_size,
+			'records': good_records
+		}, good_file)
+	with open(rejpath, 'w') as rej_file:
+		print "Dumping reject records to %s" % rejpath
+		cPickle.dump({
+			'window_size': window_size,
+			'records': rej_records
+		}, rej_file)
+	with open(ippath, 'w') as ip_file:
+		print "Dumping ip address dictionary to %s" % ippath
+		cPickle.dump(ip_map, ip_file, protocol=2)
+	print "Done\n"
+
+if __name__ == "__main__":
+	if sys.argv[1] == "-stream":
+		infile = sys.argv[2]
+		window_size = int(sys.argv[3])
+		follow = "-follow" in sys.argv
+		args = [arg for arg in sys.argv[4:] if arg != "-follow"]
+		grace = int(args[0]) if len(args) > 0 else STREAM_GRACE
+		if follow:
+			lines = follow_lines(infile)
+		else:
+			lines = scan_lines(infile, SHADOW_MARKERS)
+		stream(lines, window_size, grace)
+		sys.exit(0)
+	infile = sys.argv[1]
+	window_size = int(sys.argv[2])
+	grace = int(sys.argv[3]) if len(sys.argv) > 3 else None
+	ingest_file(infile, log_name(infile)[:-4], window_size, grace)
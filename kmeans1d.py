@@ -0,0 +1,121 @@
+"""
+Exact k-means for one dimensional data, by dynamic programming (as in Wang
+and Song's Ckmeans.1d.dp). An optimal partition of points on a line into k
+clusters is a partition of the sorted points into k contiguous runs, so the
+least squares partitions for every k follow from the table
+
+	D[k][i] = min over j < i of D[k-1][j] + cost(j, i)
+
+over the d sorted distinct values (weighted by their counts), where
+cost(j, i) is the sum of squared deviations of distinct values j..i-1 from
+their mean. The best split j only moves right as i grows, so each row is
+filled by divide and conquer over i in O(d log d), vectorized over all the
+subproblems at one depth. Rows are kept, so the partitions for every k up
+to the largest asked for come from one pass.
+"""
+
+from numpy import (asarray, unique, concatenate, cumsum, arange, repeat,
+	minimum, searchsorted, flatnonzero, array, where, errstate, full, zeros,
+	inf, int64, float64)
+
+class OptimalPartitions(object):
+	"""
+	The least squares partitions of a set of 1-D points into k clusters, for
+	every k.
+	"""
+	def __init__(self, values):
+		"""
+		@param values: the points, any array-like of floats
+		"""
+		values = asarray(values, float64).ravel()
+		self.values, counts = unique(values, return_counts=True)
+		self.d = len(self.values)
+		weights = counts.astype(float64)
+		# prefix sums of the weights and of the (centred, for precision)
+		# values and their squares, so cost(j, i) is O(1)
+		centred = self.values - (values.mean() if len(values) > 0 else 0)
+		self.W = concatenate([[0.0], cumsum(weights)])
+		self.S1 = concatenate([[0.0], cumsum(weights*centred)])
+		self.S2 = concatenate([[0.0], cumsum(weights*centred*centred)])
+		# rows[k-1][i]: least cost of the first i distinct values in k
+		# clusters; splits[k-1][i]: the first value of the last cluster
+		first = self._cost(zeros(self.d + 1, int64), arange(0, self.d + 1))
+		first[0] = inf
+		self.rows = [first]
+		self.splits = [zeros(self.d + 1, int64)]
+
+	def _cost(self, j, i):
+		# sum of squared deviations of distinct values j..i-1
+		w = self.W[i] - self.W[j]
+		s = self.S1[i] - self.S1[j]
+		with errstate(divide='ignore', invalid='ignore'):
+			cost = (self.S2[i] - self.S2[j]) - where(w > 0, s*s/w, 0.0)
+		return cost.clip(0)
+
+	def _addRow(self):
+		k = len(self.rows) + 1
+		prev = self.rows[-1]
+		row = full(self.d + 1, inf)
+		split = zeros(self.d + 1, int64)
+		# subproblems: fill row[lo..hi], knowing the split is in [olo, ohi]
+		lo, hi = array([k], int64), array([self.d], int64)
+		olo, ohi = array([k - 1], int64), array([self.d - 1], int64)
+		while len(lo) > 0:
+			mid = (lo + hi)/2
+			counts = minimum(ohi, mid - 1) - olo + 1
+			starts = cumsum(counts) - counts
+			seg = repeat(arange(len(mid)), counts)
+			j = olo[seg] + arange(counts.sum()) - starts[seg]
+			vals = prev[j] + self._cost(j, mid[seg])
+			best = minimum.reduceat(vals, starts)
+			# the first j reaching the minimum of each subproblem
+			hits = flatnonzero(vals == best[seg])
+			opt = j[hits[searchsorted(seg[hits], arange(len(mid)))]]
+			row[mid] = best
+			split[mid] = opt
+			left, right = lo < mid, mid < hi
+			lo, hi, olo, ohi = (
+				concatenate([lo[left], mid[right] + 1]),
+				concatenate([mid[left] - 1, hi[right]]),
+				concatenate([olo[left], opt[right]]),
+				concatenate([opt[left], ohi[right]]))
+		self.rows.append(row)
+		self.splits.append(split)
+
+	def starts(self, k):
+		"""
+		@param k: the number of clusters, at most the number of distinct
+			values
+		@return: the index into the sorted distinct values (self.values) of
+			the smallest value of each cluster of the optimal partition, in
+			increasing order
+		"""
+		if k < 1 or k > self.d:
+			raise ValueError("can't partition %i distinct values into %i "
+				"clusters" % (self.d, k))
+		while len(self.rows) < k:
+			self._addRow()
+		starts = [0]*k
+		i = self.d
+		for row in xrange(k - 1, 0, -1):
+			i = int(self.splits[row][i])
+			starts[row] = i
+		return starts
+
+	def cost(self, k):
+		"""
+		@return: the sum of squared deviations of the optimal partition into
+			k clusters
+		"""
+		self.starts(k)
+		return float(self.rows[k-1][self.d])
+
+	def labels(self, k, values):
+		"""
+		@param k: the number of clusters
+		@param values: points to label, from those the partitions are of
+		@return: an array of the cluster number of each point, clusters
+			numbered in increasing order of their values
+		"""
+		bounds = self.values[self.starts(k)]
+		return searchsorted(bounds, asarray(values, float64), side='right') - 1
@@ -0,0 +1,56 @@
+"""
+Compare clustering with the landmark approximation of the HMM distance
+(HMMCluster's 'landmark' dist_func) against the exact distance, on
+sample_gen.smyth_example data.
+
+	Syntax: python landmark_eval.py n_per_model [n_landmarks ...]
+
+Generates n_per_model sequences from each of smyth_example's two models,
+clusters them hierarchically into two clusters with the exact distance and
+with the landmark distance for each number of landmarks (default 5, 10 and
+20), and prints the time each distance matrix took and the adjusted Rand
+index of each clustering against the true models and against the exact
+clustering.
+"""
+
+from smyth import HMMCluster
+from sample_gen import smyth_example
+from sequence_utils import seqSetToList
+from sklearn.metrics import adjusted_rand_score
+import sys
+
+K = 2
+TARGET_M = 2
+
+def cluster(seqs, dist_func, n_landmarks=None, landmark_pick='kmeans++'):
+	"""
+	@return: (labels, distance matrix time) of seqs clustered into K
+		clusters
+	"""
+	clust = HMMCluster([(s, i) for i, s in enumerate(seqs)], TARGET_M, K, K,
+		{K: None}, dist_func, 'smyth', None, n_landmarks=n_landmarks,
+		landmark_pick=landmark_pick)
+	clust._hierarchical()
+	clust.pool.close()
+	return (clust.labelings[K], clust.times['distance_matrix'])
+
+if __name__ == "__main__":
+	n_per_model = int(sys.argv[1])
+	landmark_counts = map(int, sys.argv[2:]) or [5, 10, 20]
+	S = smyth_example(Ns=(n_per_model, n_per_model), lengths=(200, 200),
+		seed=9)
+	seqs = S if isinstance(S, list) else seqSetToList(S)
+	truth = [0]*n_per_model + [1]*n_per_model
+	exact, exact_time = cluster(seqs, 'hmm')
+	print "%-22s %10s %12s %12s" % ("distance", "time (s)", "ARI (truth)",
+		"ARI (exact)")
+	print "%-22s %10.2f %12.3f %12s" % ("exact", exact_time,
+		adjusted_rand_score(truth, exact), "-")
+	for n_landmarks in landmark_counts:
+		for pick in ('random', 'kmeans++'):
+			labels, landmark_time = cluster(seqs, 'landmark', n_landmarks,
+				pick)
+			print "%-22s %10.2f %12.3f %12.3f" % ("%i landmarks, %s" % (
+				n_landmarks, pick), landmark_time,
+				adjusted_rand_score(truth, labels),
+				adjusted_rand_score(exact, labels))
@@ -2,7 +2,33 @@
 Parse a hack_tor log file infile and output the resulting records as a
 pickled list.
 
-	Syntax: python2.7 logparse.py infile outfile
+	Syntax: python2.7 logparse.py infile outfile [n_jobs]
+			python2.7 logparse.py infile outfile -evict grace
+		python2.7 logparse.py infile outfile -incremental grace checkpoint
+
+The file is split into byte ranges that are parsed in n_jobs processes
+(cpu_count() by default, -1 to parse in a single process). If outfile ends
+in ".circs", the records are written as a columnar circuit store instead
+(see circstore.py). With -evict, the file is parsed in a single process and
+each circuit is finalized and dropped from memory grace milliseconds after
+its first DESTROY (see ingest.EvictingParser). Cells arriving after that are
+ignored, but memory use only grows with the number of open circuits, and
+stores are written as the circuits finish. grace limits how faithful the
+validity filter is: a circuit with RELAY cells more than grace milliseconds
+after its DESTROY is kept, where parsing the whole log would reject it. The
+number of such late cells, and of valid circuits they arrived for, is
+printed. A compressed infile (.gz, .bz2,
+.xz or .zst) is decompressed on the fly and always parsed in a single
+process.
+
+-incremental works like -evict, but saves the byte offset it stopped at, the
+circuits still open there (those without a DESTROY, or still in their grace
+period) and the counts of invalid circuits to the checkpoint file. Run again
+on the same, grown, log, it resumes from the checkpoint, parses only the
+appended lines and appends the newly finalized circuits to outfile, which
+has to be a ".circs" store: a pickle can only be rewritten whole, which
+would make every run as slow as parsing the log from the start. Circuits
+open at the end of the log are left in the checkpoint, not written out.
 
 The output file is a pickled list in the format:
 [ { 'ident': [circuit id, ip slug]
@@ -25,7 +51,7 @@ The output file is a pickled list in the format:
 
 from pprint import pprint
 
-from datetime import datetime
+from timecodec import tor_millis
 import sys, cPickle
 
 no_destroy = 0
@@ -34,6 +60,29 @@ create_after_relay = 0
 relay_after_destroy = 0
 
 
+def invalid_counts():
+	"""
+	@return: the counts of invalid circuits is_valid_circ has seen, by
+		reason, as a dict for set_invalid_counts
+	"""
+	return {
+		'no_destroy': no_destroy,
+		'no_relays': no_relays,
+		'create_after_relay': create_after_relay,
+		'relay_after_destroy': relay_after_destroy
+	}
+
+def set_invalid_counts(counts):
+	"""
+	Pick the counts of invalid circuits up where invalid_counts left them.
+	@param counts: a dict returned by invalid_counts
+	"""
+	global no_destroy, no_relays, create_after_relay, relay_after_destroy
+	no_destroy = counts.get('no_destroy', 0)
+	no_relays = counts.get('no_relays', 0)
+	create_after_relay = counts.get('create_after_relay', 0)
+	relay_after_destroy = counts.get('relay_after_destroy', 0)
+
 def parse_time(time_str):
 	"""
 	Parse a time string from the hack_tor logfile. Returns the number
@@ -43,11 +92,7 @@ def parse_time(time_str):
 	@param time_str: The time string from the logfile
 	@return: The number of milliseconds since January 1, 2013
 	"""
-	augmented = "2013 " + time_str
-	date_parsed = datetime.strptime(augmented[0:-4],'%Y %b %d %H:%M:%S')
-	n_seconds = 1.0*(date_parsed - datetime(2013, 1, 1)).total_seconds()
-	n_milliseconds = int(time_str[-3:])
-	return 1000*n_seconds + n_milliseconds
+	return float(tor_millis(time_str))
 
 def parse_line(line):
 	"""
@@ -102,74 +147,95 @@ def is_valid_circ(record):
 			record['relays_in'][-1] <= record['destroy'])
 
 if __name__ == "__main__":
+	from ingest import (parse_parallel, parse_appended, EvictingParser,
+		load_checkpoint, save_checkpoint)
+	from circstore import is_store, write_store, CircuitStoreWriter
+	from logreader import open_log
 	lfpath = sys.argv[1]     # the tor formatted log file -- tor_fmt_relayname.log
 	outpath = sys.argv[2]
-	with open(lfpath) as logfile:
+	mode = sys.argv[3] if len(sys.argv) > 3 else None
+	evict = mode in ("-evict", "-incremental")
+	if evict:
+		# stream finished circuits out as their grace period ends
+		grace = int(sys.argv[4])
+		offset, state = 0, None
+		if mode == "-incremental":
+			if not is_store(outpath):
+				raise ValueError("-incremental appends to a circuit store, "
+					"not a pickle: %s doesn't end in .circs" % outpath)
+			checkpoint = sys.argv[5]
+			offset, state, counts = load_checkpoint(checkpoint, lfpath)
+			if state is not None and state['grace'] != grace:
+				raise ValueError("%s was made with a grace period of %i" %
+					(checkpoint, state['grace']))
+			set_invalid_counts(counts)
+		# circuits already written out by earlier incremental runs
+		n_kept = None if state is None else state['n_valid']
+		if is_store(outpath):
+			writer = CircuitStoreWriter(outpath, n_kept)
+			sink = writer.add
+		else:
+			filtered = []
+			sink = filtered.append
+		parser = EvictingParser(grace, sink, is_valid_circ)
+		if state is not None:
+			print "Resuming at byte %i of %s..." % (offset, lfpath)
+			parser.set_state(state)
+		if mode == "-incremental":
+			print "Parsing..."
+			offset = parse_appended(parser, lfpath, offset)
+			print "%i circuits still open" % len(parser.records)
+		else:
+			with open_log(lfpath) as logfile:
+				print "Reading file..."
+				n_entries = 0
+				print "Parsing..."
+				for line in logfile:
+					n_entries += 1
+					if n_entries % 50000 == 0 and n_entries != 0:
+						print "%i entries processed" % n_entries
+					parser.feed_tor_line(line)
+		parser.print_counts()
+		print "Removing invalid circuits..."
+		if mode == "-evict":
+			parser.finish()
+		n_circuits, n_valid = parser.n_circuits, parser.n_valid
+		print "%i circuits open at once (max)" % parser.max_open
+		print "%i RELAY cells after the grace period (%i valid circuits)" % (
+			parser.n_late, parser.n_late_valid)
+	else:
+		# number of processes to parse with, -1 to parse in this process
+		n_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else None
 		print "Reading file..."
-		records = {}
-		n_entries = 0
-		c = 0
-		d = 0
-		r = 0
-		print "Parsing..."
-		for line in logfile:
-			n_entries += 1
-			if n_entries % 50000 == 0 and n_entries != 0:
-				print "%i entries processed" % n_entries
-			split = line.split(" ")
-			if split[6] == "CREATE":
-				c = c + 1
-				# In the case of multiple CREATE cells, we define the
-				# beginning of the circuit as the time at which the last
-				# CREATE was sent.
-				ident, time = parse_line(line)
-				records[ident] = {
-					'ident': ident,
-					'create': time,
-					'destroy': None,
-					'relays_in': [],
-					'relays_out': []
-				}
-
-			elif split[6] == "DESTROY":
-				d = d + 1
-				ident, time = parse_line(line)
-				record = records.get(ident)
-				if record is not None:
-					# In the case of multiple DESTROY cells, we define the
-					# end of the circuit as the time at which the first
-					# DESTROY was sent.
-					if record['destroy'] is None:
-						record['destroy'] = time
-			
-			elif split[6] == "RELAY":
-				r = r + 1
-				ident, time = parse_line(line)
-				record = records.get(ident)
-				direc = split[8]
-				if record is not None:
-					if direc == "<-":
-						record['relays_in'].append(time)
-					elif direc == "->":
-						record['relays_out'].append(time)
-
-		print "CREATE cells: " + str(c)
-		print "DESTROY cells: " + str(d)
-		print "RELAY cells: " + str(r)
+		print "Parsing (parallel)..."
+		parser = parse_parallel(lfpath, n_jobs)
+		parser.print_counts()
+		records = parser.records
+		print "Removing invalid circuits..."
+		filtered = filter(is_valid_circ, records.itervalues())
+		n_circuits, n_valid = len(records), len(filtered)
+	#print filtered
+	print "%i circuits total" % n_circuits
+	print "%i (%.2f%%) valid circuits" % (n_valid,
+		100.0*n_valid/max(n_circuits, 1))
+	print "Dumping valid circuits to %s" % outpath
+
+	if is_store(outpath):
+		if evict:
+			writer.close()
+		else:
+			write_store(outpath, filtered)
+	else:
 		with open(outpath, 'w') as outfile:
-			print "Removing invalid circuits..."
-			filtered = filter(is_valid_circ, records.itervalues())
-			#print filtered
-			print "%i circuits total" % len(records)
-			print "%i (%.2f%%) valid circuits" % (len(filtered),
-				100.0*len(filtered)/len(records))
-			print "Dumping valid circuits to %s" % outpath
-
 			cPickle.dump(filtered, outfile, protocol=2)
-			print "NO DESTROY: " + str(no_destroy)
-			print "FEW RELAYS: " + str(no_relays)
-			print "CREATE AFTER RELAY: " + str(create_after_relay)
-			print "RELAY AFTER DESTROY: " + str(relay_after_destroy)	
-			print "Done\n"
-
-
+	if mode == "-incremental":
+		# only once the output is complete, so that an interrupted run
+		# leaves the old checkpoint and output circuit count in place
+		save_checkpoint(checkpoint, lfpath, offset, parser,
+			invalid_counts())
+		print "Saved checkpoint to %s" % checkpoint
+	print "NO DESTROY: " + str(no_destroy)
+	print "FEW RELAYS: " + str(no_relays)
+	print "CREATE AFTER RELAY: " + str(create_after_relay)
+	print "RELAY AFTER DESTROY: " + str(relay_after_destroy)	
+	print "Done\n"
@@ -0,0 +1,285 @@
+"""
+Reading large, possibly compressed, log files.
+
+Logs ending in .gz, .bz2, .xz or .zst are decompressed on the fly: a
+background thread pulls decompressed data out of the file (or out of an xz
+or zstd process, when the lzma or zstandard module isn't installed) and
+hands it over in newline-aligned blocks through a bounded queue, so
+decompression overlaps with parsing and only a few blocks are ever held in
+memory. Everything else is read as plain text.
+
+Lines can also be selected by marker: rather than splitting every line of a
+log in Python, the log is cut into large blocks, each block is searched with
+str.find for the markers a stage cares about, and only the lines containing
+a marker are sliced out and handed back. Plain logs are memory mapped for
+this, so lines without a marker are never touched by Python code.
+
+A log that is still being written can be followed, like tail -f, with
+follow_lines.
+"""
+
+from threading import Thread
+from Queue import Queue, Full
+from subprocess import Popen, PIPE
+from os.path import getsize
+from time import sleep
+import mmap, gzip, bz2
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# approximate size of the blocks a log is read and searched in, in bytes
+SCAN_BLOCK = 1 << 20
+# how many decompressed blocks can be waiting for the parser at once
+QUEUE_BLOCKS = 8
+# how long, in seconds, follow_lines waits for a log to grow
+FOLLOW_POLL = 1.0
+# command lines used to decompress when the python module is missing
+DECOMPRESS_COMMANDS = {
+	".xz": ["xz", "-dc"],
+	".zst": ["zstd", "-dc"]
+}
+COMPRESSED_SUFFIXES = [".gz", ".bz2", ".xz", ".zst"]
+
+def compression_suffix(path):
+	"""
+	@param path: the path to a log file
+	@return: the compression suffix of path (".gz", ...), or None if the log
+		isn't compressed
+	"""
+	for suffix in COMPRESSED_SUFFIXES:
+		if path.endswith(suffix):
+			return suffix
+	return None
+
+def is_compressed(path):
+	"""
+	@param path: the path to a log file
+	@return: True if the log will be decompressed when read
+	"""
+	return compression_suffix(path) is not None
+
+def log_name(path):
+	"""
+	@param path: the path to a log file
+	@return: path without its compression suffix, e.g. "scallion.log" for
+		"scallion.log.xz"
+	"""
+	suffix = compression_suffix(path)
+	return path if suffix is None else path[:-len(suffix)]
+
+def _decompressed_stream(path):
+	"""
+	@return: a tuple (stream, process), where stream is a file-like object
+		with a read method giving the decompressed contents of path, and
+		process is the decompressing Popen object, or None if it's done in
+		this process
+	"""
+	suffix = compression_suffix(path)
+	if suffix == ".gz":
+		return (gzip.GzipFile(path, 'rb'), None)
+	if suffix == ".bz2":
+		return (bz2.BZ2File(path, 'rb'), None)
+	if suffix == ".xz" and lzma is not None:
+		return (lzma.LZMAFile(path, 'rb'), None)
+	if suffix == ".zst" and zstandard is not None:
+		raw = open(path, 'rb')
+		return (zstandard.ZstdDecompressor().stream_reader(raw), None)
+	process = Popen(DECOMPRESS_COMMANDS[suffix] + [path], stdout=PIPE,
+		bufsize=-1)
+	return (process.stdout, process)
+
+class CompressedLog(object):
+	"""
+	Iterates over the lines (or newline-aligned blocks) of a compressed log,
+	decompressing it in a background thread.
+	"""
+	def __init__(self, path, block_size=SCAN_BLOCK, max_blocks=QUEUE_BLOCKS):
+		"""
+		@param path: the path to the compressed log
+		@param block_size: how many bytes to decompress at a time
+		@param max_blocks: how many decompressed blocks can be queued up
+			before the thread waits for them to be consumed
+		"""
+		self.path = path
+		self.block_size = block_size
+		self.queue = Queue(max_blocks)
+		self.stopped = False
+		self.stream, self.process = _decompressed_stream(path)
+		self.thread = Thread(target=self._decompress)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _put(self, item):
+		# give up on the put if the reader has been closed in the meantime
+		while not self.stopped:
+			try:
+				self.queue.put(item, timeout=0.1)
+				return True
+			except Full:
+				pass
+		return False
+
+	def _decompress(self):
+		try:
+			rest = ""
+			while not self.stopped:
+				data = self.stream.read(self.block_size)
+				if not data:
+					break
+				data = rest + data
+				end = data.rfind("\n") + 1
+				rest = data[end:]
+				if end > 0 and not self._put(data[:end]):
+					return
+			if rest:
+				self._put(rest)
+			if self.process is not None and self.process.wait() != 0:
+				raise IOError("%s exited with status %i while reading %s" %
+					(DECOMPRESS_COMMANDS[compression_suffix(self.path)][0],
+					self.process.returncode, self.path))
+			self._put(None)
+		except Exception, e:
+			self._put(e)
+
+	def blocks(self):
+		"""
+		@return: a generator of decompressed blocks of the log, each ending
+			at the end of a line
+		"""
+		while True:
+			block = self.queue.get()
+			if block is None:
+				return
+			if isinstance(block, Exception):
+				raise block
+			yield block
+
+	def __iter__(self):
+		for block in self.blocks():
+			# str.splitlines would also split on \r and other line breaks
+			lines = block.split("\n")
+			for line in lines[:-1]:
+				yield line + "\n"
+			if lines[-1]:
+				yield lines[-1]
+
+	def close(self):
+		"""
+		Stop decompressing and release the file.
+		"""
+		self.stopped = True
+		if self.process is not None and self.process.poll() is None:
+			self.process.kill()
+		self.thread.join()
+		if self.process is not None:
+			self.process.wait()
+		self.stream.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def open_log(path):
+	"""
+	Open a log file for reading, decompressing it if its name ends in one of
+	COMPRESSED_SUFFIXES. Either way, the result can be iterated over to get
+	the lines of the log and used in a with statement.
+	@param path: the path to the log file
+	@return: a file object or a CompressedLog
+	"""
+	if is_compressed(path):
+		return CompressedLog(path)
+	return open(path, 'r')
+
+def read_blocks(path):
+	"""
+	Read a log file in large blocks that end on line boundaries.
+	@param path: the path to the log file, which can be compressed
+	@return: a generator of blocks of the log
+	"""
+	if is_compressed(path):
+		with CompressedLog(path) as log:
+			for block in log.blocks():
+				yield block
+		return
+	if getsize(path) == 0:
+		return
+	with open(path, 'rb') as f:
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			size = len(mm)
+			pos = 0
+			while pos < size:
+				end = -1
+				if pos + SCAN_BLOCK < size:
+					end = mm.find("\n", pos + SCAN_BLOCK)
+				end = size if end == -1 else end + 1
+				yield mm[pos:end]
+				pos = end
+		finally:
+			mm.close()
+
+def scan_lines(path, markers):
+	"""
+	Yield the lines of a log file that contain at least one of a set of
+	markers, in file order. Each matching line is yielded once, with its
+	trailing newline, exactly as iterating over the file would give it.
+	@param path: the path to the log file, which can be compressed
+	@param markers: a list of strings to search for. They can't contain
+		newlines.
+	@return: a generator of matching lines
+	"""
+	for block in read_blocks(path):
+		# blocks are strings: mmap.find in Python 2 is a naive byte loop,
+		# str.find is much faster
+		find, rfind = block.find, block.rfind
+		starts = set()
+		for marker in markers:
+			i = find(marker)
+			while i != -1:
+				starts.add(rfind("\n", 0, i) + 1)
+				i = find("\n", i)
+				if i == -1:
+					break
+				i = find(marker, i)
+		for start in sorted(starts):
+			stop = find("\n", start)
+			yield block[start:] if stop == -1 else block[start:stop + 1]
+
+def follow_lines(path, poll=FOLLOW_POLL):
+	"""
+	Yield the lines of a plain log file as it is written, like tail -f:
+	first the lines already in it, then each new line once it is complete.
+	A partial last line is held back until its newline is written. Never
+	returns by itself, so stop iterating (or close the generator) to end.
+	@param path: the path to the log file, which can't be compressed
+	@param poll: how long, in seconds, to wait before looking for new lines
+		once the end of the log is reached
+	@return: a generator of lines, with their trailing newlines
+	"""
+	if is_compressed(path):
+		raise ValueError("can't follow a compressed log: " + path)
+	with open(path, 'r') as f:
+		partial = ""
+		while True:
+			line = f.readline()
+			if not line:
+				sleep(poll)
+				continue
+			if line[-1] != "\n":
+				partial += line
+				continue
+			yield partial + line
+			partial = ""
@@ -91,67 +91,31 @@ def ip_replace(split, ip_dict, ip_pseudo):
 
 
 if (__name__ == "__main__"):
+	from ingest import ShadowFilter, SHADOW_MARKERS, tor_line
+	from logreader import scan_lines, log_name
 	infile = sys.argv[1]
 	#nodename = sys.argv[2]  # nodename = name of relay/node wanted --
                             # in the example above, this is 2.relay
 	outfile = sys.argv[2]
-	outpickle = infile[:-4] + "_pseudo_ip.pickle"
+	outpickle = log_name(infile)[:-4] + "_pseudo_ip.pickle"
 
-	ip_dict = {}
-	ip_pseudo = 1
-	num_cl = 0
-	unique_sc = 0
-	sc = 0
-	trans_comp = 0
-	built = 0
-	sc_dict = []
+	shadow = ShadowFilter()
 
 # ./data/relays-50r-180c.csv
-	with open(infile, "r") as f_in, open(outfile, "w") as f_out:
+	with open(outfile, "w") as f_out:
 		print "Reading file..."
-		n_entries = 0
 		print "Converting to tor format..."
-		for line in f_in:
-			n_entries += 1
-			if n_entries % 50000 == 0 and n_entries != 0:
-				print "%i entries processed" % n_entries
-
-			split = line.split()
-			if "BUILT" in line:
-				built = built + 1
-
-			if "GET" in line and "transfer-complete" in line:
-				trans_comp = trans_comp + 1
-
-			if "SENTCONNECT" in line and split[-1].split(":")[1] == "80":
-				sc = sc + 1
-				if [split[12],split[4]] not in sc_dict:
-					sc_dict.append([split[12],split[4]])
-					unique_sc = unique_sc + 1
-		
-			# previous relay is a client
-			if (split[6] == "CLIENTLOGGING:" and split[8].startswith("11.0.")):
-				num_cl = num_cl + 1
-				# pseudonomyize ip addresses
-				split, ip_dict, ip_pseudo = ip_replace(split, ip_dict, ip_pseudo)
-				ip = split[4]
-				# get virtual time
-				hours, minutes, seconds, nano = [int(x) for x in split[2].replace(".",":").split(":")]
-				loglevel = "[notice]"
-				date = datetime(2013, 1, 1, hours, minutes, seconds, nano/1000)
-				date_fmt = date.strftime("%b %d %H:%M:%S.%f")[0:-3]
-				tor_log = date_fmt + " " + loglevel + " " + ip + " " + " ".join(split[6:]) + "\n"
-				f_out.write(tor_log)
-
-	print "\ntotal SENTCONNECT: " + str(sc)
-	print "unique SENTCONNECT: " + str(unique_sc)
-	print "total GET: " + str(trans_comp)
-	print "total BUILT: " + str(built)
-	print "Filtered cell count: " + str(num_cl)
+		# only the lines with a marker in them are split and filtered
+		for line in scan_lines(infile, SHADOW_MARKERS):
+			split = shadow.filter_line(line)
+			if shadow.n_entries % 50000 == 0:
+				print "%i entries processed" % shadow.n_entries
+			if split is not None:
+				f_out.write(tor_line(split))
+
+	shadow.print_counts()
 	# save pseudo ip map
 	with open(outpickle, "w") as outfile:
-		ip_dict_flip = {v:k for k, v in ip_dict.items()}
-		cPickle.dump(ip_dict_flip, outfile, protocol=2)
+		cPickle.dump(shadow.pseudo_ip_map(), outfile, protocol=2)
  		print "Dumping ip address dictionary to %s" % outpickle
 	print "Done\n"
-
@@ -5,7 +5,6 @@ Utility functions for working with matrices
 
 from numpy import array
 from numpy import float64 as npfloat
-from ghmm import HMMFromMatrices, Float, GaussianDistribution
 
 def uniformMatrix(r, c, v=0):
 	"""
@@ -4,7 +4,8 @@ Automates the post-data collection process.
 		    python post_processing -visualizations graphing_mode shortname
 		    python post_processing.py -clientSeries infile type_client num_graphs 
 
-where infile is a scallion.log file.
+where infile is a scallion.log file, which can be compressed (.gz, .bz2, .xz
+		or .zst).
       nodename is the name of a relay/node (ex: relaymiddle2)
 	  shortname is a string in the format nodename_numclients (ex: rm2_50)
       graphing_mode is the plot wanted (-summarize, -horizon, -colorplots, -allPlots)
@@ -17,6 +18,8 @@ where infile is a scallion.log file.
 
 import sys, re, subprocess
 import timeplot_clients
+from ingest import ingest_file
+from logreader import scan_lines, log_name
 import operator
 
 '''
@@ -27,21 +30,20 @@ import operator
 	@return: a dictionary of {nodename:number of cells}
 '''
 def info_scallion(infile):
-	with open(infile, "r") as f:
-		nodes = {}
-		for line in f:
-			split = line.split() # split the log
-			if "CLIENTLOGGING" in line:
-				name = split[4].split("~")[0].replace("[", "")
-				if name not in nodes:
-					nodes[name] = 1
-				else:
-					num = nodes.get(name) + 1
-					nodes[name] = num
-		return sorted(nodes.items(), key=operator.itemgetter(1))
+	nodes = {}
+	for line in scan_lines(infile, ["CLIENTLOGGING"]):
+		split = line.split() # split the log
+		name = split[4].split("~")[0].replace("[", "")
+		if name not in nodes:
+			nodes[name] = 1
+		else:
+			num = nodes.get(name) + 1
+			nodes[name] = num
+	return sorted(nodes.items(), key=operator.itemgetter(1))
 
 '''
-	Filters and formats scallion.log data
+	Filters and formats scallion.log data. The filtering, parsing, windowing
+	and trimming stages run in a single pass over infile (see ingest.py).
 		Syntax: python post_processing -get_data infile nodename shortname
 	@param infile: a scallion.log file
 	@param nodename: the name of a relay/node
@@ -49,14 +51,7 @@ def info_scallion(infile):
 
 '''
 def get_data(infile, name):
-	logshadow_in = "python logshadow.py " + infile + " " + name + "_tor_fmt.log" + " "
-	subprocess.call(logshadow_in, shell=True)
-	logparse_in = "python logparse.py " + name + "_tor_fmt.log " + name + "_parsed.pickle"
-	subprocess.call(logparse_in, shell=True)
-	window_in = "python window.py " + name + "_parsed.pickle " + name + "_windowed.pickle 5000"
-	subprocess.call(window_in, shell=True)
-	trim_in = "python trim_series.py " + name + "_windowed.pickle " + name + "_trimmed_good.pickle " + name + "_trimmed_bad.pickle"
-	subprocess.call(trim_in, shell=True)
+	ingest_file(infile, name, 5000)
 
 '''
 	Runs visualization code
@@ -116,7 +111,7 @@ if __name__ == "__main__":
 		infile = sys.argv[2]  # a scallion.log
 		#nodename = sys.argv[3] # a node/relay name
 		#relay_csv = sys.argv[3]
-		name = infile[:-4]
+		name = log_name(infile)[:-4]
 		get_data(infile, name)
 
 	elif command == "-visualizations":
@@ -129,7 +124,7 @@ if __name__ == "__main__":
 		#nodename = sys.argv[3]
 		type_client = sys.argv[3] # web, bulk, perfclient1m, perfclient5m, perfclient50, -allClients
 		num_graphs = int(sys.argv[4]) # number of graphs wanted
-		name = infile[:-4]
+		name = log_name(infile)[:-4]
 
 		ident_list = timeplot_clients.get_ident_list(name + "_trimmed_good.pickle")
 		circ_name_map = timeplot_clients.circuit_client_map(infile, ident_list)
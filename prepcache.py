@@ -0,0 +1,177 @@
+"""
+Cache of the preprocessed training data build_models.py and
+gen_likelihoods.py work on. Preprocessing a trimmed records pickle (see
+build_models.preprocess_filtered) means unpickling every record, log
+transforming it and filtering it; this is done once per input file and the
+result saved as flat numpy arrays that later runs memory map instead:
+
+	values.npy   log transformed (in, out) windows of all the series
+	offsets.npy  CSR offsets into values, n_series + 1 entries
+	slugs.npy    ip slug of each series
+	split_<beta>_<seed>_train.npy, split_<beta>_<seed>_test.npy
+	             indices of the series train_test_split puts in the
+	             training and test sets for a train size and random seed
+
+Entries are content addressed: they live in a directory named by the md5 of
+the input file's contents and the preprocessing parameters, so a changed
+input file gets a new entry, and stale ones can be deleted at any time. The
+cache is kept in CACHE_DIR next to the input file.
+
+	Syntax: python prepcache.py inpath
+
+Preprocesses inpath into the cache, if it isn't cached already.
+"""
+
+from numpy import (array, asarray, concatenate, cumsum, load, save, zeros,
+	arange, int64, float64, flatnonzero)
+from sklearn.cross_validation import train_test_split
+from os.path import join, dirname, abspath, isdir, exists
+from os import mkdir, rename, getpid
+from hashlib import md5
+from sequence_utils import SeriesBatch
+import sys, json, cPickle, shutil
+
+CACHE_DIR = ".prepcache"
+# bump when preprocessing changes, so entries made by the old code are missed
+PREPROCESS_VERSION = 1
+HASH_BLOCK = 1 << 20
+
+def file_digest(path):
+	"""
+	@param path: a file
+	@return: the md5 of the file's contents, as a hex string
+	"""
+	digest = md5()
+	with open(path, 'rb') as f:
+		while True:
+			block = f.read(HASH_BLOCK)
+			if not block:
+				break
+			digest.update(block)
+	return digest.hexdigest()
+
+def cache_key(path, params):
+	"""
+	@param path: the input file
+	@param params: a dict of the parameters the cached data depends on
+	@return: the name of the cache entry for path and params
+	"""
+	digest = md5(file_digest(path))
+	digest.update(json.dumps(params, sort_keys=True))
+	return digest.hexdigest()
+
+class PreprocessedSeries(object):
+	"""
+	The cached, preprocessed series of one input file.
+	"""
+	def __init__(self, entry):
+		"""
+		@param entry: the cache entry's directory
+		"""
+		self.entry = entry
+		self.values = load(join(entry, "values.npy"), mmap_mode='r')
+		self.offsets = load(join(entry, "offsets.npy"))
+		self.slugs = load(join(entry, "slugs.npy"))
+
+	def __len__(self):
+		return len(self.slugs)
+
+	def series(self):
+		"""
+		@return: the series as build_models.preprocess_filtered gives them,
+			a list of (list of (in, out) tuples, ip slug) tuples
+		"""
+		windows = map(tuple, asarray(self.values).tolist())
+		offsets = self.offsets.tolist()
+		return [(windows[offsets[i]:offsets[i+1]], slug) for i, slug in
+			enumerate(self.slugs.tolist())]
+
+	def out_series(self):
+		"""
+		@return: the outbound counts of the series, as a list of
+			(list of outbound counts, ip slug) tuples
+		"""
+		counts = asarray(self.values[:,1]).tolist()
+		offsets = self.offsets.tolist()
+		return [(counts[offsets[i]:offsets[i+1]], slug) for i, slug in
+			enumerate(self.slugs.tolist())]
+
+	def split(self, beta, rand_seed):
+		"""
+		The train/test split train_test_split makes of the series. It only
+		depends on the number of series, so it's made (and cached) on their
+		indices.
+		@param beta: the proportion of series to train on
+		@param rand_seed: the random seed of the split
+		@return: (train, test), arrays of the indices of the series in each,
+			in the order train_test_split gives them
+		"""
+		path = join(self.entry, "split_%r_%i" % (beta, rand_seed))
+		if exists(path + "_test.npy"):
+			return (load(path + "_train.npy"), load(path + "_test.npy"))
+		train, test = train_test_split(arange(len(self)), train_size=beta,
+			random_state=rand_seed)
+		_save_atomic(path + "_train.npy", train)
+		_save_atomic(path + "_test.npy", test)
+		return (train, test)
+
+def _save_atomic(path, arr):
+	# write to a temporary file first, so readers never see half an array
+	tmp_path = "%s.%i.tmp" % (path, getpid())
+	with open(tmp_path, 'wb') as f:
+		save(f, arr)
+	rename(tmp_path, path)
+
+def _preprocess_records(inpath):
+	# build_models.preprocess_filtered, straight to arrays
+	with open(inpath) as datafile:
+		records = cPickle.load(datafile)['records']
+	batch = SeriesBatch([record['relays'] for record in records])
+	batch.log_transform()
+	good = flatnonzero(batch.good())
+	windows = [batch.windows(i) for i in good]
+	offsets = zeros(len(good) + 1, int64)
+	cumsum([len(w) for w in windows], out=offsets[1:])
+	values = concatenate(windows) if windows else zeros((0, 2), float64)
+	slugs = array([records[i]['ident'][1] for i in good], int64)
+	return (values, offsets, slugs)
+
+def load_preprocessed(inpath, cache_dir=None):
+	"""
+	Load the preprocessed series of a trimmed records pickle from the cache,
+	preprocessing them and adding them to the cache if they aren't in it.
+	@param inpath: the records pickle, as output by trim_series.py
+	@param cache_dir: the cache directory, CACHE_DIR next to inpath by
+		default
+	@return: a PreprocessedSeries
+	"""
+	if cache_dir is None:
+		cache_dir = join(dirname(abspath(inpath)), CACHE_DIR)
+	key = cache_key(inpath, {
+		'preprocess': 'preprocess_filtered',
+		'version': PREPROCESS_VERSION
+	})
+	entry = join(cache_dir, key)
+	if isdir(entry):
+		return PreprocessedSeries(entry)
+	print "Preprocessing %s into the cache..." % inpath
+	values, offsets, slugs = _preprocess_records(inpath)
+	if not isdir(cache_dir):
+		mkdir(cache_dir)
+	# build the entry under a temporary name and rename it into place, so
+	# an interrupted run never leaves a partial entry
+	tmp_entry = "%s.%i.tmp" % (entry, getpid())
+	mkdir(tmp_entry)
+	save(join(tmp_entry, "values.npy"), values)
+	save(join(tmp_entry, "offsets.npy"), offsets)
+	save(join(tmp_entry, "slugs.npy"), slugs)
+	try:
+		rename(tmp_entry, entry)
+	except OSError:
+		# another process cached the same input in the meantime
+		shutil.rmtree(tmp_entry)
+	return PreprocessedSeries(entry)
+
+if __name__ == "__main__":
+	prep = load_preprocessed(sys.argv[1])
+	print "%i series cached in %s" % (len(prep), prep.entry)
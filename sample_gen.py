@@ -1,7 +1,19 @@
-from ghmm import GaussianDistribution, Float, SequenceSet, HMMFromMatrices
+from gaussian_hmm import GaussianHMM
 from random import random
 
+try:
+	from ghmm import GaussianDistribution, Float, SequenceSet, HMMFromMatrices
+except ImportError:
+	HMMFromMatrices = None
+
 def make_data(As, Bs, pis, Ns, lengths=200, seed=0):
+	if HMMFromMatrices is None:
+		# without ghmm, sample from numpy models into a list of sequences
+		S = []
+		for i in xrange(0, len(As)):
+			hmm = GaussianHMM((As[i], Bs[i], pis[i]))
+			S += hmm.sample(Ns[i], lengths[i], seed)
+		return S
 	S = SequenceSet(Float(), [])
 	for i in xrange(0, len(As)):
 		A = As[i]
@@ -3,7 +3,14 @@ Utility functions for working with sequence data.
 @author: Julian Applebaum
 """
 
-from ghmm import Float, SequenceSet, EmissionSequence
+try:
+	from ghmm import Float, SequenceSet, EmissionSequence
+except ImportError:
+	# only the numpy HMM backend (see hmm_utils) can be used
+	Float = SequenceSet = EmissionSequence = None
+from numpy import (arange, asarray, concatenate, cumsum, diff, flatnonzero,
+	float64, int64, log, maximum, minimum, ones, repeat, std, zeros)
+from circrecord import RunSeries
 
 def sequenceEq(s1, s2):
 	"""
@@ -16,21 +23,26 @@ def sequenceEq(s1, s2):
 		if s1[i] != s2[i]: return False
 	return True
 
-def toSequenceSet(S, domain=Float()):
+def toSequenceSet(S, domain=None):
 	"""
 	Convert a list of sequences into a ghmm.SequenceSet
 	@param S: a list of sequences as Python lists
+	@param domain: the ghmm emission domain, ghmm.Float() by default
 	@return: the sequences as a ghmm.SequenceSet
 	"""
+	if domain is None:
+		domain = Float()
 	return SequenceSet(domain, S)
 
-def toSequence(s, domain=Float()):
+def toSequence(s, domain=None):
 	"""
 	Convert a sequence in list form to a ghmm.EmissionSequence
 	@param: a sequence in Python list form
-	@param domain: the ghmm emission domain
+	@param domain: the ghmm emission domain, ghmm.Float() by default
 	@param: the sequence as a ghmm.EmissionSequence
 	"""
+	if domain is None:
+		domain = Float()
 	return EmissionSequence(domain, s)
 
 def seqSetToList(S):
@@ -73,10 +85,28 @@ def trim_inactive(series):
 	#print series[lead_idx:trail_idx]
 	return series[lead_idx:trail_idx]
 
+def _trim_inactive_runs(series):
+	# trim_inactive_preprocess for a RunSeries, a run at a time
+	lead_idx = None
+	trail_idx = 0
+	start = 0
+	for (w_in, w_out), length in series.runs():
+		if w_in >= 2 or w_out >= 2:
+			if lead_idx is None:
+				lead_idx = start
+			trail_idx = start + length
+		start += length
+	if lead_idx is None:
+		return series[0:0]
+	return series[lead_idx:trail_idx]
+
 def trim_inactive_preprocess(series):
 	'''
-	@param series: time series of [in, out] cell counts
+	@param series: time series of [in, out] cell counts. A RunSeries is
+		trimmed run by run, without expanding it.
 	'''
+	if isinstance(series, RunSeries):
+		return _trim_inactive_runs(series)
 	tail = len(series)
 	lead_idx = 0
 	trail_idx = tail
@@ -94,6 +124,120 @@ def trim_inactive_preprocess(series):
 	#print series[lead_idx:trail_idx]
 	return series[lead_idx:trail_idx]
 
+class SeriesBatch(object):
+	"""
+	Many window series held as one ragged array of runs, so trimming, the
+	log transform and the std filter can be done for all of them at once
+	with numpy instead of a Python loop per series and window. A RunSeries
+	contributes its runs; any other series of (in, out) windows contributes
+	one run per window.
+	"""
+	def __init__(self, series_list):
+		"""
+		@param series_list: a list of window series (lists of (in, out)
+			tuples, WindowSeries or RunSeries)
+		"""
+		values = []
+		lengths = []
+		for series in series_list:
+			if isinstance(series, RunSeries):
+				run_values, run_lengths = series.run_arrays()
+			else:
+				run_values = asarray(series, float64).reshape(-1, 2)
+				run_lengths = ones(len(run_values), int64)
+			values.append(run_values)
+			lengths.append(run_lengths)
+		n_series = len(series_list)
+		self.values = (concatenate(values).astype(float64) if values else
+			zeros((0, 2), float64))
+		self.lengths = (concatenate(lengths).astype(int64) if lengths else
+			zeros(0, int64))
+		# the runs of series i are run_lo[i], ..., run_hi[i]-1, and cover
+		# its windows lead[i], ..., trail[i]-1
+		n_runs = zeros(n_series + 1, int64)
+		cumsum([len(l) for l in lengths], out=n_runs[1:])
+		self.run_lo = n_runs[:-1].copy()
+		self.run_hi = n_runs[1:].copy()
+		self.lead = zeros(n_series, int64)
+		self.trail = zeros(n_series, int64)
+		ends = cumsum(self.lengths)
+		nonempty = flatnonzero(self.run_hi > self.run_lo)
+		base = concatenate([[0], ends])[self.run_lo[nonempty]]
+		self.trail[nonempty] = ends[self.run_hi[nonempty] - 1] - base
+		# where each run starts within its series
+		run_series = repeat(arange(n_series), self.run_hi - self.run_lo)
+		self.run_start = (ends - self.lengths - concatenate([[0], ends])[
+			self.run_lo][run_series])
+
+	def __len__(self):
+		return len(self.run_lo)
+
+	def trim_inactive(self):
+		"""
+		Trim the leading and trailing inactive windows of every series, as
+		trim_inactive_preprocess does. Has to be done before log_transform.
+		"""
+		values = self.values
+		active = flatnonzero((values[:,0] >= 2) | (values[:,1] >= 2))
+		# the first and last active run within each series' runs
+		first = active.searchsorted(self.run_lo)
+		last = active.searchsorted(self.run_hi) - 1
+		trimmed = flatnonzero(last >= first)
+		self.run_lo[:] = self.run_hi
+		self.lead[:] = 0
+		self.trail[:] = 0
+		if len(trimmed) > 0:
+			lo = active[first[trimmed]]
+			hi = active[last[trimmed]] + 1
+			self.run_lo[trimmed] = lo
+			self.run_hi[trimmed] = hi
+			self.lead[trimmed] = self.run_start[lo]
+			self.trail[trimmed] = self.run_start[hi - 1] + self.lengths[hi - 1]
+
+	def log_transform(self):
+		"""
+		Replace every count c with log(1+c), in place. This is log of 1+c
+		rather than log1p, which can differ from it in the last bit, to
+		give exactly the values log_series_preprocess does.
+		"""
+		self.values += 1
+		log(self.values, out=self.values)
 
+	def good(self):
+		"""
+		@return: a boolean array, True for the series that are nonempty
+			and have a nonzero std, as filter_criteria_preprocess checks
+		"""
+		good = self.run_hi > self.run_lo
+		nonempty = flatnonzero(good)
+		if len(nonempty) == 0:
+			return good
+		# min and max of each series over both directions: series with
+		# two different values have a nonzero std
+		bounds = zeros(2*len(nonempty), int64)
+		bounds[0::2] = self.run_lo[nonempty]
+		bounds[1::2] = self.run_hi[nonempty]
+		row_min = concatenate([self.values.min(axis=1), [0]])
+		row_max = concatenate([self.values.max(axis=1), [0]])
+		series_min = minimum.reduceat(row_min, bounds)[0::2]
+		series_max = maximum.reduceat(row_max, bounds)[0::2]
+		good[nonempty] = series_max > series_min
+		# numpy's std of a constant series isn't always exactly 0, so those
+		# get the std filter_criteria_preprocess would compute
+		for i in nonempty[series_max == series_min]:
+			good[i] = std(self.windows(i)) > 0
+		return good
 
+	def windows(self, i):
+		"""
+		@return: the (trimmed, transformed) windows of series i, expanded
+			to an (n_windows, 2) array
+		"""
+		lo, hi = self.run_lo[i], self.run_hi[i]
+		return repeat(self.values[lo:hi], self.lengths[lo:hi], axis=0)
 
+	def window_tuples(self, i):
+		"""
+		@return: the windows of series i as a list of (in, out) tuples
+		"""
+		return map(tuple, self.windows(i).tolist())
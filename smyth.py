@@ -8,30 +8,51 @@ documentation for explanations.
 @author: Julian Applebaum
 """
 
-from ghmm import Alphabet
-from sklearn.cluster import k_means
+try:
+	from ghmm import Alphabet
+except ImportError:
+	Alphabet = None
 from fastcluster import linkage
 from Pycluster import kmedoids, treecluster
 from scipy.cluster.hierarchy import fcluster
-from scipy.spatial.distance import squareform
-from numpy import std, mean, array, float32
+from scipy.spatial.distance import squareform, pdist
+from scipy.spatial import cKDTree
+from numpy import (std, mean, zeros, load, asarray, array, cumsum, minimum,
+	searchsorted, flatnonzero, column_stack, concatenate, argsort, unique,
+	bincount, repeat, log, exp, dot, pi as PI, int64, float32, float64)
+from numpy.random import RandomState
 from sample_gen import smyth_example
 from cluster_utils import partition
 from sequence_utils import *
 from hmm_utils import *
+from gaussian_hmm import GaussianHMM
 from matrix_utils import uniformMatrix
+from diststore import DistanceStore, distanceKey
+from sparse_linkage import mstLinkage, averageLinkage
+from kmeans1d import OptimalPartitions
+from os.path import join, isdir
+from os import mkdir
 # from levenshtein import levDistance
 from pprint import pprint
 from math import isnan
 from multiprocessing import Pool
-from itertools import izip, islice, ifilter
+from itertools import izip, imap, ifilter
 from time import clock
 from random import uniform
-import sys, cPickle
+import sys, cPickle, hmm_utils
 
 # Minimum standard deviation for a state in the clustering phase. Anything
 # less than this leaves log likelihood prone to underflow errors.
 EPSILON = .25
+# number of sequences per block of the distance matrix; work items are pairs
+# of blocks
+DIST_BLOCK = 200
+# default number of landmark sequences for the 'landmark' distance
+N_LANDMARKS = 50
+# default number of neighbours per sequence for the 'knn' distance, and how
+# many candidates per neighbour are picked by summary statistics
+N_NEIGHBORS = 10
+KNN_CANDIDATES = 10
 
 def validateTriple(triple):
 	"""
@@ -78,20 +99,24 @@ def printAndFlush(string):
 # These functions really belong as methods of HMMCluster, but we need to leave
 # them at the module level for multiprocessing.
 
-def prepareSeqs(S):
-	"""
-	Combine the observations from a set of sequences into a merged list of
-	1d vectors, and get the set of distinct observation values in one pass.
-	@param S: the set of sequences
-	@return: A pair (merged, distinct)
-	"""
-	distinct = set()
-	merged = []
-	for s in S:
-		for o in s:
-			merged.append([o])
-			distinct.add(o)
-	return (merged, distinct)
+def _mergedObservations(S):
+	return concatenate([asarray(s, float64) for s in S]) if len(S) > 0 else \
+		zeros(0, float64)
+
+def _emissionDistribution(partitions, obs, m):
+	# (B, labels, has_zero) of the optimal partition of obs into m clusters
+	labels = partitions.labels(m, obs)
+	B = []
+	has_zero = False
+	for i in xrange(0, m):
+		cluster = obs[labels == i]
+		assert len(cluster) > 0
+		mu = mean(cluster)
+		stddev = std(cluster)
+		B.append((mu, stddev))
+		if stddev < 0.001:
+			has_zero = True
+	return (B, labels, has_zero)
 
 def smythEmissionDistribution(pair):
 	"""
@@ -104,49 +129,37 @@ def smythEmissionDistribution(pair):
 	@return:  (B, labels, has_zero), where:
 	   * S', obs = concat(S), set(S)
 	   * m' = min(target_m, len(obs))
-	   * [C_0,...,C_{m'-1}] = result of clustering S' with k-means.
-	   * labels: tells which cluster each item in merged goes into; i.e.,
+	   * [C_0,...,C_{m'-1}] = the optimal (least squares) partition of S'
+	       into m' clusters, by exact 1-D k-means (see kmeans1d), in
+	       increasing order of their values.
+	   * labels: tells which cluster each item in S' goes into; i.e.,
 	       labels[i] = j, where S'[i] belongs to cluster C_j.
 	   * B[i] = (mean(C_i), stddev(C_i)).
 	   * has_zero = True if there is i such that B[i][1] ~= 0.0.
 	"""
 	S, target_m = pair
-	# merged list of 1d vectors, set of distinct observation values
-	merged, distinct = prepareSeqs(S)
-
-	# m_prime is min of either target_m or the number of distinct obs values 
-	m_prime = min(target_m, len(distinct))
-
-	# k-means partitions merged into m_prime clusters [C_0,...,C_{m'-1}].
-	# centroids = [c_0,...,c_{m'-1}]: cluster centers; i.e., c_i is the center
-	#   of C_j.
-	# labels: tells which cluster each item in merged goes into; i.e.,
-	#   labels[i] = j, where merged[i] belongs to cluster C_j.
-	# inertia: sum of distances of samples to closest cluster center
-	#   inertia = sum_{i=0}^{m'-1}(sum_{x in C_i} dist(x, c_i)).
-	centroids, labels, inertia = k_means(merged, m_prime, init='k-means++')
-
-	# takes labels and arranges merged into 
-	# a list of lists, each of which contains the series from one cluster
-	# clusters = [C_0,..,C_{m'-1}]
-	clusters = partition(merged, labels)
-
-	# Compute (B, labels, has_zero), where
-	#   B[i] = (mean(C_i), stddev(C_i)).
-	#   has_zero = True if there is i such that B[i][1] ~= 0.0.
-	B = []
-	has_zero = False
-	for cluster in clusters:
-		assert len(cluster) > 0
-		mu = mean(cluster)
-		stddev = std(cluster)
-		B.append((mu, stddev))
-		if stddev < 0.001:
-			has_zero = True
+	obs = _mergedObservations(S)
+	partitions = OptimalPartitions(obs)
+	# m_prime is min of either target_m or the number of distinct obs values
+	m_prime = min(target_m, partitions.d)
+	return _emissionDistribution(partitions, obs, m_prime)
 
-	return (B, labels, has_zero)
+def smythEmissionDistributions(pair):
+	"""
+	smythEmissionDistribution for every target_m up to max_m at once, from a
+	single dynamic programming pass. The distribution smythEmissionDistribution
+	gives for target_m <= max_m is the min(target_m, len(result))-th.
+	@param pair: A tuple of the form (S: list of sequences, max_m: int)
+	@return: a list of the (B, labels, has_zero) of each m in
+		1..min(max_m, number of distinct observations)
+	"""
+	S, max_m = pair
+	obs = _mergedObservations(S)
+	partitions = OptimalPartitions(obs)
+	return [_emissionDistribution(partitions, obs, m) for m in
+		xrange(1, min(max_m, partitions.d) + 1)]
 
-def trainHMM(pair):
+def trainHMM(pair, pool=None, n_shards=None):
 	"""
 	Given a pair (S: list of sequences, target_m: int), train an HMM triple on S
 	with Baum-Welch with at most target_m states using Smyth's "default" method
@@ -163,11 +176,31 @@ def trainHMM(pair):
 	(N: # states in HMM, M: # observation symbols)
 
 	@param pair: A tuple of the form (S: list of sequences, target_m: int)
+	@param pool: A multiprocessing.Pool to split Baum-Welch's E-step across,
+		for a cluster too big for one process. The model is then trained as
+		a GaussianHMM, whatever the backend.
+	@param n_shards: How many shards to split the sequences into for pool,
+		normally its number of workers; cpu_count() if None
 	@return: The HMM as a (A, B, pi) triple
 	"""
 	cluster, target_m = pair
-	# get emission distribution B = [(mu, stddev), ...]
-	B, labels, has_zero = smythEmissionDistribution((cluster, target_m))
+	return trainFromEmissions(cluster,
+		smythEmissionDistribution((cluster, target_m)), pool, n_shards)
+
+def trainFromEmissions(cluster, emissions, pool=None, n_shards=None):
+	"""
+	The Baum-Welch half of trainHMM: train an HMM triple on a cluster from
+	Smyth's "default" HMM with a given emission distribution. With
+	smythEmissionDistributions, this trains a cluster for several target_m
+	from a single k-means pass.
+	@param cluster: the list of sequences
+	@param emissions: a (B, labels, has_zero) from smythEmissionDistribution
+	@param pool: See trainHMM
+	@param n_shards: See trainHMM
+	@return: The HMM as a (A, B, pi) triple
+	"""
+	# emission distribution B = [(mu, stddev), ...]
+	B, labels, has_zero = emissions
 	# also the number of clusters (created by k-means)
 	m_prime = len(B)
 	pi = [1.0/m_prime] * m_prime # ex: if m_prime = 4, pi = [0.25, 0.25, 0.25, 0.25]
@@ -183,8 +216,11 @@ def trainHMM(pair):
 	# error if len(cluster) = 1. 
 	#if len(cluster) > 1:
 	A = uniformMatrix(m_prime, m_prime, 1.0/m_prime)
-	hmm = tripleToHMM((A, B, pi))
-	hmm.baumWelch(toSequenceSet(cluster))
+	if pool is None:
+		hmm = tripleToHMM((A, B, pi))
+	else:
+		hmm = GaussianHMM((A, B, pi))
+	baumWelch(hmm, cluster, pool, n_shards)
 	A_p, B_p, pi_p = hmmToTriple(hmm)
 	B_p = map(lambda b: (b[0], max(b[1], EPSILON)), B_p)
 	validateTriple((A_p, B_p, pi_p))
@@ -253,8 +289,8 @@ def symDistance(args):
 	seq2, triple2 = pair2
 	hmm1 = tripleToHMM(triple1)
 	hmm2 = tripleToHMM(triple2)
-	s1_m2 = hmm2.loglikelihood(toSequence(seq1))
-	s2_m1 = hmm1.loglikelihood(toSequence(seq2))
+	s1_m2 = loglikelihood(hmm2, [seq1])
+	s2_m1 = loglikelihood(hmm1, [seq2])
 	"""
 	if s1_m2 > 0:
 		print seq1, hmm2
@@ -263,18 +299,268 @@ def symDistance(args):
 	assert s2_m1 <= 0, ("s2_m1=%f" % s2_m1)
 	return (s1_m2 + s2_m1)/2.0
 
+def crossLikelihoods(hmms, seqs):
+	"""
+	Score every sequence of a block under every model.
+	@param hmms: a list of HMMs, as returned by tripleToHMM
+	@param seqs: the sequences, as returned by sequenceBlock
+	@return: a len(seqs) x len(hmms) array L with
+		L[i,j] = log P(seqs[i] | hmms[j])
+	"""
+	L = zeros((len(seqs), len(hmms)), float64)
+	for j, hmm in enumerate(hmms):
+		L[:,j] = loglikelihoods(hmm, seqs)
+	return L
+
+# The distance matrix workers' sequences and initial HMM triples, set once
+# per process by initDistWorker, and the blocks of HMMs and converted
+# sequences built from them so far.
+_distState = {}
+
+def initDistWorker(seqs, triples):
+	"""
+	Pool initializer for distanceTile.
+	@param seqs: the sequences to compute distances between
+	@param triples: the initial HMM triple of each sequence
+	"""
+	_distState['seqs'] = seqs
+	_distState['triples'] = triples
+	_distState['blocks'] = {}
+
+def _workerBlock(b):
+	# the HMMs and converted sequences of block b
+	blocks = _distState['blocks']
+	if b not in blocks:
+		lo = b*DIST_BLOCK
+		hi = lo + DIST_BLOCK
+		hmms = map(tripleToHMM, _distState['triples'][lo:hi])
+		blocks[b] = (hmms, sequenceBlock(_distState['seqs'][lo:hi]))
+	return blocks[b]
+
+def distanceTile(tile):
+	"""
+	Compute the symDistances between two blocks of DIST_BLOCK of the
+	sequences given to initDistWorker. Each model is built, and each
+	sequence converted, once per worker; the models of each block are scored
+	against the sequences of the other, and the two cross likelihood blocks
+	symmetrized.
+	@param tile: a pair (bi, bj) of block numbers, bi <= bj
+	@return: (bi, bj, D), D[a,b] the distance between sequences
+		bi*DIST_BLOCK + a and bj*DIST_BLOCK + b
+	"""
+	bi, bj = tile
+	hmms_i, seqs_i = _workerBlock(bi)
+	hmms_j, seqs_j = _workerBlock(bj)
+	L_ij = crossLikelihoods(hmms_j, seqs_i)
+	L_ji = L_ij if bi == bj else crossLikelihoods(hmms_i, seqs_j)
+	assert (L_ij <= 0).all() and (L_ji <= 0).all(), (
+		"positive log likelihood in tile (%i, %i)" % tile)
+	return (bi, bj, (L_ij + L_ji.T)/2.0)
+
+def summaryFeatures(seqs):
+	"""
+	@param seqs: a list of sequences in Python list form
+	@return: an n x 3 array of the mean, standard deviation and log length of
+		each sequence, each column standardized
+	"""
+	seqs = [asarray(s, float64) for s in seqs]
+	X = column_stack([
+		[s.mean() if len(s) > 0 else 0 for s in seqs],
+		[s.std() if len(s) > 0 else 0 for s in seqs],
+		[log(max(len(s), 1)) for s in seqs]])
+	spread = X.std(axis=0)
+	spread[spread == 0] = 1
+	return (X - X.mean(axis=0))/spread
+
+def pickLandmarks(seqs, n_landmarks, method='kmeans++', seed=0):
+	"""
+	Choose landmark sequences for landmarkEmbedding.
+	@param seqs: a list of sequences in Python list form
+	@param n_landmarks: how many to choose (at most len(seqs))
+	@param method: 'random', or 'kmeans++' to spread them out over the
+		sequences' summaryFeatures with k-means++ seeding
+	@param seed: the random seed
+	@return: the sorted indices of the landmarks
+	"""
+	n = len(seqs)
+	n_landmarks = min(n_landmarks, n)
+	rand = RandomState(seed)
+	if method == 'random' or n_landmarks == 0:
+		return sorted(rand.permutation(n)[0:n_landmarks].tolist())
+	X = summaryFeatures(seqs)
+	chosen = [rand.randint(n)]
+	d2 = ((X - X[chosen[0]])**2).sum(axis=1)
+	while len(chosen) < n_landmarks:
+		total = d2.sum()
+		if total > 0:
+			i = searchsorted(cumsum(d2), rand.random_sample()*total,
+				side='right')
+			i = min(i, n - 1)
+		else:
+			# the rest are all the same as a landmark
+			left = flatnonzero(~array([j in chosen for j in xrange(0, n)]))
+			i = left[rand.randint(len(left))]
+		chosen.append(int(i))
+		d2 = minimum(d2, ((X - X[i])**2).sum(axis=1))
+	return sorted(chosen)
+
+# The embedding workers' sequences and landmark HMM triples, set once per
+# process by initEmbedWorker, and the HMMs built from them.
+_embedState = {}
+
+def initEmbedWorker(seqs, triples):
+	"""
+	Pool initializer for embedBlock.
+	@param seqs: the sequences to embed
+	@param triples: the landmark HMM triples
+	"""
+	_embedState['seqs'] = seqs
+	_embedState['triples'] = triples
+	_embedState['hmms'] = None
+
+def embedBlock(b):
+	"""
+	Embed a block of DIST_BLOCK of the sequences given to initEmbedWorker.
+	@param b: the block number
+	@return: (b, E), E[a,l] the log likelihood of sequence b*DIST_BLOCK + a
+		under landmark model l
+	"""
+	if _embedState['hmms'] is None:
+		_embedState['hmms'] = map(tripleToHMM, _embedState['triples'])
+	lo = b*DIST_BLOCK
+	seqs = sequenceBlock(_embedState['seqs'][lo:lo + DIST_BLOCK])
+	return (b, crossLikelihoods(_embedState['hmms'], seqs))
+
+def emissionBounds(seqs, triple):
+	"""
+	Upper bounds on the log likelihoods of sequences under a model. With
+	alpha the forward variables, the total probability grows at each step t
+	by at most max_s b_s(x_t), and at most sum_s (max_r A[r,s]) b_s(x_t),
+	and the first step is exact.
+	@param seqs: a list of sequences, as float arrays
+	@param triple: the model's HMM triple
+	@return: an array of the bound for each sequence
+	"""
+	if len(seqs) == 0:
+		return zeros(0, float64)
+	A, B, pi = triple
+	B = array(B, float64).reshape(-1, 2)
+	mu, var = B[:,0], B[:,1]
+	obs = concatenate(seqs)
+	log_b = -0.5*log(2*PI*var) - (obs[:,None] - mu)**2/(2*var)
+	log_max = log_b.max(axis=1)
+	b = exp(log_b - log_max[:,None])
+	step = log(minimum(1.0, dot(b, array(A, float64).max(axis=0))))
+	lengths = array([len(s) for s in seqs])
+	first = (cumsum(lengths) - lengths)[lengths > 0]
+	step[first] = log(dot(b[first], array(pi, float64)))
+	owner = repeat(range(0, len(seqs)), lengths)
+	return bincount(owner, log_max + step, len(seqs))
+
+def knnFeatures(seqs, triples):
+	"""
+	Cheap per-sequence statistics to pick kNN candidates with: the
+	summaryFeatures of the sequence and the lowest and highest emission
+	mean of its default model, all standardized.
+	@param seqs: a list of sequences in Python list form
+	@param triples: the default HMM triple of each sequence
+	@return: an n x 5 array
+	"""
+	means = [[b[0] for b in triple[1]] for triple in triples]
+	X = column_stack([[min(m) for m in means], [max(m) for m in means]])
+	spread = X.std(axis=0)
+	spread[spread == 0] = 1
+	return column_stack([summaryFeatures(seqs),
+		(X - X.mean(axis=0))/spread])
+
+# The kNN workers' sequences, default HMM triples and candidate neighbours,
+# set once per process by initKNNWorker, and the HMMs built so far.
+_knnState = {}
+
+def initKNNWorker(seqs, triples, candidates, k):
+	"""
+	Pool initializer for knnBlock.
+	@param seqs: the sequences
+	@param triples: the default HMM triple of each sequence
+	@param candidates: an n x c array of each sequence's candidate neighbours
+	@param k: the number of neighbours to find
+	"""
+	_knnState['seqs'] = [asarray(s, float64) for s in seqs]
+	_knnState['triples'] = triples
+	_knnState['candidates'] = candidates
+	_knnState['k'] = k
+	_knnState['hmms'] = {}
+
+def _knnHMM(i):
+	hmms = _knnState['hmms']
+	if i not in hmms:
+		hmms[i] = tripleToHMM(_knnState['triples'][i])
+	return hmms[i]
+
+def _nearest(i):
+	# the k nearest candidates of sequence i, by symDistance. Candidates are
+	# scored k at a time in order of their distance lower bounds, until the
+	# next bound is past the k-th nearest distance found.
+	seqs, triples = _knnState['seqs'], _knnState['triples']
+	cand = _knnState['candidates'][i]
+	k = _knnState['k']
+	if k == 0:
+		return ([], [])
+	upper_ic = array([emissionBounds([seqs[i]], triples[c])[0] for c in
+		cand])
+	upper_ci = emissionBounds([seqs[c] for c in cand], triples[i])
+	bounds = -(upper_ic + upper_ci)/2.0
+	order = argsort(bounds, kind='mergesort')
+	hmm_i = _knnHMM(i)
+	seq_i = sequenceBlock([seqs[i]])
+	found, found_dists = [], []
+	for start in xrange(0, len(order), k):
+		if len(found) >= k and bounds[order[start]] >= sorted(found_dists)[k-1]:
+			break
+		chunk = cand[order[start:start + k]]
+		L_ci = loglikelihoods(hmm_i, sequenceBlock([seqs[c] for c in chunk]))
+		L_ic = array([loglikelihoods(_knnHMM(c), seq_i)[0] for c in chunk])
+		found.extend(chunk.tolist())
+		found_dists.extend((-(L_ic + L_ci)/2.0).tolist())
+	nearest = argsort(found_dists, kind='mergesort')[0:k]
+	return ([found[j] for j in nearest], [found_dists[j] for j in nearest])
+
+def knnBlock(b):
+	"""
+	Find the k nearest neighbours of a block of DIST_BLOCK of the sequences
+	given to initKNNWorker, among their candidates.
+	@param b: the block number
+	@return: (rows, cols, dists) arrays of the block's kNN graph edges
+	"""
+	lo = b*DIST_BLOCK
+	hi = min(lo + DIST_BLOCK, len(_knnState['seqs']))
+	rows, cols, dists = [], [], []
+	for i in xrange(lo, hi):
+		nearest, nearest_dists = _nearest(i)
+		rows.extend([i]*len(nearest))
+		cols.extend(nearest)
+		dists.extend(nearest_dists)
+	return (array(rows, int64), array(cols, int64), array(dists, float64))
+
 def kMedoids(args):
 	"""
 	Do k-medoids clustering on a distance matrix.
-	@param args: A tuple of the form (dist_matrix, k, n_passes)
+	@param args: A tuple of the form (dist_matrix, k, n_passes). dist_matrix
+		may also be the path of a saved condensed matrix, which is memory
+		mapped rather than sent to the worker.
 	@return: The result tuple returned by Pycluster.kmedoids
 	"""
 	dist_matrix, k, n_passes = args
+	if isinstance(dist_matrix, str):
+		dist_matrix = load(dist_matrix, mmap_mode='r')
 	return kmedoids(dist_matrix, k, n_passes)
 
 class HMMCluster():
 	def __init__(self, S, target_m, min_k, max_k, labels, dist_func='hmm',
-			hmm_init='smyth', n_jobs=None):
+			hmm_init='smyth', n_jobs=None, dist_dir=None, extends=None,
+			n_landmarks=N_LANDMARKS, landmark_pick='kmeans++',
+			n_neighbors=N_NEIGHBORS, knn_linkage='average', pool=None,
+			parallel_bw=None):
 		"""
 		@param S: The sequences to model
 		@param target_m: The desired number of components per HMM. The training
@@ -283,14 +569,44 @@ class HMMCluster():
 		@param min_k: The minimum number of mixture components to try
 		@param max_k: The maximum number of mixture components to try
 		@param labels: The labelings after clustering
-		@param dist_func: The distance function to use; either 'hmm' or
-			'editdistance'. 'hmm' is Rabiner's symmetrized measure.
+		@param dist_func: The distance function to use; 'hmm',
+			'editdistance' or 'landmark'. 'hmm' is Rabiner's symmetrized
+			measure. 'landmark' approximates it for large numbers of
+			sequences: default HMMs are trained for n_landmarks landmark
+			sequences only, and sequences are compared by the Euclidean
+			distance between their vectors of log likelihoods under them.
+			'knn' keeps only the distances from each sequence to its
+			n_neighbors nearest, and can only be clustered hierarchically.
 		@param hmm_init: Either 'smyth' or 'random'. 'smyth' causes HMMs to
 			be initialized with Smyth 1997's "default" method. 'random'
 			results in random transition matrices, emission distributions
 			and intial state distributions.
 		@param n_jobs: How many processes to spawn for parallel computations.
-			If None, cpu_count() processes are created.
+			If None, cpu_count() processes are created, and if -1, the
+			computations run in this process.
+		@param dist_dir: If given, the HMM distance matrix is kept in a
+			DistanceStore entry in this directory, and a rerun on the same
+			sequences resumes computing it where the last one stopped.
+		@param extends: If given, dist_dir has the complete distance matrix
+			of the first extends sequences of S, from an earlier run. Only
+			the default HMMs of the sequences after them, and their
+			distances to all of S, are computed; the stored ones are
+			reused.
+		@param n_landmarks: The number of landmarks for 'landmark'
+		@param landmark_pick: How the landmarks are chosen, 'kmeans++' or
+			'random' (see pickLandmarks)
+		@param n_neighbors: The number of neighbours per sequence for 'knn'
+		@param knn_linkage: How 'knn' graphs are clustered, 'single' or
+			'average' (see sparse_linkage)
+		@param pool: A multiprocessing.Pool to use instead of creating one.
+			It's left open for its owner to close. The distance matrix
+			('hmm', 'landmark' and 'knn') is always computed on a dedicated
+			pool of n_jobs workers, started with the sequences and default
+			HMMs, or in this process if n_jobs is -1.
+		@param parallel_bw: If given, clusters of at least this many
+			sequences are trained one at a time, before the others, with
+			Baum-Welch's E-step split across the pool (see trainHMM),
+			rather than each in a single process.
 		"""
 		self.S = S
 		self.n = len(self.S)
@@ -300,6 +616,13 @@ class HMMCluster():
 		self.labelings = labels
 		self.dist_func = dist_func
 		self.hmm_init = hmm_init
+		self.dist_dir = dist_dir
+		self.extends = extends
+		self.n_landmarks = n_landmarks
+		self.landmark_pick = landmark_pick
+		self.n_neighbors = n_neighbors
+		self.knn_linkage = knn_linkage
+		self.parallel_bw = parallel_bw
 		self._sanityCheck()
 		self.components = {}
 		self.composites = {}
@@ -309,22 +632,26 @@ class HMMCluster():
 		self.calc_ks = []
 		self.init_hmms = []
 		self.times = {}
-		self.single_threaded = n_jobs == -1
-		if not self.single_threaded:
+		self.n_jobs = n_jobs
+		self.dist_path = None
+		self.landmarks = []
+		self.embedding = None
+		self.knn_graph = None
+		self.single_threaded = n_jobs == -1 and pool is None
+		self.own_pool = pool is None
+		if pool is not None:
+			self.pool = pool
+		elif not self.single_threaded:
 			self.pool = Pool(n_jobs)
 
 	def _sanityCheck(self):
 		assert self.min_k <= self.max_k
-		assert self.dist_func in ('hmm', 'editdistance')
+		assert self.dist_func in ('hmm', 'editdistance', 'landmark', 'knn')
+		assert self.landmark_pick in ('random', 'kmeans++')
+		assert self.knn_linkage in ('single', 'average')
 		assert self.hmm_init in ('smyth', 'random')
 		assert len(self.labelings) > 0
-
-	def _getHMMBatchItems(self):
-		for i in xrange(0, self.n):
-			for j in xrange(1+i, self.n):
-				pair_1 = (self.S[i][0], self.init_hmms[i])
-				pair_2 = (self.S[j][0], self.init_hmms[j])
-				yield (pair_1, pair_2)
+		assert self.extends is None or self.dist_dir is not None
 
 	def _doMap(self, func, items):
 		if self.single_threaded:
@@ -332,48 +659,181 @@ class HMMCluster():
 		else:
 			return self.pool.map(func, items)
 
+	def _storePath(self, seqs):
+		# the DistanceStore entry of seqs in dist_dir
+		return join(self.dist_dir, distanceKey(seqs, {
+			'target_m': self.target_m,
+			'hmm_init': self.hmm_init,
+			'backend': hmm_utils.HMM_BACKEND,
+			'block': DIST_BLOCK
+		}))
+
+	def _extendStore(self, store, seqs):
+		# copy the stored distances of the first self.extends sequences into
+		# store, and return their default HMMs
+		base_path = self._storePath(seqs[0:self.extends])
+		if not isdir(base_path):
+			raise ValueError("No stored distance matrix of the first %i "
+				"sequences in %s" % (self.extends, self.dist_dir))
+		base = DistanceStore(self.extends, DIST_BLOCK, base_path)
+		if not base.complete():
+			raise ValueError("The distance matrix in %s is incomplete" %
+				base_path)
+		printAndFlush("Extending the distance matrix of %i sequences..." %
+			self.extends)
+		store.copyFrom(base)
+		return base.loadInitHMMs()
+
 	def _getHMMDistMatrix(self):
 		"""
 		Compute the distance matrix using Rabiner's HMM distance measure.
 		"""
 
+		seqs = [s[0] for s in self.S]
+		store_path = None
+		if self.dist_dir is not None:
+			if not isdir(self.dist_dir):
+				mkdir(self.dist_dir)
+			store_path = self._storePath(seqs)
+		store = DistanceStore(self.n, DIST_BLOCK, store_path)
+
 		# Train an HMM for each sequence in S in parallel.  hmm_init and init_fn
 		# are poor name choices and need to be changed.
 		if self.hmm_init == 'smyth':
 			init_fn = trainHMM
 		elif self.hmm_init == 'random':
 			init_fn = randomDefaultTriple
+		# a resumed run has to use the HMMs the stored distances came from
+		self.init_hmms = store.loadInitHMMs()
+		if self.init_hmms is None:
+			stored_hmms = []
+			if self.extends is not None:
+				stored_hmms = self._extendStore(store, seqs)
+			printAndFlush("Generating default HMMs (parallel)...")
+			start = clock()
+			# inital hmm?
+			self.init_hmms = stored_hmms + self._doMap(init_fn,
+				(([s[0]], self.target_m) for s in self.S[len(stored_hmms):]))
+			self.times['init_hmms'] = clock() - start
+			store.saveInitHMMs(self.init_hmms)
+			printAndFlush("done")
+
+		# Compute the distance matrix in parallel, in tiles of pairs of
+		# blocks of sequences. The sequences and triples are handed to each
+		# worker once, when the pool starts.
+		tiles = store.missing()
+		printAndFlush("Computing distance matrix (parallel)...")
+		printAndFlush("Processing %i of %i tiles" % (len(tiles),
+			len(store.tiles)))
+		start = clock()
+		if self.n_jobs == -1:
+			initDistWorker(seqs, self.init_hmms)
+			results = imap(distanceTile, tiles)
+		else:
+			pool = Pool(self.n_jobs, initDistWorker, (seqs, self.init_hmms))
+			results = pool.imap_unordered(distanceTile, tiles)
+		# log-likelihoods are <= 0, a distance function must be positive
+		for bi, bj, D in results:
+			store.add(bi, bj, -1*D)
+		store.flush()
+		if self.n_jobs != -1:
+			pool.close()
+			pool.join()
+		self.times['distance_matrix'] = clock() - start
+		printAndFlush("done")
+		if self.n > 1:
+			printAndFlush("Minimum distance: %f" % store.dist.min())
+			printAndFlush("Maximum distance: %f" % store.dist.max())
+		if store_path is not None:
+			self.dist_path = join(store_path, "dist.npy")
+
+		return store.dist
+
+	def _getLandmarkDistMatrix(self):
+		"""
+		Compute the approximate distance matrix of the landmark embedding.
+		"""
+		seqs = [s[0] for s in self.S]
+		self.landmarks = pickLandmarks(seqs, self.n_landmarks,
+			self.landmark_pick)
+		printAndFlush("Generating landmark HMMs (parallel)...")
+		start = clock()
+		self.init_hmms = self._doMap(trainHMM,
+			(([seqs[i]], self.target_m) for i in self.landmarks))
+		self.times['init_hmms'] = clock() - start
+		printAndFlush("done")
+
+		printAndFlush("Embedding %i sequences (parallel)..." % self.n)
+		start = clock()
+		blocks = xrange(0, (self.n + DIST_BLOCK - 1)/DIST_BLOCK)
+		if self.n_jobs == -1:
+			initEmbedWorker(seqs, self.init_hmms)
+			results = imap(embedBlock, blocks)
+		else:
+			pool = Pool(self.n_jobs, initEmbedWorker, (seqs, self.init_hmms))
+			results = pool.imap_unordered(embedBlock, blocks)
+		self.embedding = zeros((self.n, len(self.landmarks)), float64)
+		for b, E in results:
+			self.embedding[b*DIST_BLOCK:b*DIST_BLOCK + len(E)] = E
+		if self.n_jobs != -1:
+			pool.close()
+			pool.join()
+		condensed = array(pdist(self.embedding), float32)
+		self.times['distance_matrix'] = clock() - start
+		printAndFlush("done")
+		if self.n > 1:
+			printAndFlush("Minimum distance: %f" % condensed.min())
+			printAndFlush("Maximum distance: %f" % condensed.max())
+		return condensed
+
+	def _getKNNGraph(self):
+		"""
+		Compute the symmetrized k nearest neighbour graph of the sequences
+		under Rabiner's HMM distance. Each sequence's neighbours are looked
+		for among its KNN_CANDIDATES*n_neighbors nearest by knnFeatures,
+		so only O(n*k) full likelihoods are evaluated.
+		@return: (rows, cols, dists) arrays of the edges, rows < cols
+		"""
+		seqs = [s[0] for s in self.S]
 		printAndFlush("Generating default HMMs (parallel)...")
 		start = clock()
-		# inital hmm?
-		self.init_hmms = self._doMap(init_fn,
+		self.init_hmms = self._doMap(trainHMM,
 			(([s[0]], self.target_m) for s in self.S))
 		self.times['init_hmms'] = clock() - start
 		printAndFlush("done")
 
-		# Compute distance matrix in parallel (in batches of 500,000).
-		n_batchitems = (self.n)*(self.n+1)/2 - self.n
-		condensed = []
-		printAndFlush("Computing distance matrix (parallel)...")
-		printAndFlush("Processing %i batch items" % n_batchitems)
+		printAndFlush("Computing kNN graph (parallel)...")
 		start = clock()
-		# Split the distance matrix calculation into mini batches of 500,000
-		# pairs to avoid a bug in the multiprocessing API.
-		batch_size = 500000
-		for i in xrange(0, (n_batchitems)/batch_size + 1):
-			start, stop = batch_size*i, min(batch_size*(i+1), n_batchitems)
-			printAndFlush("Items %i-%i" % (start, stop))
-			dist_batch = self._getHMMBatchItems()
-			mini_batch = islice(dist_batch, start, stop)
-			condensed += self._doMap(symDistance, mini_batch)
+		k = min(self.n_neighbors, self.n - 1)
+		n_cand = min(KNN_CANDIDATES*k, self.n - 1)
+		features = knnFeatures(seqs, self.init_hmms)
+		# the nearest point by features is the sequence itself, unless
+		# there are duplicates; either way drop a sequence from its own list
+		found = cKDTree(features).query(features, n_cand + 1)[1]
+		found = found.reshape(self.n, n_cand + 1)
+		candidates = zeros((self.n, n_cand), int64)
+		for i in xrange(0, self.n):
+			others = found[i][found[i] != i]
+			candidates[i] = others[0:n_cand]
+		blocks = xrange(0, (self.n + DIST_BLOCK - 1)/DIST_BLOCK)
+		args = (seqs, self.init_hmms, candidates, k)
+		if self.n_jobs == -1:
+			initKNNWorker(*args)
+			results = map(knnBlock, blocks)
+		else:
+			pool = Pool(self.n_jobs, initKNNWorker, args)
+			results = pool.map(knnBlock, blocks)
+			pool.close()
+			pool.join()
+		rows = concatenate([r[0] for r in results])
+		cols = concatenate([r[1] for r in results])
+		dists = concatenate([r[2] for r in results])
+		# i -> j and j -> i are the same edge
+		lo, hi = minimum(rows, cols), rows + cols - minimum(rows, cols)
+		first = unique(lo*self.n + hi, return_index=True)[1]
 		self.times['distance_matrix'] = clock() - start
 		printAndFlush("done")
-		# log-likelihoods are <= 0, a distance function must be positive
-		shifted = map(lambda l: -1*l, condensed)
-		printAndFlush("Minimum distance: %f" % min(shifted))
-		printAndFlush("Maximum distance: %f" % max(shifted))
-
-		return array(shifted, float32)
+		return (lo[first], hi[first], dists[first])
 
 	# def _getEditDistMatrix(self):
 	# 	"""
@@ -398,6 +858,11 @@ class HMMCluster():
 			condensed = self._getHMMDistMatrix()
 		elif self.dist_func == 'editdistance':
 			condensed = self._getEditDistMatrix()
+		elif self.dist_func == 'landmark':
+			condensed = self._getLandmarkDistMatrix()
+		elif self.dist_func == 'knn':
+			raise ValueError("'knn' gives a sparse graph, not a distance "
+				"matrix; it can only be clustered hierarchically")
 		return condensed
 
 	def _hierarchical(self):
@@ -405,10 +870,18 @@ class HMMCluster():
 		Create multiple partitions for k values in [self.min_k... self.max_k]
 		via hierarchical, agglomerative clustering.
 		"""
-		self.dist_matrix = self._getDistMatrix()
-		printAndFlush("Hierarchical clustering (serial)...")
-		# tree = treecluster(distancematrix=self.dist_matrix, method='m')
-		linkage_matrix = linkage(self.dist_matrix, method='complete')
+		if self.dist_func == 'knn':
+			self.knn_graph = self._getKNNGraph()
+			printAndFlush("Hierarchical clustering (serial)...")
+			if self.knn_linkage == 'single':
+				linkage_matrix = mstLinkage(self.n, *self.knn_graph)
+			else:
+				linkage_matrix = averageLinkage(self.n, *self.knn_graph)
+		else:
+			self.dist_matrix = self._getDistMatrix()
+			printAndFlush("Hierarchical clustering (serial)...")
+			# tree = treecluster(distancematrix=self.dist_matrix, method='m')
+			linkage_matrix = linkage(self.dist_matrix, method='complete')
 		for k in self.k_values:
 			# labels = tree.cut(k)
 			labels = fcluster(linkage_matrix, k, 'maxclust')
@@ -431,7 +904,12 @@ class HMMCluster():
 		via k-medoids.
 		"""
 		self.dist_matrix = self._getDistMatrix()
-		batch_items = ((self.dist_matrix, k, 10) for k in self.k_values)
+		# workers map a stored matrix themselves instead of each being sent
+		# a copy
+		dist_matrix = self.dist_matrix
+		if self.dist_path is not None and not self.single_threaded:
+			dist_matrix = self.dist_path
+		batch_items = ((dist_matrix, k, 10) for k in self.k_values)
 		printAndFlush("K-medoids clustering (parallel)...")
 		results = self._doMap(kMedoids, batch_items)
 		printAndFlush("done")
@@ -454,16 +932,26 @@ class HMMCluster():
 			self._kMedoids()
 		self.times['clustering'] = clock() - start
 
-	def _trainModels(self):
+	def _partitionLabelings(self):
+		for k in self.k_values:
+			clusters = partition(self.S, self.labelings[k])
+			self.partitions[k] = (clusters)
+
+	def trainingTasks(self):
 		"""
-		Train a HMM mixture on each of the k-partitions by separately training
-		an HMM on each cluster.
+		Partition the sequences by the labelings, and list the HMMs to train
+		on the clusters. finishModels takes the trained HMMs; between the
+		two, the tasks can be run by anything, such as a SweepScheduler
+		along with other HMMClusters' (see sweep.py).
+		@return: a list of (series, target_m) arguments to trainHMM
 		"""
+		self._partitionLabelings()
 		batch_items = [] 
 		cluster_sizes = [] # size of clusters
 		seq_lens = [] # len of time series replaces actual times series
 			      # e.g. [[1, 2, 3, 4],[2,3],[3,2,4,1,1]] -> [4, 2, 5]
 		cluster_ips = []
+		self.calc_ks = []
 		# Build a list of mapping items to submit as a bulk job
 		# for each k_value (predicted range of clusters)given
 		for k in self.k_values:
@@ -484,7 +972,25 @@ class HMMCluster():
 				clusSeen += 1
 
 			self.calc_ks.append(clusSeen)
+		self._task_info = (cluster_sizes, seq_lens, cluster_ips)
+		return batch_items
+
+	def isLargeTask(self, task):
+		"""
+		@param task: a task from trainingTasks
+		@return: True if its HMM should be trained with the E-step split
+			across the pool (see parallel_bw)
+		"""
+		return (self.parallel_bw is not None and not self.single_threaded
+			and len(task[0]) >= self.parallel_bw)
 
+	def finishModels(self, hmm_triples):
+		"""
+		Build the mixtures for each k from the HMMs trained for
+		trainingTasks.
+		@param hmm_triples: the trained triple of each task, in order
+		"""
+		cluster_sizes, seq_lens, cluster_ips = self._task_info
 		# initialize components[k]
 		for k in self.k_values:
 			self.components[k] = {
@@ -493,11 +999,6 @@ class HMMCluster():
 				'seq_lens': [],
 				'cluster_ips': []
 			}
-		printAndFlush("Training components on clusters (parallel)...")
-		start = clock()
-		hmm_triples = self._doMap(trainHMM, batch_items)
-		self.times['modeling'] = clock() - start
-		printAndFlush("done")
 		idx = 0
 		# Reconstruct the mixtures for each k from the list of trained HMMS
 		# Some algorithms may produce fewer clusters than set
@@ -515,6 +1016,31 @@ class HMMCluster():
 				self.components[k]['cluster_ips'].append(cluster_ip)
 				idx += 1
 			actualClusSize += 1
+
+	def _trainModels(self):
+		"""
+		Train a HMM mixture on each of the k-partitions by separately training
+		an HMM on each cluster.
+		"""
+		batch_items = self.trainingTasks()
+		printAndFlush("Training components on clusters (parallel)...")
+		start = clock()
+		hmm_triples = [None]*len(batch_items)
+		large = [i for i, item in enumerate(batch_items) if
+			self.isLargeTask(item)]
+		# one shard per worker; n_jobs doesn't give the size of an injected
+		# pool when it's -1, so that's cpu_count() shards
+		n_shards = None if self.n_jobs == -1 else self.n_jobs
+		for i in large:
+			hmm_triples[i] = trainHMM(batch_items[i], self.pool, n_shards)
+		rest = [i for i, item in enumerate(batch_items) if
+			not self.isLargeTask(item)]
+		for i, triple in izip(rest, self._doMap(trainHMM,
+				[batch_items[i] for i in rest])):
+			hmm_triples[i] = triple
+		self.times['modeling'] = clock() - start
+		printAndFlush("done")
+		self.finishModels(hmm_triples)
 		print "done"
 
 	def model(self):
@@ -527,13 +1053,9 @@ class HMMCluster():
 		start = clock()
 		# self._cluster()
 
-		for k in self.k_values:
-			clusters = partition(self.S, self.labelings[k])
-			self.partitions[k] = (clusters)
-
 		self._trainModels()
 		self.times['total'] = clock() - start
-		if not self.single_threaded:
+		if not self.single_threaded and self.own_pool:
 			self.pool.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+"""
+Hierarchical clustering of a sparse distance graph, like the k nearest
+neighbour graph smyth.HMMCluster builds for its 'knn' distance, in O(edges)
+memory. The graph is given as three arrays, an edge (rows[e], cols[e]) of
+length dists[e] each. Both linkages return a linkage matrix in the format of
+scipy.cluster.hierarchy's, which fcluster can cut.
+
+Only clusters joined by an edge are merged on their own. If the graph is
+disconnected, its components are merged last, one at a time, above the
+highest merge.
+"""
+
+from numpy import zeros, argsort, float64
+from heapq import heapify, heappush, heappop
+
+def _linkageMatrix(n, merges):
+	# scipy's linkage matrix from a list of (a, b, height, size) merges, with
+	# heights made monotone so cutting the tree at a height is well defined
+	Z = zeros((max(n - 1, 0), 4), float64)
+	heights = {}
+	for m, (a, b, height, size) in enumerate(merges):
+		height = max(height, heights.get(a, 0), heights.get(b, 0))
+		heights[n + m] = height
+		Z[m] = (min(a, b), max(a, b), height, size)
+	return Z
+
+def _joinComponents(n, merges, roots, sizes):
+	# merge what's left of the forest, at one height above every merge
+	top = max([m[2] for m in merges] + [0.0])*2 + 1
+	roots = sorted(roots)
+	if len(roots) == 0:
+		return merges
+	current, size = roots[0], sizes[roots[0]]
+	for root in roots[1:]:
+		size += sizes[root]
+		merges.append((current, root, top, size))
+		current = n + len(merges) - 1
+	return merges
+
+def mstLinkage(n, rows, cols, dists):
+	"""
+	Single linkage of a sparse graph: Kruskal's algorithm over its edges,
+	shortest first, which merges along the minimum spanning tree.
+	@param n: the number of points
+	@param rows, cols, dists: the edges
+	@return: the linkage matrix
+	"""
+	parent = range(0, n)
+	# the linkage matrix id and size of the cluster at each root
+	label = range(0, n)
+	sizes = [1]*n
+	def find(i):
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+	merges = []
+	for e in argsort(dists, kind='mergesort'):
+		a, b = find(rows[e]), find(cols[e])
+		if a == b:
+			continue
+		if sizes[a] < sizes[b]:
+			a, b = b, a
+		size = sizes[a] + sizes[b]
+		merges.append((label[a], label[b], float(dists[e]), size))
+		parent[b] = a
+		sizes[a] = size
+		label[a] = n + len(merges) - 1
+	roots = [i for i in xrange(0, n) if find(i) == i]
+	return _linkageMatrix(n, _joinComponents(n, merges,
+		[label[r] for r in roots], dict((label[r], sizes[r]) for r in roots)))
+
+def averageLinkage(n, rows, cols, dists):
+	"""
+	Average linkage of a sparse graph. The distance between two clusters is
+	the mean length of the edges between them; clusters without an edge
+	between them aren't compared.
+	@param n: the number of points
+	@param rows, cols, dists: the edges
+	@return: the linkage matrix
+	"""
+	# nbrs[c][d] = [sum of edge lengths, number of edges] between clusters
+	# c and d, keyed by linkage matrix id
+	nbrs = dict((i, {}) for i in xrange(0, n))
+	for i, j, d in zip(rows.tolist(), cols.tolist(), dists.tolist()):
+		if i == j or j in nbrs[i]:
+			continue
+		nbrs[i][j] = [d, 1]
+		nbrs[j][i] = [d, 1]
+	sizes = dict((i, 1) for i in xrange(0, n))
+	heap = [(s/c, i, j) for i in nbrs for j, (s, c) in nbrs[i].iteritems()
+		if i < j]
+	heapify(heap)
+	merges = []
+	while heap:
+		avg, a, b = heappop(heap)
+		# skip entries for merged clusters and outdated averages
+		if a not in nbrs or b not in nbrs[a]:
+			continue
+		s, c = nbrs[a][b]
+		if s/c != avg:
+			continue
+		new = n + len(merges)
+		merges.append((a, b, avg, sizes[a] + sizes[b]))
+		sizes[new] = sizes.pop(a) + sizes.pop(b)
+		edges_a, edges_b = nbrs.pop(a), nbrs.pop(b)
+		del edges_a[b], edges_b[a]
+		# reuse the bigger edge dict for the new cluster
+		if len(edges_a) < len(edges_b):
+			edges_a, edges_b = edges_b, edges_a
+		for x, (s, c) in edges_b.iteritems():
+			if x in edges_a:
+				edges_a[x][0] += s
+				edges_a[x][1] += c
+			else:
+				edges_a[x] = [s, c]
+		nbrs[new] = edges_a
+		for x, pair in edges_a.iteritems():
+			edges_x = nbrs[x]
+			edges_x.pop(a, None)
+			edges_x.pop(b, None)
+			edges_x[new] = pair
+			heappush(heap, (pair[0]/pair[1], min(x, new), max(x, new)))
+	return _linkageMatrix(n, _joinComponents(n, merges, nbrs.keys(), sizes))
@@ -0,0 +1,180 @@
+"""
+Runs the HMM training of many HMMClusters, like the (trial, target_m) sweep
+of build_models.py, on one persistent pool. Rather than each HMMCluster
+mapping its own clusters in its own pool, the trainHMM tasks of all of them
+are submitted together.
+
+The HMMClusters of one trial share their labelings, so the same cluster
+comes up once for every target_m. Tasks on the same sequences are grouped
+into one, which runs the exact k-means of smythEmissionDistributions once
+for the largest target_m and then Baum-Welch for each target_m in turn.
+Groups are submitted one at a time, in decreasing order of their estimated
+cost (total observations x the sum of their target_m). The biggest clusters
+start first, and the small ones fill in around them, so workers aren't left
+idle behind a big cluster at the end of the list. Clusters an HMMCluster
+marks as large (see its parallel_bw) are trained before all of them, each
+with its Baum-Welch E-step split across the whole pool.
+"""
+
+from smyth import (smythEmissionDistributions, trainFromEmissions,
+	printAndFlush)
+from numpy import asarray, float64, int64
+from multiprocessing import Pool
+from hashlib import md5
+from time import time
+
+def taskKey(series):
+	"""
+	@param series: the sequences of a trainHMM task
+	@return: a key that is the same for tasks on the same sequences
+	"""
+	h = md5(asarray([len(s) for s in series], int64).tostring())
+	for s in series:
+		h.update(asarray(s, float64).tostring())
+	return h.hexdigest()
+
+def taskCost(task):
+	"""
+	@param task: a (series, target_ms) trainGroup task
+	@return: its estimated cost, the total number of observations times
+		the sum of target_ms
+	"""
+	series, target_ms = task
+	return sum(len(s) for s in series)*sum(target_ms)
+
+def trainGroup(task, pool=None, n_shards=None):
+	"""
+	trainHMM for several target_m on the same sequences, from a single
+	k-means pass.
+	@param task: a tuple (series, target_ms), of the sequences and a list of
+		target_m values
+	@param pool: See trainHMM
+	@param n_shards: See trainHMM
+	@return: a (triple, seconds) pair for each target_m, in order: the
+		trained triple, and the seconds its Baum-Welch took plus an even
+		share of the k-means
+	"""
+	series, target_ms = task
+	start = time()
+	emissions = smythEmissionDistributions((series, max(target_ms)))
+	shared = (time() - start)/len(target_ms)
+	trained = []
+	for target_m in target_ms:
+		start = time()
+		triple = trainFromEmissions(series,
+			emissions[min(target_m, len(emissions)) - 1], pool, n_shards)
+		trained.append((triple, shared + time() - start))
+	return trained
+
+def _runTask(item):
+	# (index, task) -> (index, trainGroup result)
+	idx, task = item
+	return (idx, trainGroup(task))
+
+class SweepScheduler(object):
+	"""
+	A pool of workers that stays up across HMMClusters, and trains their
+	models together.
+	"""
+	def __init__(self, n_jobs=None):
+		"""
+		@param n_jobs: the number of worker processes, cpu_count() if None,
+			or -1 to train in this process
+		"""
+		self.n_jobs = n_jobs
+		self.single_threaded = n_jobs == -1
+		self.pool = None if self.single_threaded else Pool(n_jobs)
+		self.clusterings = []
+
+	def add(self, clust):
+		"""
+		Queue an HMMCluster's models to be trained by the next run. It should
+		have been created with this scheduler's pool.
+		@param clust: the HMMCluster
+		"""
+		self.clusterings.append(clust)
+
+	def run(self, on_done=None):
+		"""
+		Train the models of every queued HMMCluster, and empty the queue.
+
+		As in HMMCluster.model, each HMMCluster's times['modeling'] is the
+		time spent training its models and times['total'] that plus the time
+		to build its components. Since they are trained alongside other
+		clusterings', the training time is the seconds the workers spent on
+		its tasks rather than wall time, with the time of work shared with
+		other clusterings (a model of the same cluster and target_m, or the
+		k-means of a cluster) split evenly between them.
+		@param on_done: called with each HMMCluster as soon as its models
+			are trained (and its components built)
+		"""
+		# the group of each distinct cluster: its sequences, whether any of
+		# its tasks is large, and the (clustering, task) pairs of each
+		# target_m, in the order they first come up
+		groups = []
+		group_index = {}
+		remaining = []
+		for c, clust in enumerate(self.clusterings):
+			clust_tasks = clust.trainingTasks()
+			for i, task in enumerate(clust_tasks):
+				series, target_m = task
+				key = taskKey(series)
+				if key not in group_index:
+					group_index[key] = len(groups)
+					groups.append([series, False, {}])
+				group = groups[group_index[key]]
+				group[1] = group[1] or clust.isLargeTask(task)
+				group[2].setdefault(target_m, []).append((c, i))
+			remaining.append(len(clust_tasks))
+		results = [[None]*n for n in remaining]
+		spent = [0.0]*len(remaining)
+		tasks = [(series, sorted(owners)) for series, _, owners in groups]
+		order = sorted(xrange(0, len(tasks)), key=lambda t: -taskCost(tasks[t]))
+		# clusters big enough to split Baum-Welch across the pool go first,
+		# one at a time, each with the whole pool
+		large = [t for t in order if groups[t][1]]
+		order = [t for t in order if not groups[t][1]]
+		printAndFlush("Training %i components of %i clusterings on %i "
+			"clusters..." % (sum(remaining), len(self.clusterings),
+			len(tasks)))
+		for c, n in enumerate(remaining):
+			if n == 0:
+				self._finish(c, results[c], spent[c], on_done)
+		def collect(t, trained):
+			owners = groups[t][2]
+			for target_m, (triple, seconds) in zip(tasks[t][1], trained):
+				share = seconds/len(owners[target_m])
+				for c, i in owners[target_m]:
+					results[c][i] = triple
+					spent[c] += share
+					remaining[c] -= 1
+					if remaining[c] == 0:
+						self._finish(c, results[c], spent[c], on_done)
+		for t in large:
+			collect(t, trainGroup(tasks[t], self.pool, self.n_jobs))
+		items = ((t, tasks[t]) for t in order)
+		if self.single_threaded:
+			trained = (_runTask(item) for item in items)
+		else:
+			trained = self.pool.imap_unordered(_runTask, items, 1)
+		for t, group_trained in trained:
+			collect(t, group_trained)
+		printAndFlush("done")
+		self.clusterings = []
+
+	def _finish(self, c, triples, seconds, on_done):
+		clust = self.clusterings[c]
+		start = time()
+		clust.finishModels(triples)
+		clust.times['modeling'] = seconds
+		clust.times['total'] = seconds + time() - start
+		if on_done is not None:
+			on_done(clust)
+
+	def close(self):
+		"""
+		Shut the workers down.
+		"""
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
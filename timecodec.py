@@ -0,0 +1,171 @@
+"""
+Fast conversions between log timestamps and milliseconds since January 1,
+2013 (see logparse.parse_time). Handles the tor format "Jan 01 HH:MM:SS.mmm"
+and the Shadow virtual time format "H:M:S:nnnnnnnnn". Fields are read with
+fixed width slices and integer arithmetic instead of datetime, and the
+seconds value of each distinct date prefix is memoized, since consecutive
+log lines nearly always fall in the same second.
+
+	Syntax: python timecodec.py [n_lines]
+
+Runs a benchmark of the codec against the datetime based conversions it
+replaces on n_lines synthetic timestamps (default 200000).
+"""
+
+from numpy import array, fromiter, frombuffer, int64, uint8, zeros
+from datetime import datetime
+from random import randint, seed
+from time import time
+import sys
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep",
+	"Oct", "Nov", "Dec"]
+# days before the first of each month in 2013 (not a leap year)
+MONTH_DAYS = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365]
+MONTH_START = dict(zip(MONTHS, MONTH_DAYS))
+# the memo tables are cleared when they grow past this many entries
+MEMO_SIZE = 100000
+TOR_WIDTH = 19
+
+_tor_seconds = {}
+_shadow_seconds = {}
+_tor_prefixes = {}
+
+def tor_millis(time_str):
+	"""
+	Parse a tor log timestamp.
+	@param time_str: a string starting with a timestamp in the format
+		"Jan 01 HH:MM:SS.mmm"
+	@return: The number of milliseconds since January 1, 2013, as an int
+	"""
+	prefix = time_str[0:15]
+	seconds = _tor_seconds.get(prefix)
+	if seconds is None:
+		days = MONTH_START[prefix[0:3]] + int(prefix[4:6]) - 1
+		seconds = (86400*days + 3600*int(prefix[7:9]) + 60*int(prefix[10:12]) +
+			int(prefix[13:15]))
+		if len(_tor_seconds) >= MEMO_SIZE:
+			_tor_seconds.clear()
+		_tor_seconds[prefix] = seconds
+	return 1000*seconds + int(time_str[16:19])
+
+def shadow_millis(time_str):
+	"""
+	Parse a Shadow virtual timestamp, truncating it to the millisecond.
+	@param time_str: a timestamp in the format "H:M:S:nnnnnnnnn", with any
+		number of digits for the hours, minutes and seconds
+	@return: The number of milliseconds since the start of the simulation
+		(January 1, 2013), as an int
+	"""
+	prefix = time_str[0:-10]
+	seconds = _shadow_seconds.get(prefix)
+	if seconds is None:
+		hours, minutes, secs = prefix.split(":")
+		seconds = 3600*int(hours) + 60*int(minutes) + int(secs)
+		if len(_shadow_seconds) >= MEMO_SIZE:
+			_shadow_seconds.clear()
+		_shadow_seconds[prefix] = seconds
+	return 1000*seconds + int(time_str[-9:-6])
+
+def tor_time(millis):
+	"""
+	Format a timestamp the way tor logs it.
+	@param millis: the number of milliseconds since January 1, 2013
+	@return: the timestamp in the format "Jan 01 HH:MM:SS.mmm"
+	"""
+	seconds, ms = divmod(int(millis), 1000)
+	prefix = _tor_prefixes.get(seconds)
+	if prefix is None:
+		days, rem = divmod(seconds, 86400)
+		hours, rem = divmod(rem, 3600)
+		minutes, secs = divmod(rem, 60)
+		month = 0
+		while MONTH_DAYS[month+1] <= days:
+			month += 1
+		prefix = "%s %02i %02i:%02i:%02i." % (MONTHS[month],
+			days - MONTH_DAYS[month] + 1, hours, minutes, secs)
+		if len(_tor_prefixes) >= MEMO_SIZE:
+			_tor_prefixes.clear()
+		_tor_prefixes[seconds] = prefix
+	return prefix + "%03i" % ms
+
+def tor_millis_block(lines):
+	"""
+	Parse the timestamps at the start of a block of tor log lines at once.
+	@param lines: a list of lines, each starting with a timestamp in the
+		format "Jan 01 HH:MM:SS.mmm"
+	@return: a numpy int64 array of milliseconds since January 1, 2013
+	"""
+	n = len(lines)
+	if n == 0:
+		return zeros(0, int64)
+	stamps = "".join([line[0:TOR_WIDTH] for line in lines])
+	chars = frombuffer(stamps, uint8).reshape(n, TOR_WIDTH).astype(int64)
+	digits = chars - ord("0")
+	def field(i):
+		return 10*digits[:,i] + digits[:,i+1]
+	days = field(4) - 1
+	month_codes = (chars[:,0] << 16) | (chars[:,1] << 8) | chars[:,2]
+	for name, start in MONTH_START.iteritems():
+		code = (ord(name[0]) << 16) | (ord(name[1]) << 8) | ord(name[2])
+		days[month_codes == code] += start
+	seconds = 86400*days + 3600*field(7) + 60*field(10) + field(13)
+	millis = 100*digits[:,16] + 10*digits[:,17] + digits[:,18]
+	return 1000*seconds + millis
+
+def shadow_millis_block(time_strs):
+	"""
+	Parse a block of Shadow virtual timestamps at once.
+	@param time_strs: a list of timestamps in the format "H:M:S:nnnnnnnnn"
+	@return: a numpy int64 array of milliseconds since the start of the
+		simulation
+	"""
+	return fromiter((shadow_millis(s) for s in time_strs), int64,
+		len(time_strs))
+
+def _strptime_millis(time_str):
+	# the datetime based conversion logparse.parse_time used to do
+	augmented = "2013 " + time_str
+	date_parsed = datetime.strptime(augmented[0:-4],'%Y %b %d %H:%M:%S')
+	n_seconds = 1.0*(date_parsed - datetime(2013, 1, 1)).total_seconds()
+	return 1000*n_seconds + int(time_str[-3:])
+
+def _strftime_tor_time(time_str):
+	# the datetime based conversion logshadow.py used to do
+	hours, minutes, seconds, nano = [int(x) for x in
+		time_str.replace(".",":").split(":")]
+	date = datetime(2013, 1, 1, hours, minutes, seconds, nano/1000)
+	return date.strftime("%b %d %H:%M:%S.%f")[0:-3]
+
+def _bench(name, func, n_lines):
+	start = time()
+	result = func()
+	elapsed = max(time() - start, 1e-9)
+	print "%-32s %12.0f lines/s" % (name, n_lines/elapsed)
+	return result
+
+if __name__ == "__main__":
+	n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	seed(0)
+	shadow_strs = []
+	nanos = 0
+	for i in xrange(0, n_lines):
+		nanos += randint(0, 2000000)
+		secs, nano = divmod(nanos, 10**9)
+		shadow_strs.append("%i:%i:%i:%09i" % (secs/3600, secs/60 % 60,
+			secs % 60, nano))
+	tor_strs = _bench("datetime.strftime (logshadow)",
+		lambda: [_strftime_tor_time(s) for s in shadow_strs], n_lines)
+	codec_strs = _bench("tor_time(shadow_millis(...))",
+		lambda: [tor_time(shadow_millis(s)) for s in shadow_strs], n_lines)
+	assert tor_strs == codec_strs
+	_bench("shadow_millis_block", lambda: shadow_millis_block(shadow_strs),
+		n_lines)
+	print
+	old = _bench("datetime.strptime (logparse)",
+		lambda: [_strptime_millis(s) for s in tor_strs], n_lines)
+	new = _bench("tor_millis", lambda: [tor_millis(s) for s in tor_strs],
+		n_lines)
+	block = _bench("tor_millis_block", lambda: tor_millis_block(tor_strs),
+		n_lines)
+	assert old == new and array(new, int64).tolist() == block.tolist()
@@ -6,6 +6,7 @@ Last Edited: 08/05/2014
 '''
 
 import sys, re, cPickle, random
+from logreader import open_log
 
 '''
 	Extracts the host name and ip addresses from scallion.log and 
@@ -24,7 +25,7 @@ def circuit_client_map(infile, ident_list):
 	valid_circs = [(i[0][0], hex(i[0][1])[2:]) for i in ident_list] # (relay_ip, circ_id)
 	#valid_circs = [hex(i[0][1])[2:] for i in ident_list]
 	#print valid_circs
-	with open(infile) as f:
+	with open_log(infile) as f:
 		print "Reading file..."
 		n_entries = 0
 		print "Mapping Clients and Circuits..."
@@ -1,34 +1,15 @@
-from numpy import std
-from sequence_utils import trim_inactive_preprocess
-from build_models import filter_criteria_preprocess, log_series_preprocess
+from ingest import trim_records
 import sys, cPickle
 
 if __name__ == "__main__":
 	inpath = sys.argv[1]
 	goodpath = sys.argv[2]
 	rejpath = sys.argv[3]
-	good_records = []
-	rej_records = []
 	with open(inpath) as datafile:
 		data = cPickle.load(datafile)
 		window_size = data['window_size']
 		records = data['records']
-		for record in records:
-			#trimmed = trim_inactive_preprocess(
-			#		record['relays_out'])
-			trimmed = trim_inactive_preprocess(
-					record['relays'])
-			new_rec = {
-				'ident': record['ident'],
-				'create': record['create'],
-				'destroy': record['destroy'],
-				'relays': trimmed,
-			}
-			if filter_criteria_preprocess(
-					log_series_preprocess(trimmed)):
-				good_records.append(new_rec)
-			elif len(trimmed) > 0:
-				rej_records.append(new_rec)
+		good_records, rej_records = trim_records(records)
 	n_gone = len(records) - len(good_records) - len(rej_records)
 	print "%i good records" % len(good_records)
 	print "%i reject records" % len(rej_records)
@@ -46,5 +27,3 @@ if __name__ == "__main__":
 			'records': rej_records
 		}
 		cPickle.dump(rej_out, rej_file)
-
-
@@ -4,16 +4,45 @@ Window the sequences from a logparse.py output file. Outputs a pickled dict:
   'records': same as input, but with 'relay_in' and 'relay_out' replaced by
   			 their windowed versions }
 
-	Syntax: python window.py infile outfile window_size
-window_size is in milliseconds.
+	Syntax: python window.py infile outfile window_size [window_size ...]
+window_size is in milliseconds. infile is either a pickle or a circuit store
+(see circstore.py). Given several window sizes, the circuits are windowed at
+each of them and written to outfile with "_<window_size>" inserted before
+its extension, e.g. win_1000.pickle, win_5000.pickle.
+
+The circuits are windowed in batches with window_arrays, which works on the
+concatenated timestamps of many circuits at once with numpy and gives the
+same windows as window_allrelays. For several window sizes, each batch is
+scanned once into a CountIndex of cumulative cell counts on a grid of the
+sizes' greatest common divisor, and every window size is cut from that,
+unless that grid is so fine (sizes like 1000 and 1001 give a 1 ms grid) that
+the index would be much bigger than the batch; the batch is then windowed
+at each size separately (see INDEX_RATIO).
+The records' 'relays' are RunSeries (see circrecord.py): the windows are
+run-length encoded as they're cut, so long idle stretches cost one run.
 
 @author: Julian Applebaum
 """
 
 from pprint import pprint
-from multiprocessing import Pool
+from numpy import (arange, asarray, bincount, bool_, ceil, clip, concatenate,
+	cumsum, diff, floor, flatnonzero, float64, fromiter, in1d, int32, int64,
+	maximum, minimum, ones, repeat, column_stack, where, zeros)
+from itertools import chain
+from fractions import gcd
+from os.path import splitext
+from array import array
+from circstore import CircuitStore, is_store
+from circrecord import CircuitRecord, WindowSeries, RunSeries
 import sys, cPickle
 
+# number of circuits windowed at once by window_batch and window_store_batch
+WINDOW_BATCH = 10000
+# a CountIndex is only used for several window sizes if it would hold at most
+# this many times as many grid cells as windowing a batch at the smallest of
+# them goes through (its RELAY cells and windows)
+INDEX_RATIO = 4
+
 def window_record(pair):
 	"""
 	Window a record's incoming and outgoing relay time series:
@@ -35,12 +64,463 @@ def window_record(pair):
 	#	'relays_in': windowed_in,
 	#	'relays_out': windowed_out
 	#}
-	return {
-		'ident': ident,
-		'create': create,
-		'destroy': destroy,
-		'relays': windowed_both
-	}
+	return CircuitRecord(ident, create, destroy,
+		relays=WindowSeries(windowed_both))
+
+def window_counts(create, destroy, window_size):
+	"""
+	The number of windows window_allrelays gives each circuit.
+	@param create: array of the circuits' CREATE timestamps
+	@param destroy: array of the circuits' DESTROY timestamps
+	@param window_size: the length, in milliseconds, of each window
+	@return: an int64 array of window counts
+	"""
+	x = (destroy - create)/window_size + .5
+	# round() rounds halves away from zero, numpy.round to even
+	rounded = floor(x)
+	rounded += (x - rounded >= .5)
+	return maximum(1, rounded.astype(int64))
+
+def _walk_indices(rel_times, window_size):
+	# the window_allrelays walk, for a single circuit
+	indices = []
+	window_idx = 0
+	window_end = window_size
+	for time in rel_times:
+		if time > window_end:
+			window_idx += 1
+			window_end += window_size
+		indices.append(window_idx)
+	return indices
+
+def _ideal_windows(rel_times, window_size):
+	# the window each time falls in: the first idx with
+	# time <= (idx + 1)*window_size, fixed up for rounding in the division
+	ideal = ceil(rel_times/window_size).astype(int64) - 1
+	ideal[rel_times > (ideal + 1)*window_size] += 1
+	ideal[(ideal > 0) & (rel_times <= ideal*window_size)] -= 1
+	return maximum(ideal, 0)
+
+def _segments(lengths):
+	# the segment of each item of a concatenation of segments of the given
+	# lengths, and its position in the segment
+	segment = repeat(arange(len(lengths)), lengths)
+	starts = cumsum(lengths) - lengths
+	return (segment, arange(len(segment)) - starts[segment])
+
+def _unordered(rel_times, circ):
+	# the circuits with cells out of time order
+	unordered = flatnonzero((rel_times[1:] < rel_times[:-1]) &
+		(circ[1:] == circ[:-1]))
+	return sorted(set(circ[unordered + 1].tolist()))
+
+def window_indices(times, offsets, create, window_size):
+	"""
+	Find the window each RELAY cell of many circuits falls in, as assigned
+	by window_allrelays. Its walk only moves on by one window per cell, so a
+	cell after a gap of several windows lands in the window after the
+	previous cell's rather than the one its time falls in. For cells in
+	time order, that is idx[k] = min(idx[k-1] + 1, ideal[k]) with idx[-1] = 0,
+	which unrolls to idx[k] = k + min(1, min over j <= k of (ideal[j] - j))
+	and is computed for all circuits at once with one cumulative minimum.
+	Circuits with cells out of time order are walked one by one.
+	@param times: float64 array of the cell timestamps of all the circuits,
+		concatenated
+	@param offsets: int64 array of n_circuits + 1 offsets into times. The
+		cells of circuit i are times[offsets[i]:offsets[i+1]].
+	@param create: float64 array of the circuits' CREATE timestamps
+	@param window_size: the length, in milliseconds, of each window
+	@return: an int64 array of window indices, one per cell
+	"""
+	n_cells = len(times)
+	if n_cells == 0:
+		return zeros(0, int64)
+	lengths = diff(offsets)
+	circ, pos = _segments(lengths)
+	rel_times = times - create[circ]
+	ideal = _ideal_windows(rel_times, window_size)
+	# shift each circuit's keys below all earlier circuits' keys, so the
+	# cumulative minimum starts over at every circuit
+	span = ideal.max() + lengths.max() + 1
+	shift = circ*span
+	keys = ideal - pos - shift
+	indices = pos + minimum(1, minimum.accumulate(keys) + shift)
+
+	for i in _unordered(rel_times, circ):
+		start, stop = offsets[i], offsets[i + 1]
+		indices[start:stop] = _walk_indices(rel_times[start:stop].tolist(),
+			window_size)
+	return indices
+
+def window_arrays(create, destroy, in_times, in_offsets, out_times,
+		out_offsets, window_size):
+	"""
+	Window the relay time series of many circuits at once. Gives the same
+	windows as window_allrelays.
+	@param create: array of the circuits' CREATE timestamps
+	@param destroy: array of the circuits' DESTROY timestamps
+	@param in_times: array of the incoming RELAY cell timestamps of all the
+		circuits, concatenated
+	@param in_offsets: n_circuits + 1 offsets into in_times
+	@param out_times: as in_times, for outgoing RELAY cells
+	@param out_offsets: n_circuits + 1 offsets into out_times
+	@param window_size: the length, in milliseconds, of each window
+	@return: a pair (window_offsets, windows), where windows is an int64
+		array of (in, out) cell counts with one row per window, and the
+		windows of circuit i are windows[window_offsets[i]:window_offsets[i+1]]
+	"""
+	create = asarray(create, float64)
+	destroy = asarray(destroy, float64)
+	n_windows = window_counts(create, destroy, window_size)
+	window_offsets = zeros(len(n_windows) + 1, int64)
+	cumsum(n_windows, out=window_offsets[1:])
+	n_total = int(window_offsets[-1])
+	counts = []
+	for times, offsets in ((in_times, in_offsets), (out_times, out_offsets)):
+		times = asarray(times, float64)
+		offsets = asarray(offsets, int64)
+		indices = window_indices(times, offsets, create, window_size)
+		circ = repeat(arange(len(n_windows)), diff(offsets))
+		if (indices >= n_windows[circ]).any():
+			raise IndexError("list index out of range")
+		counts.append(bincount(window_offsets[:-1][circ] + indices,
+			minlength=n_total))
+	return (window_offsets, column_stack(counts))
+
+def index_cells(create, in_times, in_offsets, out_times, out_offsets, grid):
+	"""
+	Estimate the size of a CountIndex without building it.
+	@param create, in_times, in_offsets, out_times, out_offsets, grid: as
+		for CountIndex
+	@return: about the number of cumulative counts the CountIndex would
+		hold, over both directions
+	"""
+	create = asarray(create, float64)
+	total = 0
+	for times, offsets in ((in_times, in_offsets), (out_times, out_offsets)):
+		times = asarray(times, float64)
+		offsets = asarray(offsets, int64)
+		lengths = diff(offsets)
+		total += 2*len(lengths)
+		starts = offsets[:-1][lengths > 0]
+		if len(starts) > 0:
+			circ = repeat(arange(len(lengths)), lengths)
+			last = maximum.reduceat(times - create[circ], starts)
+			total += int((last.clip(0)/grid).sum())
+	return total
+
+class CountIndex(object):
+	"""
+	Cumulative RELAY cell counts of many circuits over a fine time grid. Built
+	once from the timestamps, it windows the circuits at any multiple of the
+	grid size in time proportional to the number of windows, with the same
+	result as window_arrays.
+
+	For each circuit and direction, cumulative[k] is the number of cells with
+	a time of at most k*grid after the CREATE (times at or before the CREATE
+	count as the first grid cell). The cells a window of m grid cells would
+	get if windows followed time are then a difference of two cumulative
+	counts, and the window_allrelays walk only depends on those counts: a
+	run of c cells whose time falls in window k, after a cell the walk put in
+	window p, lands one per window from min(p + 1, k) on, with the rest in
+	window k. Circuits with cells out of time order keep their timestamps and
+	are walked one by one.
+	"""
+	def __init__(self, create, destroy, in_times, in_offsets, out_times,
+			out_offsets, grid):
+		"""
+		@param create: array of the circuits' CREATE timestamps
+		@param destroy: array of the circuits' DESTROY timestamps
+		@param in_times: array of the incoming RELAY cell timestamps of all
+			the circuits, concatenated
+		@param in_offsets: n_circuits + 1 offsets into in_times
+		@param out_times: as in_times, for outgoing RELAY cells
+		@param out_offsets: n_circuits + 1 offsets into out_times
+		@param grid: the grid size, in milliseconds
+		"""
+		self.create = asarray(create, float64)
+		self.destroy = asarray(destroy, float64)
+		self.grid = grid
+		# per direction: (offsets, cumulative counts, {circuit: times})
+		self.directions = []
+		for times, offsets in ((in_times, in_offsets), (out_times, out_offsets)):
+			times = asarray(times, float64)
+			offsets = asarray(offsets, int64)
+			lengths = diff(offsets)
+			circ, pos = _segments(lengths)
+			rel_times = times - self.create[circ]
+			cells = _ideal_windows(rel_times, grid)
+			# number of grid cells per circuit, up to its last cell
+			n_cells = zeros(len(lengths), int64)
+			if len(cells) > 0:
+				span = cells.max() + 1
+				last_max = maximum.accumulate(cells + circ*span) - circ*span
+				ends = cumsum(lengths) - 1
+				has_cells = lengths > 0
+				n_cells[has_cells] = last_max[ends[has_cells]] + 1
+			cum_offsets = zeros(len(lengths) + 1, int64)
+			cumsum(n_cells + 1, out=cum_offsets[1:])
+			counts = bincount(cum_offsets[:-1][circ] + cells + 1,
+				minlength=int(cum_offsets[-1])).cumsum()
+			# restart the count at each circuit
+			cumulative = counts - repeat(counts[cum_offsets[:-1]], n_cells + 1)
+			unordered = dict((i, rel_times[offsets[i]:offsets[i+1]].tolist())
+				for i in _unordered(rel_times, circ))
+			self.directions.append((cum_offsets, cumulative, unordered))
+
+	def windows(self, window_size):
+		"""
+		Window the circuits.
+		@param window_size: the length, in milliseconds, of each window. It
+			must be a multiple of the grid size.
+		@return: a pair (window_offsets, windows) as returned by window_arrays
+		"""
+		if window_size % self.grid != 0:
+			raise ValueError("window size %s is not a multiple of the grid "
+				"size %s" % (window_size, self.grid))
+		m = window_size // self.grid
+		n_windows = window_counts(self.create, self.destroy, window_size)
+		window_offsets = zeros(len(n_windows) + 1, int64)
+		cumsum(n_windows, out=window_offsets[1:])
+		n_total = int(window_offsets[-1])
+		counts = []
+		for cum_offsets, cumulative, unordered in self.directions:
+			n_cells = diff(cum_offsets) - 1
+			# cell counts of the windows by time: differences of the
+			# cumulative counts at every m-th grid cell
+			n_ideal = (n_cells + m - 1) // m
+			bound_circ, bound = _segments(n_ideal + 1)
+			edges = cumulative[cum_offsets[:-1][bound_circ] +
+				minimum(bound*m, n_cells[bound_circ])]
+			in_window = flatnonzero(bound[1:] > 0) + 1
+			ideal = edges[in_window] - edges[in_window - 1]
+			runs = flatnonzero(ideal)
+			if unordered:
+				runs = runs[~in1d(bound_circ[in_window][runs], unordered.keys())]
+			circ = bound_circ[in_window][runs]
+			k = bound[in_window][runs] - 1
+			c = ideal[runs]
+			# the walk over the runs: before is the number of cells in the
+			# circuit before the run, and start the window its first cell
+			# goes to if it doesn't catch up with k. See window_indices.
+			if len(c) > 0:
+				total = cumsum(c)
+				first = ones(len(c), bool_)
+				first[1:] = circ[1:] != circ[:-1]
+				run_start = maximum.accumulate(where(first, arange(len(c)), 0))
+				before = total - c - (total - c)[run_start]
+				run_min = k - before - c + 1
+				span = abs(run_min).max() + 2
+				shift = circ*span
+				prev_min = minimum.accumulate(run_min - shift) + shift
+				prev_min = concatenate(([1], prev_min[:-1]))
+				prev_min[first] = 1
+				start = before + minimum(1, prev_min)
+				spread = clip(k - start, 0, c)
+				last = where(spread < c, k, start + spread - 1)
+				if (last >= n_windows[circ]).any():
+					raise IndexError("list index out of range")
+			else:
+				start = spread = zeros(0, int64)
+			base = window_offsets[:-1][circ]
+			# one cell per window from start on, and the rest in window k
+			steps = bincount(base + start, minlength=n_total + 1)
+			steps -= bincount(base + start + spread, minlength=n_total + 1)
+			direction = steps.cumsum()[:n_total]
+			rest = flatnonzero(spread < c)
+			direction += bincount(base[rest] + k[rest],
+				weights=(c - spread)[rest], minlength=n_total).astype(int64)
+			for i, rel_times in unordered.iteritems():
+				indices = _walk_indices(rel_times, window_size)
+				if max(indices) >= n_windows[i]:
+					raise IndexError("list index out of range")
+				direction[window_offsets[i]:window_offsets[i+1]] = bincount(
+					indices, minlength=n_windows[i])
+			counts.append(direction)
+		return (window_offsets, column_stack(counts))
+
+def _windowed_records(idents, create, destroy, window_offsets, windows):
+	# run-length encode all the circuits' windows at once: a run starts at
+	# each circuit's first window and wherever the counts change
+	windows = windows.astype(int32)
+	n_total = len(windows)
+	starts = ones(n_total, bool_)
+	starts[1:] = (windows[1:] != windows[:-1]).any(axis=1)
+	starts[window_offsets[:-1]] = True
+	starts = flatnonzero(starts)
+	values = windows[starts]
+	ends = concatenate([starts[1:], [n_total]])
+	run_offsets = starts.searchsorted(window_offsets)
+	records = []
+	for i in xrange(0, len(idents)):
+		first, last = run_offsets[i], run_offsets[i+1]
+		record = CircuitRecord(idents[i], create[i], destroy[i])
+		record.relays = RunSeries(
+			values=array('i', values[first:last].tostring()),
+			ends=array('i', (ends[first:last] - window_offsets[i])
+				.astype(int32).tostring()))
+		records.append(record)
+	return records
+
+def _concatenate(series):
+	# CSR layout of a list of time series, for window_arrays
+	offsets = zeros(len(series) + 1, int64)
+	cumsum([len(s) for s in series], out=offsets[1:])
+	if all(isinstance(s, list) for s in series):
+		# much faster than converting the lists one by one
+		times = fromiter(chain.from_iterable(series), float64, offsets[-1])
+	elif series:
+		# TimeSeries convert to arrays without iterating
+		times = concatenate([asarray(s, float64) for s in series])
+	else:
+		times = zeros(0, float64)
+	return (times, offsets)
+
+def _record_columns(records):
+	# (idents, create, destroy, in_times, in_offsets, out_times, out_offsets)
+	# for a list of records
+	in_times, in_offsets = _concatenate([r['relays_in'] for r in records])
+	out_times, out_offsets = _concatenate([r['relays_out'] for r in records])
+	return ([record['ident'] for record in records],
+		[record['create'] for record in records],
+		[record['destroy'] for record in records],
+		in_times, in_offsets, out_times, out_offsets)
+
+def _store_columns(store, start, stop):
+	# the same, for circuits start, ..., stop-1 of a circuit store
+	in_offsets = asarray(store.in_offsets[start:stop+1])
+	out_offsets = asarray(store.out_offsets[start:stop+1])
+	return ([store.ident(i) for i in xrange(start, stop)],
+		store.create[start:stop].astype(float64).tolist(),
+		store.destroy[start:stop].astype(float64).tolist(),
+		store.in_times[in_offsets[0]:in_offsets[-1]], in_offsets - in_offsets[0],
+		store.out_times[out_offsets[0]:out_offsets[-1]],
+		out_offsets - out_offsets[0])
+
+def _window_columns(columns, window_sizes):
+	# window one batch of circuits at each of window_sizes, going through a
+	# CountIndex if there's more than one and its grid isn't too fine (with
+	# window sizes like 1000 and 1001 it would be 1 ms)
+	idents, create, destroy = columns[0:3]
+	grid = reduce(gcd, window_sizes)
+	use_index = False
+	if len(window_sizes) > 1:
+		in_offsets, out_offsets = columns[4], columns[6]
+		n_cells = (in_offsets[-1] - in_offsets[0]) + (out_offsets[-1] -
+			out_offsets[0])
+		n_windows = window_counts(asarray(create, float64),
+			asarray(destroy, float64), min(window_sizes)).sum()
+		use_index = (index_cells(*(columns[1:2] + columns[3:] + (grid,))) <=
+			INDEX_RATIO*(n_cells + n_windows))
+	if use_index:
+		index = CountIndex(*(columns[1:] + (grid,)))
+		windows = [index.windows(size) for size in window_sizes]
+	else:
+		windows = [window_arrays(*(columns[1:] + (size,))) for size in
+			window_sizes]
+	return [_windowed_records(idents, create, destroy, window_offsets, counts)
+		for window_offsets, counts in windows]
+
+def window_batch(records, window_size):
+	"""
+	Window a list of records as window_record does, WINDOW_BATCH circuits
+	at a time.
+	@param records: records in the format output by logparse.py
+	@param window_size: the length, in milliseconds, of each window, or a
+		list of lengths to window the records at each of
+	@return: the windowed records, or a list of them per window size
+	"""
+	window_sizes = window_size if isinstance(window_size, list) else [window_size]
+	windowed = [[] for size in window_sizes]
+	for start in xrange(0, len(records), WINDOW_BATCH):
+		columns = _record_columns(records[start:start + WINDOW_BATCH])
+		for i, batch in enumerate(_window_columns(columns, window_sizes)):
+			windowed[i] += batch
+	return windowed if isinstance(window_size, list) else windowed[0]
+
+def window_store_batch(store, start, stop, window_size):
+	"""
+	Window a range of the circuits in a circuit store (see circstore.py),
+	straight from its memory mapped columns.
+	@param store: a CircuitStore
+	@param start: the first circuit to window
+	@param stop: one past the last circuit to window
+	@param window_size: the length, in milliseconds, of each window, or a
+		list of lengths to window the circuits at each of
+	@return: the windowed records of circuits start, ..., stop-1, or a list
+		of them per window size
+	"""
+	window_sizes = window_size if isinstance(window_size, list) else [window_size]
+	windowed = _window_columns(_store_columns(store, start, stop), window_sizes)
+	return windowed if isinstance(window_size, list) else windowed[0]
+
+class OnlineWindows(object):
+	"""
+	The windows of one circuit, built up one RELAY cell at a time as the
+	cells arrive, before the circuit's DESTROY is known. Runs the
+	window_allrelays walk for each direction and hands back each window as
+	soon as no later cell can land in it. That is once both walks have moved
+	past it, so only the windows between the two walks' current windows are
+	held: normally one, more while one direction is catching up after a gap.
+
+	A walk moves at most one window per cell, so this is not bounded by
+	time: while one direction is idle, the other adds up to one held window
+	per cell. They can't be handed back early, as the idle walk can still
+	land in any window from its current one on, so a circuit that only
+	sends one way holds a window per cell until the other direction catches
+	up or close() is called.
+	"""
+	__slots__ = ['create', 'window_size', 'idx', 'end', 'base', 'held']
+
+	def __init__(self, create, window_size):
+		"""
+		@param create: the timestamp of the circuit's last CREATE
+		@param window_size: the length, in milliseconds, of each window
+		"""
+		self.create = create
+		self.window_size = window_size
+		# the current window and its end, of the in and out walks
+		self.idx = [0, 0]
+		self.end = [window_size, window_size]
+		# the held windows, [in, out] counts of windows base, base + 1, ...
+		self.base = 0
+		self.held = [[0, 0]]
+
+	def add(self, time, direction):
+		"""
+		Count a RELAY cell.
+		@param time: the cell's timestamp
+		@param direction: 0 for an incoming cell, 1 for an outgoing one
+		@return: the list of (in, out) windows completed by the cell, in order
+		"""
+		if time - self.create > self.end[direction]:
+			self.idx[direction] += 1
+			self.end[direction] += self.window_size
+		pos = self.idx[direction] - self.base
+		if pos == len(self.held):
+			self.held.append([0, 0])
+		self.held[pos][direction] += 1
+		n_done = min(self.idx) - self.base
+		if n_done == 0:
+			return []
+		done = [tuple(window) for window in self.held[0:n_done]]
+		del self.held[0:n_done]
+		self.base += n_done
+		return done
+
+	def close(self, destroy):
+		"""
+		Finish the circuit.
+		@param destroy: the timestamp of the circuit's first DESTROY
+		@return: the list of windows not returned by add yet, padded with
+			(0, 0) windows to the number window_allrelays gives the circuit
+		"""
+		circ_len = destroy - self.create
+		n_windows = max(1, int(round(circ_len/self.window_size + .5)))
+		if self.base + len(self.held) > n_windows:
+			raise IndexError("list index out of range")
+		rest = [tuple(window) for window in self.held]
+		return rest + [(0, 0)]*(n_windows - self.base - len(rest))
 
 def window_allrelays(create, destroy, relays_in, relays_out, window_size):
 	"""
@@ -104,22 +584,34 @@ def window_relays(create, destroy, relays, window_size):
 if __name__ == "__main__":
 	inpath = sys.argv[1]
 	outpath = sys.argv[2]
-	window_size = int(sys.argv[3])
-	pool = Pool()
-	with open(inpath) as data_file:
-		print "Loading circuit data..."
-		records = cPickle.load(data_file)
-
-	with open(outpath, 'w') as out_file:
-		print "Windowing %i circuits (parallel)..." % len(records)
-		map_items = zip(records, [window_size] * len(records))
-		windowed = pool.map(window_record, map_items)
-		#print windowed
-		print "Done"
-		output = {
-			'window_size': window_size,
-			'records': windowed
-		}
-		print "Dumping to %s" % outpath
-		cPickle.dump(output, out_file, protocol=2
-			)
+	window_sizes = [int(arg) for arg in sys.argv[3:]]
+	if is_store(inpath):
+		store = CircuitStore(inpath)
+		n_records = len(store)
+		print "Windowing %i circuits from store..." % n_records
+		windowed = [[] for size in window_sizes]
+		for start in xrange(0, n_records, WINDOW_BATCH):
+			batches = window_store_batch(store, start,
+				min(start + WINDOW_BATCH, n_records), window_sizes)
+			for i, batch in enumerate(batches):
+				windowed[i] += batch
+	else:
+		with open(inpath) as data_file:
+			print "Loading circuit data..."
+			records = cPickle.load(data_file)
+		print "Windowing %i circuits..." % len(records)
+		windowed = window_batch(records, window_sizes)
+
+	print "Done"
+	for window_size, records in zip(window_sizes, windowed):
+		path = outpath
+		if len(window_sizes) > 1:
+			root, ext = splitext(outpath)
+			path = "%s_%i%s" % (root, window_size, ext)
+		with open(path, 'w') as out_file:
+			output = {
+				'window_size': window_size,
+				'records': records
+			}
+			print "Dumping to %s" % path
+			cPickle.dump(output, out_file, protocol=2)